@@ -0,0 +1,306 @@
+"""Cold archive of raw messages to compressed local files
+
+hl7_raw_message retains every message ever received.  To keep the hot
+database (and therefore backups and VACUUMs) from growing with total
+history, raw_data older than a configured age is moved into
+compressed, append-only segment files on local disk.
+
+Each archive run appends blocks to the current segment file.  A block
+is a single gzip member holding JSON lines, one per message, so
+segments may be inspected with `zcat`.  The hl7_raw_message row keeps
+its message_control_id (and unique index), with raw_data set NULL
+and archive_segment / archive_offset locating the block, which
+`HL7_RawMessage.raw_data` transparently reads back.
+
+Configuration (pheme config file)::
+
+    [warehouse]
+    archive_dir=/opt/pheme/archive
+    archive_age_days=365
+
+Project setup.py defines the `archive_raw_messages` entry point.
+
+"""
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import getpass
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import cast
+from sqlalchemy import create_engine
+from sqlalchemy import Float
+from sqlalchemy import select
+
+from pheme.util.config import Config
+from pheme.warehouse.selection import chunked
+from pheme.warehouse.selection import parse_datetime
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7RawMessage_table
+
+
+DEFAULT_ARCHIVE_AGE_DAYS = 365
+
+
+def epoch_millis(when):
+    """Convert datetime to the import_time format (epoch millis)"""
+    return time.mktime(when.timetuple()) * 1000
+
+
+class RawArchive(object):
+    """Append-only, compressed segment files of raw messages
+
+    :param directory: archive location, defaults to the config
+      value [warehouse]archive_dir
+    :param max_segment_bytes: new segments are started once the
+      current segment exceeds this size
+
+    """
+    SEGMENT_FORMAT = 'raw-%06d.seg'
+
+    def __init__(self, directory=None, max_segment_bytes=1 << 30):
+        if directory is None:
+            directory = Config().get('warehouse', 'archive_dir')
+        if not directory:
+            raise ValueError("[warehouse]archive_dir not configured")
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._cached_block = (None, None, {})
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def current_segment(self):
+        """Returns name of the segment to append to"""
+        segments = sorted(f for f in os.listdir(self.directory)
+                          if f.startswith('raw-') and f.endswith('.seg'))
+        if segments:
+            last = segments[-1]
+            if os.path.getsize(self._path(last)) < self.max_segment_bytes:
+                return last
+            number = int(last[4:-4]) + 1
+        else:
+            number = 1
+        return self.SEGMENT_FORMAT % number
+
+    def append(self, records):
+        """Append a block of records to the current segment
+
+        :param records: sequence of (message_control_id, raw_data)
+
+        The block is flushed to disk before returning, so callers may
+        safely remove the database copy.  Returns tuple (segment name,
+        block offset).
+
+        """
+        segment = self.current_segment()
+        with open(self._path(segment), 'ab') as segment_file:
+            segment_file.seek(0, os.SEEK_END)
+            offset = segment_file.tell()
+            block = gzip.GzipFile(fileobj=segment_file, mode='wb')
+            for message_control_id, raw_data in records:
+                block.write(json.dumps({'id': message_control_id,
+                                        'raw': raw_data}) + '\n')
+            block.close()
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        return segment, offset
+
+    def read_block(self, segment, offset):
+        """Returns dictionary of raw_data keyed by message_control_id
+
+        The most recently read block is cached, as lookups tend to
+        hit the same block repeatedly.
+
+        """
+        if self._cached_block[:2] == (segment, offset):
+            return self._cached_block[2]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = []
+        with open(self._path(segment), 'rb') as segment_file:
+            segment_file.seek(offset)
+            while not decompressor.unused_data:
+                chunk = segment_file.read(64 * 1024)
+                if not chunk:
+                    break
+                data.append(decompressor.decompress(chunk))
+        block = {}
+        for line in ''.join(data).splitlines():
+            record = json.loads(line)
+            block[record['id']] = record['raw']
+        self._cached_block = (segment, offset, block)
+        return block
+
+    def lookup(self, message_control_id, segment, offset):
+        """Returns the archived raw_data for the message"""
+        return self.read_block(segment, offset).get(message_control_id)
+
+
+def archive(connection, raw_archive, older_than, block_size=1000):
+    """Move raw_data imported before `older_than` into the archive
+
+    Each block is written to the archive before the database copy is
+    removed, in its own transaction.  An interrupted run can leave an
+    unreferenced block in a segment, but never loses a message.
+
+    Generates the count of messages archived after each block.
+
+    """
+    raw = hl7RawMessage_table.c
+    ids = [row[0] for row in connection.execute(
+        select([raw.hl7_raw_message_id],
+               and_(raw.raw_data != None,
+                    cast(raw.import_time, Float) <
+                    epoch_millis(older_than))).
+        order_by(raw.hl7_raw_message_id))]
+    done = 0
+    for chunk in chunked(ids, block_size):
+        transaction = connection.begin()
+        try:
+            rows = connection.execute(
+                select([raw.hl7_raw_message_id, raw.message_control_id,
+                        raw.raw_data],
+                       and_(raw.hl7_raw_message_id.in_(chunk),
+                            raw.raw_data != None), for_update=True)
+                ).fetchall()
+            segment, offset = raw_archive.append(
+                [(row[1], row[2]) for row in rows])
+            connection.execute(hl7RawMessage_table.update().where(
+                raw.hl7_raw_message_id.in_([row[0] for row in rows])).
+                values(raw_data=None, archive_segment=segment,
+                       archive_offset=offset))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        done += len(rows)
+        yield done
+
+
+def restore(connection, raw_archive, since=None, until=None,
+            block_size=1000, missing=None):
+    """Bring archived raw_data imported within [since, until) back
+
+    :param missing: optional list, extended with the
+      message_control_ids of messages not restored, their block
+      being missing or unreadable.  Such rows keep their archive
+      locator, so a restore can be retried once the segment is
+      recovered.
+
+    Generates the count of messages restored after each block.
+
+    """
+    raw = hl7RawMessage_table.c
+    criteria = [raw.archive_segment != None]
+    if since:
+        criteria.append(cast(raw.import_time, Float) >= epoch_millis(since))
+    if until:
+        criteria.append(cast(raw.import_time, Float) < epoch_millis(until))
+    rows = connection.execute(
+        select([raw.hl7_raw_message_id, raw.message_control_id,
+                raw.archive_segment, raw.archive_offset], and_(*criteria)).
+        order_by(raw.archive_segment, raw.archive_offset)).fetchall()
+    statement = hl7RawMessage_table.update().where(
+        raw.hl7_raw_message_id == bindparam('raw_id')).values(
+            raw_data=bindparam('restored'), archive_segment=None,
+            archive_offset=None)
+    done = 0
+    for chunk in chunked(rows, block_size):
+        restored = []
+        for raw_id, message_control_id, segment, offset in chunk:
+            try:
+                raw_data = raw_archive.lookup(message_control_id, segment,
+                                              offset)
+            except (IOError, ValueError, zlib.error):
+                raw_data = None
+            if raw_data is None:
+                if missing is not None:
+                    missing.append(message_control_id)
+                continue
+            restored.append({'raw_id': raw_id, 'restored': raw_data})
+        if not restored:
+            continue
+        transaction = connection.begin()
+        try:
+            connection.execute(statement, restored)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        done += len(restored)
+        yield done
+
+
+def archive_raw_messages():
+    """Entry point to archive or restore raw message data"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="move old hl7_raw_message "
+                                 "data to (or restore from) compressed "
+                                 "segment files in [warehouse]archive_dir")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'create_table_user'),
+                    help="database user with UPDATE permission "
+                    "(overrides [warehouse]create_table_user)")
+    ap.add_argument("--archive_dir",
+                    default=config.get('warehouse', 'archive_dir'),
+                    help="archive location (overrides "
+                    "[warehouse]archive_dir)")
+    ap.add_argument("--block_size", type=int, default=1000,
+                    help="number of messages per compressed block")
+    subparsers = ap.add_subparsers(dest="command")
+    archive_parser = subparsers.add_parser(
+        "archive", help="archive messages older than the configured age")
+    archive_parser.add_argument(
+        "--age_days", type=int,
+        default=int(config.get('warehouse', 'archive_age_days') or
+                    DEFAULT_ARCHIVE_AGE_DAYS),
+        help="archive messages imported more than this many days ago "
+        "(overrides [warehouse]archive_age_days)")
+    restore_parser = subparsers.add_parser(
+        "restore", help="restore archived messages imported in range")
+    restore_parser.add_argument("--since", type=parse_datetime,
+                                help="imported on or after "
+                                "('YYYY-MM-DD[ HH:MM:SS]')")
+    restore_parser.add_argument("--until", type=parse_datetime,
+                                help="imported before "
+                                "('YYYY-MM-DD[ HH:MM:SS]')")
+    args = ap.parse_args()
+
+    raw_archive = RawArchive(args.archive_dir)
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    engine = create_engine(engine_url(args.user, password, args.db))
+    connection = engine.connect()
+    missing = []
+    try:
+        if args.command == 'archive':
+            older_than = datetime.now() - timedelta(days=args.age_days)
+            progress = archive(connection, raw_archive, older_than,
+                               block_size=args.block_size)
+        else:
+            progress = restore(connection, raw_archive, since=args.since,
+                               until=args.until, block_size=args.block_size,
+                               missing=missing)
+        done = 0
+        for done in progress:
+            print "%s: %d messages" % (args.command, done)
+        print "%s complete, %d messages" % (args.command, done)
+    finally:
+        connection.close()
+    if missing:
+        print "%d messages NOT restored, archived block missing or "\
+            "unreadable:" % len(missing)
+        for message_control_id in missing:
+            print "  %s" % message_control_id
+        sys.exit(1)
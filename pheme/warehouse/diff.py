@@ -0,0 +1,208 @@
+"""Compare the content of two warehouse databases, message by message
+
+Validating a channel change means comparing a freshly processed
+warehouse against the previous one.  Rather than spot checking known
+values, every message is reduced to a content hash, computed in the
+database from the hl7_msh row and all of its child rows (hl7_visit,
+hl7_dx, hl7_obr with its hl7_obx, hl7_nte and hl7_spm rows, plus the
+hl7_obx rows of ADT messages).  Surrogate keys and trigger maintained
+columns are excluded, as they legitimately differ between databases;
+child rows are hashed as an (ordered) set.  Messages are grouped by
+message_control_id.
+
+The comparison streams through each database once in hl7_msh_id
+chunks, looking the same message_control_ids up in the other database
+by index, so the cost is proportional to table size.  Only differing
+messages are reported.
+
+Project setup.py defines the `diff_warehouses` entry point.
+
+"""
+import argparse
+import getpass
+
+from sqlalchemy import create_engine
+from sqlalchemy import select
+from sqlalchemy import text
+
+from pheme.util.config import Config
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Nte_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
+
+
+# Columns maintained by triggers, derived from the compared columns
+DERIVED_COLUMNS = ('fingerprint', 'visit_key', 'patient_key')
+
+
+def content_sql(table, alias):
+    """SQL expression concatenating a row's comparable columns"""
+    fields = []
+    for column in table.columns:
+        if column.primary_key or column.foreign_keys or \
+                column.name in DERIVED_COLUMNS:
+            continue
+        fields.append("coalesce(%s.%s::TEXT, '')" % (alias, column.name))
+    return " || E'\\x1f' || ".join(fields)
+
+
+def _aggregate(expression, from_clause):
+    """Correlated subquery, the ordered set of expression values"""
+    return "coalesce((SELECT string_agg(c, E'\\x1d' ORDER BY c) FROM "\
+        "(SELECT %s AS c FROM %s) s), '')" % (expression, from_clause)
+
+
+def message_hash_sql():
+    """SQL generating (message_control_id, hash, first hl7_msh_id)
+
+    for the control ids given in the :control_ids array parameter.
+
+    """
+    notes = content_sql(hl7Nte_table, 'n')
+    obx = "%s || E'\\x1c' || %s" % (
+        content_sql(hl7Obx_table, 'x'),
+        _aggregate(notes, "hl7_nte n WHERE n.hl7_obx_id = x.hl7_obx_id"))
+    obr = " || E'\\x1c' || ".join((
+        content_sql(hl7Obr_table, 'r'),
+        _aggregate(obx, "hl7_obx x WHERE x.hl7_obr_id = r.hl7_obr_id"),
+        _aggregate(notes, "hl7_nte n WHERE n.hl7_obr_id = r.hl7_obr_id"),
+        _aggregate(content_sql(hl7Spm_table, 'p'),
+                   "hl7_spm p WHERE p.hl7_obr_id = r.hl7_obr_id")))
+    message = " || E'\\x1e' || ".join((
+        content_sql(hl7Msh_table, 'm'),
+        _aggregate(content_sql(hl7Visit_table, 'v'),
+                   "hl7_visit v WHERE v.hl7_msh_id = m.hl7_msh_id"),
+        _aggregate(content_sql(hl7Dx_table, 'd'),
+                   "hl7_dx d WHERE d.hl7_msh_id = m.hl7_msh_id"),
+        _aggregate(obr, "hl7_obr r WHERE r.hl7_msh_id = m.hl7_msh_id"),
+        _aggregate(obx, "hl7_obx x WHERE x.hl7_msh_id = m.hl7_msh_id "
+                   "AND x.hl7_obr_id IS NULL")))
+    return """SELECT message_control_id,
+                     md5(string_agg(hash, '' ORDER BY hash)),
+                     min(hl7_msh_id)
+              FROM (SELECT m.message_control_id, m.hl7_msh_id,
+                           md5(%s) AS hash
+                    FROM hl7_msh m
+                    WHERE m.message_control_id = ANY(:control_ids)) h
+              GROUP BY message_control_id""" % message
+
+
+def message_hashes(connection, control_ids):
+    """Returns dictionary of (hash, first hl7_msh_id) by control id"""
+    if not control_ids:
+        return {}
+    rows = connection.execute(text(message_hash_sql()),
+                              control_ids=list(control_ids))
+    return dict((row[0], (row[1], row[2])) for row in rows)
+
+
+def warehouse_hashes(connection, chunk_size=1000):
+    """Returns dictionary of content hash by control id, for all messages"""
+    hashes = {}
+    for _, control_ids in _chunks(connection, chunk_size):
+        for control_id, (hash, _) in message_hashes(
+                connection, control_ids).items():
+            hashes[control_id] = hash
+    return hashes
+
+
+def _chunks(connection, chunk_size):
+    """Generate (lowest hl7_msh_id, control ids) through hl7_msh"""
+    msh = hl7Msh_table.c
+    last = 0
+    while True:
+        rows = connection.execute(
+            select([msh.hl7_msh_id, msh.message_control_id],
+                   msh.hl7_msh_id > last).
+            order_by(msh.hl7_msh_id).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows[0][0], sorted(set(row[1] for row in rows))
+        last = rows[-1][0]
+
+
+def diff(connection_a, connection_b, chunk_size=1000):
+    """Compare two warehouses, generating the differing messages
+
+    Generates tuples (status, message_control_id), where status is
+    'differs', 'only_a' or 'only_b'.  A message_control_id repeated
+    across chunks is compared once, with the chunk holding its
+    lowest hl7_msh_id.
+
+    """
+    for first, control_ids in _chunks(connection_a, chunk_size):
+        hashes_a = message_hashes(connection_a, control_ids)
+        control_ids = [control_id for control_id in control_ids
+                       if hashes_a[control_id][1] >= first]
+        hashes_b = message_hashes(connection_b, control_ids)
+        for control_id in control_ids:
+            if control_id not in hashes_b:
+                yield 'only_a', control_id
+            elif hashes_a[control_id][0] != hashes_b[control_id][0]:
+                yield 'differs', control_id
+
+    # Messages only in b; just an index probe against a
+    msh = hl7Msh_table.c
+    for first, control_ids in _chunks(connection_b, chunk_size):
+        present = set(row[0] for row in connection_a.execute(
+            select([msh.message_control_id],
+                   msh.message_control_id.in_(control_ids)).distinct()))
+        missing = [control_id for control_id in control_ids
+                   if control_id not in present]
+        if not missing:
+            continue
+        # skip those seen in an earlier chunk of b
+        seen_earlier = set(row[0] for row in connection_b.execute(
+            select([msh.message_control_id],
+                   (msh.message_control_id.in_(missing)) &
+                   (msh.hl7_msh_id < first)).distinct()))
+        for control_id in missing:
+            if control_id not in seen_earlier:
+                yield 'only_b', control_id
+
+
+def diff_warehouses():
+    """Entry point to report messages differing between warehouses"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="compare the content of two "
+                                 "warehouse databases, reporting messages "
+                                 "(by message_control_id) that differ")
+    ap.add_argument("database_b", help="name of the database to compare "
+                    "against")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'database_user'),
+                    help="database user with SELECT permission on both "
+                    "(overrides [warehouse]database_user)")
+    ap.add_argument("--chunk_size", type=int, default=1000,
+                    help="number of messages hashed per query")
+    args = ap.parse_args()
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    connection_a = create_engine(
+        engine_url(args.user, password, args.db)).connect()
+    connection_b = create_engine(
+        engine_url(args.user, password, args.database_b)).connect()
+    labels = {'differs': 'differs', 'only_a': 'only in %s' % args.db,
+              'only_b': 'only in %s' % args.database_b}
+    counts = dict.fromkeys(labels, 0)
+    try:
+        for status, control_id in diff(connection_a, connection_b,
+                                       args.chunk_size):
+            counts[status] += 1
+            print "%s: %s" % (labels[status], control_id)
+    finally:
+        connection_a.close()
+        connection_b.close()
+    print "%d differ, %d only in %s, %d only in %s" % (
+        counts['differs'], counts['only_a'], args.db, counts['only_b'],
+        args.database_b)
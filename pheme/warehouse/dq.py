@@ -0,0 +1,264 @@
+"""Set based data quality checks of the warehouse
+
+The channel test suite verifies data quality by iterating every row in
+Python, which can't scale to a production warehouse.  Here each rule
+is a pair of SQL aggregate queries (rows checked, rows failing), plus
+a small sample of failing values, evaluated over a range of
+hl7_msh_ids.
+
+Checks run incrementally: each rule covers the messages ingested since
+its previous run, i.e. hl7_msh_id above the highest recorded in the
+`dq_result` table for the rule, which receives one row per rule and
+run.  Messages committed late with lower hl7_msh_ids than an earlier
+run covered are only picked up by a `--full` run.
+
+Project setup.py defines the `warehouse_dq` entry point.
+
+"""
+import argparse
+from datetime import datetime
+import getpass
+import sys
+
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import not_
+from sqlalchemy import select
+
+from pheme.util.config import Config
+from pheme.warehouse.tables import dqResult_table
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Visit_table
+
+
+# Failing values recorded per result, at most
+MAX_EXAMPLES = 10
+
+# visit_id as written by the channels, `<id>^^^&<authority>&<type>`
+VISIT_ID_PATTERN = r'^[0-9]+\^\^\^&[^&]+&[A-Z]+$'
+
+PATIENT_CLASSES = ('E', 'I', 'O', 'U')
+
+
+class Rule(object):
+    """A data quality rule over the rows of a table
+
+    :param name: short identifier, recorded in dq_result.rule
+    :param description: one line description of the requirement
+    :param table: the checked table, having an hl7_msh_id column
+    :param failure: SQL expression true for failing rows
+    :param value: column reported in the failure examples
+
+    """
+    def __init__(self, name, description, table, failure, value):
+        self.name = name
+        self.description = description
+        self.table = table
+        self.failure = failure
+        self.value = value
+
+    def in_range(self, first_msh_id, last_msh_id):
+        msh_id = self.table.c.hl7_msh_id
+        return and_(msh_id > first_msh_id, msh_id <= last_msh_id)
+
+    def checked_query(self, first_msh_id, last_msh_id):
+        return select([func.count()], self.in_range(first_msh_id,
+                                                    last_msh_id))
+
+    def failures_query(self, first_msh_id, last_msh_id):
+        return select([func.count()], and_(
+            self.in_range(first_msh_id, last_msh_id), self.failure))
+
+    def examples_query(self, first_msh_id, last_msh_id):
+        return select([self.value], and_(
+            self.in_range(first_msh_id, last_msh_id),
+            self.failure)).distinct().limit(MAX_EXAMPLES)
+
+    def check(self, connection, first_msh_id, last_msh_id):
+        """Returns tuple (rows checked, failures, example values)"""
+        checked = connection.execute(
+            self.checked_query(first_msh_id, last_msh_id)).scalar()
+        failures = connection.execute(
+            self.failures_query(first_msh_id, last_msh_id)).scalar()
+        examples = []
+        if failures:
+            examples = [row[0] for row in connection.execute(
+                self.examples_query(first_msh_id, last_msh_id))]
+        return checked, failures, examples
+
+
+class DuplicateControlIdRule(Rule):
+    """message_control_ids of new messages must be unique warehouse wide
+
+    A duplicate may be an older message, so the new control ids are
+    counted across all of hl7_msh (an index lookup per id).
+
+    """
+    def __init__(self):
+        msh = hl7Msh_table.c
+        super(DuplicateControlIdRule, self).__init__(
+            'duplicate_control_id', "hl7_msh.message_control_id is unique",
+            hl7Msh_table, None, msh.message_control_id)
+
+    def _duplicates(self, first_msh_id, last_msh_id):
+        msh = hl7Msh_table.c
+        new_ids = select([msh.message_control_id],
+                         self.in_range(first_msh_id, last_msh_id))
+        return select([msh.message_control_id],
+                      msh.message_control_id.in_(new_ids)).\
+            group_by(msh.message_control_id).\
+            having(func.count() > 1)
+
+    def failures_query(self, first_msh_id, last_msh_id):
+        return select([func.count()]).select_from(
+            self._duplicates(first_msh_id, last_msh_id).alias('duplicates'))
+
+    def examples_query(self, first_msh_id, last_msh_id):
+        return self._duplicates(first_msh_id, last_msh_id).\
+            order_by(hl7Msh_table.c.message_control_id).limit(MAX_EXAMPLES)
+
+
+def visit_id_rule(authorities=None):
+    """Rule requiring the `<id>^^^&<authority>&<type>` visit_id format
+
+    :param authorities: optional sequence of the accepted
+      `&<authority>&<type>` suffixes, such as '&3768573961&NPI'
+
+    """
+    visit_id = hl7Visit_table.c.visit_id
+    failure = not_(visit_id.op('~')(VISIT_ID_PATTERN))
+    if authorities:
+        failure = failure | not_(
+            func.substr(visit_id, func.strpos(visit_id, '^^^') + 3).in_(
+                list(authorities)))
+    return Rule('visit_id_authority', "hl7_visit.visit_id includes an id "
+                "and known assigning authority", hl7Visit_table, failure,
+                visit_id)
+
+
+def rules(authorities=None):
+    """Returns the list of data quality rules
+
+    :param authorities: accepted visit_id assigning authorities, see
+      `visit_id_rule`
+
+    """
+    visit, msh = hl7Visit_table.c, hl7Msh_table.c
+    return [
+        visit_id_rule(authorities),
+        Rule('patient_class_domain', "hl7_visit.patient_class is one of "
+             + ', '.join(PATIENT_CLASSES), hl7Visit_table,
+             and_(visit.patient_class != None,
+                  not_(visit.patient_class.in_(PATIENT_CLASSES))),
+             visit.patient_class),
+        Rule('message_datetime_not_null', "hl7_msh.message_datetime is "
+             "set", hl7Msh_table, msh.message_datetime == None,
+             msh.message_control_id),
+        DuplicateControlIdRule(),
+    ]
+
+
+def last_checked(connection, rule):
+    """Returns the highest hl7_msh_id already checked by the rule"""
+    dq = dqResult_table.c
+    return connection.execute(select([func.max(dq.last_msh_id)],
+                                     dq.rule == rule.name)).scalar() or 0
+
+
+def run_checks(connection, rule_list, full=False):
+    """Run the rules over the messages new to each, recording results
+
+    :param connection: warehouse connection, with INSERT permission
+      on dq_result
+    :param rule_list: the rules to check, see `rules`
+    :param full: check all messages, not just those new to each rule
+
+    Generates a dictionary per rule, as recorded in dq_result (plus
+    'examples' as a list).  Each rule covers hl7_msh_ids up to the
+    highest in its own table.  Rules without new rows are skipped.
+
+    """
+    run_datetime = datetime.now()
+    for rule in rule_list:
+        # The rule's own table, as a message's derived rows may be
+        # committed after its hl7_msh row
+        last_msh_id = connection.execute(
+            select([func.max(rule.table.c.hl7_msh_id)])).scalar() or 0
+        first_msh_id = 0 if full else last_checked(connection, rule)
+        if first_msh_id >= last_msh_id:
+            continue
+        checked, failures, examples = rule.check(connection, first_msh_id,
+                                                 last_msh_id)
+        result = {'run_datetime': run_datetime, 'rule': rule.name,
+                  'first_msh_id': first_msh_id,
+                  'last_msh_id': last_msh_id, 'checked': checked,
+                  'failures': failures,
+                  'examples': '|'.join(unicode(e) for e in examples)
+                  or None}
+        connection.execute(dqResult_table.insert(), result)
+        result['examples'] = examples
+        yield result
+
+
+def warehouse_dq():
+    """Entry point to run the data quality checks
+
+    Exits with status 1 if any rule reports failures.
+
+    """
+    config = Config()
+    ap = argparse.ArgumentParser(description="run the set based data "
+                                 "quality checks over newly ingested "
+                                 "messages, recording the results in "
+                                 "the dq_result table")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'database_user'),
+                    help="database user with INSERT permission "
+                    "(overrides [warehouse]database_user)")
+    ap.add_argument("--rule", dest="rules", action="append", default=[],
+                    help="run only the named rule (may be repeated)")
+    ap.add_argument("--full", action='store_true',
+                    help="check all messages, not only those new since "
+                    "the previous run")
+    ap.add_argument("--list", action='store_true',
+                    help="list the rules and exit")
+    args = ap.parse_args()
+
+    authorities = config.get('warehouse', 'dq_authorities')
+    if authorities:
+        authorities = [a.strip() for a in authorities.split(',')]
+    rule_list = rules(authorities)
+    if args.list:
+        for rule in rule_list:
+            print "%-28s %s" % (rule.name, rule.description)
+        return
+    if args.rules:
+        unknown = set(args.rules) - set(rule.name for rule in rule_list)
+        if unknown:
+            ap.error("unknown rule(s): %s" % ', '.join(sorted(unknown)))
+        rule_list = [rule for rule in rule_list if rule.name in args.rules]
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    engine = create_engine(engine_url(args.user, password, args.db))
+    connection = engine.connect()
+    failed = False
+    try:
+        for result in run_checks(connection, rule_list, args.full):
+            print "%s: %d of %d rows failed (hl7_msh_id %d to %d)" % (
+                result['rule'], result['failures'], result['checked'],
+                result['first_msh_id'] + 1, result['last_msh_id'])
+            if result['failures']:
+                failed = True
+                print "  e.g.", ', '.join(
+                    repr(example) for example in result['examples'])
+    finally:
+        connection.close()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,654 @@
+"""Native (in-process) extraction of warehouse data from HL7 messages
+
+Python port of the field extraction performed by the Mirth Connect
+channels (see `channels/`).  Each extraction function below names the
+channel it mirrors, and any alterations to channel logic should be
+reflected here, as reprocessing relies on this module to rebuild the
+warehouse tables from the raw messages.  `ingest_batchfile` (and the
+`ingest_batchfiles` entry point defined in setup.py) loads whole batch
+files without Mirth, optionally recording `metrics.IngestMetrics` and
+profiling (see `profiling.BatchProfiler`).
+
+Values are returned as plain python values (None for empty) rather
+than the SQL quoted strings built up in the channel scripts.
+
+"""
+import argparse
+from datetime import datetime
+import getpass
+import logging
+import os
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from pheme.util.config import Config
+from pheme.warehouse.metrics import IngestMetrics
+from pheme.warehouse.normalized import normalized_mode
+from pheme.warehouse.normalized import TextDictionary
+from pheme.warehouse.profiling import BatchProfiler
+from pheme.warehouse.selection import chunked
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Nte_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7RawMessage_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
+
+
+class Segment(object):
+    """A single HL7 segment, with field and component access
+
+    Field numbering follows the HL7 (and Mirth) convention, i.e. the
+    first field after the segment name is field 1.  For MSH segments,
+    the field separator itself is MSH.1.
+
+    Only the first repetition of a field is considered, and
+    subcomponents are left intact (as Mirth does), so callers
+    needing subcomponents split on '&' themselves.
+
+    """
+    def __init__(self, text, field_separator='|', component_separator='^',
+                 repetition_separator='~'):
+        self.text = text
+        self.component_separator = component_separator
+        self.repetition_separator = repetition_separator
+        fields = text.split(field_separator)
+        self.name = fields[0]
+        if self.name == 'MSH':
+            fields.insert(1, field_separator)
+        self.fields = fields
+
+    def __repr__(self):
+        return '<Segment %s>' % self.name
+
+    def field(self, index):
+        """Returns the raw text of the (first repetition of the) field
+
+        Empty string is returned for undefined fields.
+
+        """
+        if index >= len(self.fields):
+            return ''
+        if self.name == 'MSH' and index in (1, 2):
+            return self.fields[index]
+        return self.fields[index].split(self.repetition_separator)[0]
+
+    def component(self, index, component=1):
+        """Returns the text of the requested field component
+
+        Empty string is returned for undefined components.
+
+        """
+        components = self.field(index).split(self.component_separator)
+        if component > len(components):
+            return ''
+        return components[component - 1]
+
+
+EMPTY_SEGMENT = Segment('')
+
+
+class Message(object):
+    """Parsed HL7 message, providing ordered segment access"""
+
+    def __init__(self, raw_data):
+        self.raw_data = raw_data
+        lines = [line for line in raw_data.replace('\r\n', '\r').
+                 replace('\n', '\r').split('\r') if line]
+        field_separator, encoding = '|', '^~\\&'
+        if lines and lines[0].startswith('MSH') and len(lines[0]) > 3:
+            field_separator = lines[0][3]
+            encoding = lines[0][4:].split(field_separator)[0]
+        self.segments = [Segment(line, field_separator,
+                                 encoding[0:1] or '^',
+                                 encoding[1:2] or '~')
+                         for line in lines]
+
+    def __repr__(self):
+        return '<Message %s>' % self.message_control_id
+
+    def segment(self, name):
+        """Returns the first segment of the given name
+
+        An empty segment is returned if not present, so chained
+        lookups safely evaluate to empty strings.
+
+        """
+        for segment in self.segments:
+            if segment.name == name:
+                return segment
+        return EMPTY_SEGMENT
+
+    def segments_named(self, name):
+        """Returns list of all segments of the given name, in order"""
+        return [s for s in self.segments if s.name == name]
+
+    def value(self, name, index, component=1):
+        """Shortcut for a component from the first named segment"""
+        return self.segment(name).component(index, component)
+
+    @property
+    def message_control_id(self):
+        return self.value('MSH', 10)
+
+    @property
+    def message_type(self):
+        """MSH.9.1 + MSH.9.3 as used in the channel filters"""
+        return self.value('MSH', 9, 1) + self.value('MSH', 9, 3)
+
+
+BATCH_SEGMENTS = ('FHS', 'BHS', 'BTS', 'FTS')
+
+
+def iter_messages(lines):
+    """Generate the raw messages found in a batch file
+
+    :param lines: iterable of segment lines, such as an open file
+      handle in universal newline mode
+
+    Batch header and trailer segments are dropped, and each message
+    is returned with segments joined by the HL7 segment terminator,
+    as the raw data is stored by Mirth.
+
+    """
+    segments = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line[:3] in BATCH_SEGMENTS:
+            continue
+        if line.startswith('MSH') and segments:
+            yield '\r'.join(segments)
+            segments = []
+        segments.append(line)
+    if segments:
+        yield '\r'.join(segments)
+
+
+def or_none(value):
+    """Mirrors the codetemplate `quoteOrNull` - empty becomes None"""
+    return value if value else None
+
+
+def datetime_for_sql(value):
+    """Mirrors the codetemplate `datetimeForSQL`
+
+    Given a yyyyMMddHHmm[ss] string - returns the datetime, or None
+    in any other case (logging an error if it looks wonky).
+
+    """
+    if not value:
+        return None
+    formats = {12: '%Y%m%d%H%M', 14: '%Y%m%d%H%M%S'}
+    try:
+        return datetime.strptime(value, formats[len(value)])
+    except (KeyError, ValueError):
+        logging.error("Unable to format datetime string %s", value)
+        return None
+
+
+def accept_message(message):
+    """Mirrors the PHEME_batchfile_consumer source filter
+
+    Requires a message control ID and a visit ID in PID-18.1.  The
+    duplicate check is left to the raw message unique constraint.
+
+    """
+    return bool(message.message_control_id and message.value('PID', 18))
+
+
+def msh_values(message, batch_filename):
+    """Mirrors the PHEME_batchfile_consumer source transformer"""
+    return {'message_control_id': message.message_control_id,
+            'message_type': '^'.join((message.value('MSH', 9, 1),
+                                      message.value('MSH', 9, 2),
+                                      message.value('MSH', 9, 3))),
+            'facility': message.value('MSH', 4, 2),
+            'message_datetime': datetime_for_sql(message.value('MSH', 7)),
+            'batch_filename': batch_filename}
+
+
+def _with_authority(id_value, *authorities):
+    """Append the retained portions of the assigning authority
+
+    Keeps subcomponents 2 and 3 of the assigning authority, taking
+    each from the first of the given authorities defining it, which
+    yields ids like `358798^^^&3768573961&NPI`.
+
+    """
+    parts = [id_value + '^^^']
+    authorities = [a.split('&') for a in authorities]
+    for index in (1, 2):
+        for authority in authorities:
+            if len(authority) > index:
+                parts.append(authority[index])
+                break
+    return '&'.join(parts)
+
+
+def visit_values(message):
+    """Mirrors the PHEME_hl7_visit_insert transformer steps
+
+    Returns None if the message lacks the visit or patient id
+    required for the hl7_visit row.
+
+    """
+    pid, pv1, pv2 = (message.segment('PID'), message.segment('PV1'),
+                     message.segment('PV2'))
+
+    # MBDS and MU send visit ID in differing locations.
+    # PID 18 only defined for MBDS ; MU defines PV1 19
+    visit_id = pid.component(18) or pv1.component(19)
+    patient_id = pid.component(3)
+    if not (visit_id and patient_id):
+        logging.error("missing visit or patient id on message control "
+                      "ID: %s", message.message_control_id)
+        return None
+
+    disposition = pv1.component(36)
+    if disposition and not (disposition.isdigit() and
+                            0 < int(disposition) < 100):
+        logging.error("Invalid disposition '%s' on message control "
+                      "ID: %s", disposition, message.message_control_id)
+        disposition = None
+
+    return {'visit_id': _with_authority(visit_id, pid.component(18, 4),
+                                        pv1.component(19, 4)),
+            'patient_id': _with_authority(patient_id, pid.component(3, 4)),
+            'zip': or_none(pid.component(11, 5)),
+            'country': or_none(pid.component(11, 6)),
+            'admit_datetime': datetime_for_sql(pv1.component(44)),
+            'gender': or_none(pid.component(8)),
+            'dob': or_none(pid.component(7)),
+            'chief_complaint': or_none(pv2.component(3, 2) or
+                                       pv2.component(3, 5)),
+            'patient_class': or_none(pv1.component(2)),
+            'disposition': or_none(disposition),
+            'county': or_none(pid.component(11, 9) or pid.component(12)),
+            'race': or_none(pid.component(22, 2) or pid.component(10, 2)),
+            'service_code': or_none(pv1.component(10)),
+            'service_alt_id': or_none(pv1.component(10, 4)),
+            'admission_source': or_none(pv1.component(14)),
+            'assigned_patient_location': or_none(pv1.component(3)),
+            'state': or_none(pid.component(11, 4)),
+            'discharge_datetime': datetime_for_sql(pv1.component(45)),
+            }
+
+
+def dx_values(message):
+    """Mirrors the PHEME_hl7_dx_insert channel - one dict per DG1"""
+    rows = []
+    for dg1 in message.segments_named('DG1'):
+        rank = dg1.component(1)
+        rows.append({'rank': int(rank) if rank.isdigit() else 0,
+                     'dx_code': dg1.component(3, 1),
+                     'dx_description': dg1.component(3, 2),
+                     'dx_type': dg1.component(6, 1)})
+    return rows
+
+
+def obx_values(obx):
+    """Values for a single OBX segment, as both OBX channels use"""
+    return {'value_type': or_none(obx.component(2)),
+            'observation_id': or_none(obx.component(3, 1)),
+            'observation_text': or_none(obx.component(3, 2)),
+            'observation_result': or_none(obx.field(5)),
+            'units': or_none(obx.component(6, 5) or obx.component(6, 2)),
+            'result_status': or_none(obx.component(11, 2)),
+            'observation_datetime': datetime_for_sql(obx.component(14)),
+            'performing_lab_code': or_none(obx.component(15, 4)),
+            'sequence': or_none(obx.component(4)),
+            'coding': or_none(obx.component(3, 3)),
+            'alt_id': or_none(obx.component(3, 4)),
+            'alt_text': or_none(obx.component(3, 5)),
+            'alt_coding': or_none(obx.component(3, 6)),
+            'reference_range': or_none(obx.component(7)),
+            'abnorm_id': or_none(obx.component(8, 1)),
+            'abnorm_text': or_none(obx.component(8, 2)),
+            'abnorm_coding': or_none(obx.component(8, 3)),
+            'alt_abnorm_id': or_none(obx.component(8, 4)),
+            'alt_abnorm_text': or_none(obx.component(8, 5)),
+            'alt_abnorm_coding': or_none(obx.component(8, 6)),
+            }
+
+
+def adt_obx_values(message):
+    """Mirrors the PHEME_hl7_obx_insert channel (ADT messages only)
+
+    Only the subset of columns written by that channel is returned.
+
+    """
+    if message.value('MSH', 9, 1) != 'ADT':
+        return []
+    columns = ('value_type', 'observation_id', 'observation_text',
+               'observation_result', 'units', 'result_status',
+               'observation_datetime', 'performing_lab_code')
+    rows = []
+    for obx in message.segments_named('OBX'):
+        values = obx_values(obx)
+        rows.append(dict((c, values[c]) for c in columns))
+    return rows
+
+
+def _obr_values(obr, message_control_id):
+    status = or_none(obr.component(25))
+    if status and len(status) > 1:
+        # Known problem from INHS - bad mapping 'IP' should have been 'I'
+        if status == 'IP':
+            status = 'I'
+        else:
+            logging.error("obr.status too long: %s on message control "
+                          "ID: %s", status, message_control_id)
+            status = None
+    specimen_source = obr.component(15).split('&')
+    return {'loinc_code': or_none(obr.component(4, 1)),
+            'loinc_text': or_none(obr.component(4, 2)),
+            'alt_text': or_none(obr.component(4, 5)),
+            'observation_datetime': datetime_for_sql(obr.component(7)),
+            'status': status,
+            'report_datetime': datetime_for_sql(obr.component(22)),
+            'specimen_source': or_none(specimen_source[3]) if
+            len(specimen_source) > 3 else None,
+            'filler_order_no': or_none(obr.component(3)),
+            'coding': or_none(obr.component(4, 3)),
+            'alt_code': or_none(obr.component(4, 4)),
+            'alt_coding': or_none(obr.component(4, 6)),
+            }
+
+
+def lab_groups(message):
+    """Mirrors the PHEME_hl7_obr_insert transformer
+
+    Only ORU^R01 and ORM^O01 messages produce lab groups.  Returns a
+    list of dicts, one per OBR segment, each with keys:
+
+      - 'obr': the hl7_obr values
+      - 'obxes': list of (hl7_obx values, list of OBX related notes)
+      - 'notes': list of OBR related hl7_nte values
+      - 'spms': list of hl7_spm values (only those with an id)
+
+    The segments are walked in order to maintain the OBR:OBX
+    association.  NTE segments belong to the preceding OBX or OBR.
+
+    """
+    if message.message_type not in ('ORUORU_R01', 'ORMORM_O01'):
+        return []
+    groups, group, notes = [], None, None
+    for segment in message.segments:
+        if segment.name == 'OBR':
+            notes = []
+            group = {'obr': _obr_values(segment,
+                                        message.message_control_id),
+                     'obxes': [], 'notes': notes, 'spms': []}
+            groups.append(group)
+        elif group is None:
+            continue
+        elif segment.name == 'OBX':
+            notes = []
+            group['obxes'].append((obx_values(segment), notes))
+        elif segment.name == 'NTE':
+            notes.append({'sequence_number': or_none(segment.component(1)),
+                          'note': or_none(segment.component(3))})
+        elif segment.name == 'SPM' and segment.component(4, 1):
+            group['spms'].append({'id': segment.component(4, 1),
+                                  'description':
+                                  or_none(segment.component(4, 2)),
+                                  'code': or_none(segment.component(4, 4))})
+    return groups
+
+
+class MessageWriter(object):
+    """Writes the warehouse rows derived from HL7 messages
+
+    Uses the given connection (and whatever transaction the caller
+    has open on it) for all writes.
+
+    :param dictionary: a `normalized.TextDictionary` when the
+      warehouse is in normalized mode; rows are then written directly
+      to the store tables
+    :param metrics: optional `metrics.IngestMetrics`, to record insert
+      times and row counts per table
+
+    """
+    def __init__(self, connection, dictionary=None, metrics=None):
+        self.connection = connection
+        self.dictionary = dictionary
+        self.metrics = metrics
+
+    def next_id(self, table):
+        """Obtain the next primary key value from the table sequence"""
+        pk = list(table.primary_key.columns)[0]
+        return self.connection.execute(
+            "SELECT nextval('%s_%s_seq')" % (table.name, pk.name)).scalar()
+
+    def insert(self, table, rows):
+        if rows:
+            name = table.name
+            start = time.time()
+            if self.dictionary:
+                table, rows = self.dictionary.encode(table, rows)
+            self.connection.execute(table.insert(), rows)
+            if self.metrics:
+                self.metrics.insert_seconds.observe(time.time() - start,
+                                                    (name,))
+                self.metrics.rows.inc(len(rows), (name,))
+
+    def write_msh(self, message, hl7_msh_id, batch_filename):
+        values = msh_values(message, batch_filename)
+        values['hl7_msh_id'] = hl7_msh_id
+        self.insert(hl7Msh_table, [values])
+
+    def update_msh(self, message, hl7_msh_id):
+        """Refresh the hl7_msh row, retaining the batch_filename"""
+        values = msh_values(message, None)
+        del values['batch_filename']
+        self.connection.execute(hl7Msh_table.update().where(
+            hl7Msh_table.c.hl7_msh_id == hl7_msh_id).values(**values))
+
+    def write_visit(self, message, hl7_msh_id):
+        values = visit_values(message)
+        if values:
+            values['hl7_msh_id'] = hl7_msh_id
+            self.insert(hl7Visit_table, [values])
+
+    def write_dx(self, message, hl7_msh_id):
+        rows = dx_values(message)
+        for row in rows:
+            row['hl7_msh_id'] = hl7_msh_id
+        self.insert(hl7Dx_table, rows)
+
+    def write_labs(self, message, hl7_msh_id):
+        for group in lab_groups(message):
+            obr = dict(group['obr'], hl7_msh_id=hl7_msh_id,
+                       hl7_obr_id=self.next_id(hl7Obr_table))
+            self.insert(hl7Obr_table, [obr])
+            notes = [dict(n, hl7_obr_id=obr['hl7_obr_id'])
+                     for n in group['notes']]
+            for values, obx_notes in group['obxes']:
+                obx = dict(values, hl7_msh_id=hl7_msh_id,
+                           hl7_obr_id=obr['hl7_obr_id'],
+                           hl7_obx_id=self.next_id(hl7Obx_table))
+                self.insert(hl7Obx_table, [obx])
+                notes.extend(dict(n, hl7_obx_id=obx['hl7_obx_id'])
+                             for n in obx_notes)
+            self.insert(hl7Nte_table, notes)
+            self.insert(hl7Spm_table, [dict(s, hl7_obr_id=obr['hl7_obr_id'])
+                                       for s in group['spms']])
+
+    def write_adt_obx(self, message, hl7_msh_id):
+        rows = adt_obx_values(message)
+        for row in rows:
+            row['hl7_msh_id'] = hl7_msh_id
+        self.insert(hl7Obx_table, rows)
+
+    def write_derived(self, message, hl7_msh_id):
+        """Write all rows hanging off the message's hl7_msh row"""
+        self.write_visit(message, hl7_msh_id)
+        self.write_dx(message, hl7_msh_id)
+        self.write_labs(message, hl7_msh_id)
+        self.write_adt_obx(message, hl7_msh_id)
+
+
+def ingest_batchfile(connection, path, dictionary=None, chunk_size=500,
+                     metrics=None):
+    """Mirrors the PHEME_batchfile_consumer channel, in process
+
+    Stores the raw message, hl7_msh row and all derived rows for each
+    accepted message in the batch file.  As with the channel, messages
+    whose message_control_id is already stored (or repeated within the
+    file) are skipped.  Each chunk of messages is written in its own
+    transaction, each message within a savepoint: a message failing to
+    store, say violating a constraint, is logged and rolled back alone,
+    as the channels do, and counted with the 'failed' outcome.
+
+    :param connection: warehouse connection, with INSERT permission
+    :param path: path to the HL7 batch file
+    :param dictionary: a `normalized.TextDictionary` in normalized mode
+    :param chunk_size: number of messages per transaction
+    :param metrics: optional `metrics.IngestMetrics` to record into
+
+    Returns tuple (messages read, messages stored)
+
+    """
+    def observe(stage, start):
+        if metrics:
+            metrics.stage_seconds.observe(time.time() - start, (stage,))
+
+    def count(outcome, amount=1):
+        if metrics:
+            metrics.messages.inc(amount, (outcome,))
+
+    batch_filename = os.path.basename(path)
+    raw = hl7RawMessage_table.c
+    writer = MessageWriter(connection, dictionary, metrics)
+
+    def store_message(message):
+        start = time.time()
+        writer.insert(hl7RawMessage_table, [{
+            'message_control_id': message.message_control_id,
+            'raw_data': message.raw_data,
+            'import_time': str(int(time.time() * 1000))}])
+        observe('raw_insert', start)
+        start = time.time()
+        hl7_msh_id = writer.next_id(hl7Msh_table)
+        writer.write_msh(message, hl7_msh_id, batch_filename)
+        observe('msh_insert', start)
+        start = time.time()
+        writer.write_derived(message, hl7_msh_id)
+        observe('derived', start)
+
+    read = stored = 0
+    seen = set()
+    with open(path, 'rU') as batchfile:
+        for chunk in chunked(iter_messages(batchfile), chunk_size):
+            read += len(chunk)
+            messages = []
+            for raw_data in chunk:
+                start = time.time()
+                message = Message(raw_data)
+                if accept_message(message):
+                    messages.append(message)
+                observe('parse', start)
+            count('rejected', len(chunk) - len(messages))
+
+            start = time.time()
+            control_ids = [m.message_control_id for m in messages]
+            if control_ids:
+                seen.update(row[0] for row in connection.execute(select(
+                    [raw.message_control_id],
+                    raw.message_control_id.in_(control_ids))))
+            observe('duplicate_check', start)
+
+            transaction = connection.begin()
+            try:
+                for message in messages:
+                    if message.message_control_id in seen:
+                        logging.debug("Skipping duplicate "
+                                      "message_control_id %s",
+                                      message.message_control_id)
+                        count('duplicate')
+                        continue
+                    savepoint = connection.begin_nested()
+                    try:
+                        store_message(message)
+                        savepoint.commit()
+                    except SQLAlchemyError as e:
+                        savepoint.rollback()
+                        logging.error("Failed to store message control "
+                                      "id %s: %s",
+                                      message.message_control_id, e)
+                        count('failed')
+                        continue
+                    seen.add(message.message_control_id)
+                    count('stored')
+                    stored += 1
+                start = time.time()
+                transaction.commit()
+                observe('commit', start)
+            except:
+                transaction.rollback()
+                raise
+    return read, stored
+
+
+def ingest_batchfiles():
+    """Entry point to load HL7 batch files without Mirth"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="load HL7 batch files into "
+                                 "the warehouse in process, as the Mirth "
+                                 "channels would")
+    ap.add_argument("batchfiles", nargs='+', help="batch files to load")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'database_user'),
+                    help="database user with INSERT permission "
+                    "(overrides [warehouse]database_user)")
+    ap.add_argument("--chunk_size", type=int, default=500,
+                    help="number of messages per transaction")
+    ap.add_argument("--metrics_port", type=int,
+                    help="serve ingest metrics on this local port")
+    ap.add_argument("--metrics_file",
+                    help="rewrite this Prometheus text file with the "
+                    "ingest metrics after each batch file")
+    args = ap.parse_args()
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    engine = create_engine(engine_url(args.user, password, args.db))
+    dictionary = TextDictionary(engine) if normalized_mode() else None
+
+    metrics = IngestMetrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    profiler = BatchProfiler.from_config(config)
+    profiler.install_signal_handler()
+    connection = engine.connect()
+    try:
+        for index, path in enumerate(args.batchfiles):
+            metrics.queue_depth.set(len(args.batchfiles) - index - 1)
+            metrics.files_in_flight.inc()
+            start = time.time()
+            try:
+                with profiler.profile(path) as profile_path:
+                    read, stored = ingest_batchfile(
+                        connection, path, dictionary, args.chunk_size,
+                        metrics)
+            finally:
+                metrics.files_in_flight.dec()
+            metrics.files.inc()
+            if args.metrics_file:
+                metrics.write_textfile(args.metrics_file)
+            print "%s: stored %d of %d messages in %.1f seconds" % (
+                path, stored, read, time.time() - start)
+            if profile_path:
+                print "profile written to", profile_path
+    finally:
+        connection.close()
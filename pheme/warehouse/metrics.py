@@ -0,0 +1,225 @@
+"""Ingest instrumentation, exported in the Prometheus text format
+
+`IngestMetrics` collects per stage and per table timing histograms,
+message and row counters, plus the queue depth (batch files waiting)
+and files in flight of a native ingest (see
+`pheme.warehouse.ingest.ingest_batchfiles`).  Recording is a couple
+of clock reads and dictionary updates per observation, cheap enough
+to leave enabled.
+
+Metrics are exposed either by rewriting a file (for the node_exporter
+textfile collector) with `write_textfile`, or on a local HTTP
+endpoint with `serve`.
+
+"""
+import BaseHTTPServer
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+
+
+# Upper bounds in seconds, suited to per message and per insert times
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values))
+
+
+class Metric(object):
+    """Base for the metric types
+
+    Values are kept per tuple of label values, given as the `labels`
+    argument when recording, in the order of the label names.
+
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Generate (name suffix, label names, label values, value)"""
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield '', self.labels, label_values, value
+
+    def render(self):
+        """Returns the metric in the Prometheus text format"""
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %r' % (self.name, suffix,
+                                        _label_text(names, values),
+                                        float(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    """Cumulative histogram of observed values
+
+    :param buckets: ascending upper bounds, +Inf is implied
+
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = \
+                    [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """Observe the duration of the with block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), count, total))
+                            for labels, (counts, count, total)
+                            in self._values.items())
+        for label_values, (counts, count, total) in values:
+            names = self.labels + ('le',)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', names, label_values + (repr(bound),), \
+                    cumulative
+            yield '_bucket', names, label_values + ('+Inf',), count
+            yield '_sum', self.labels, label_values, total
+            yield '_count', self.labels, label_values, count
+
+
+class IngestMetrics(object):
+    """The metrics recorded during native ingest
+
+    Stages timed per message are 'parse', 'raw_insert', 'msh_insert'
+    and 'derived' (all hl7_visit, hl7_dx, hl7_obr, hl7_obx, hl7_nte
+    and hl7_spm writes, broken down by the per table insert times);
+    'duplicate_check' and 'commit' are timed per chunk of messages.
+
+    """
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            'pheme_ingest_stage_seconds',
+            'Time spent in each ingest stage', ('stage',))
+        self.insert_seconds = Histogram(
+            'pheme_ingest_insert_seconds',
+            'Time spent per insert statement, by target table', ('table',))
+        self.rows = Counter('pheme_ingest_rows_total',
+                            'Rows inserted, by target table', ('table',))
+        self.messages = Counter(
+            'pheme_ingest_messages_total',
+            'Messages read, by outcome (stored, duplicate, rejected, '
+            'failed)',
+            ('outcome',))
+        self.files = Counter('pheme_ingest_files_total',
+                             'Batch files completed')
+        self.queue_depth = Gauge('pheme_ingest_queue_depth',
+                                 'Batch files waiting to be ingested')
+        self.files_in_flight = Gauge('pheme_ingest_files_in_flight',
+                                     'Batch files being ingested')
+        self.metrics = (self.stage_seconds, self.insert_seconds, self.rows,
+                        self.messages, self.files, self.queue_depth,
+                        self.files_in_flight)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format"""
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically replace path with the current metrics"""
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory,
+                                             prefix='.metrics')
+        try:
+            with os.fdopen(handle, 'w') as output:
+                output.write(self.render())
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics at http://host:port/metrics
+
+        Runs in a daemon thread; returns the HTTP server, call its
+        `shutdown` method to stop.
+
+        """
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
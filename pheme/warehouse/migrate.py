@@ -0,0 +1,326 @@
+"""Online, additive migration of the warehouse schema
+
+`create_tables` drops and recreates every table, requiring a full
+reload for any schema change.  This module instead compares the live
+database against the tables declared in `pheme.warehouse.tables` and
+applies only the additive differences, without rewriting existing
+tables:
+
+- missing tables are created (with their indexes and sequences) and
+  the [warehouse]database_user granted access
+- missing nullable columns are added, which PostgreSQL handles as a
+  catalog only change.  Trigger maintained columns (hash keys and
+  fingerprints) are then computed for existing rows, in chunks; the
+  triggers are (re)installed and missing values computed on every
+  run, even when no schema change is due.
+- in normalized mode, the views over the `<table>_store` tables (and
+  their INSTEAD OF trigger functions) are replaced when lacking
+  columns added to the store, see `pheme.warehouse.normalized`
+- missing indexes are built with CREATE INDEX CONCURRENTLY, so
+  writers are not blocked while large tables are indexed.  Invalid
+  indexes left behind by an interrupted concurrent build are dropped
+  and rebuilt.
+
+Changes that would require a table rewrite or a data backfill (NOT
+NULL columns, server defaults, type changes) are reported for manual
+handling, never applied.  Nothing is ever dropped.
+
+Project setup.py defines the `migrate_warehouse` entry point.
+
+"""
+import argparse
+import getpass
+
+from sqlalchemy import create_engine
+from sqlalchemy import FetchedValue
+from sqlalchemy import text
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.types import NullType
+
+from pheme.util.config import Config
+from pheme.warehouse.normalized import normalized_metadata
+from pheme.warehouse.normalized import normalized_mode
+from pheme.warehouse.normalized import normalized_views
+from pheme.warehouse.normalized import TEXT_TABLE
+from pheme.warehouse.normalized import trigger_ddl
+from pheme.warehouse.normalized import view_ddl
+from pheme.warehouse.tables import backfill_fingerprints
+from pheme.warehouse.tables import backfill_keys
+from pheme.warehouse.tables import create_fingerprint_triggers
+from pheme.warehouse.tables import create_key_triggers
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import grant_privileges
+from pheme.warehouse.tables import metadata
+
+
+class CreateTableStep(object):
+    """Create a missing table, its indexes and grant access"""
+    def __init__(self, table):
+        self.table = table
+
+    def __str__(self):
+        return "create table %s" % self.table.name
+
+    def statements(self, dialect):
+        statements = [unicode(CreateTable(self.table).compile(
+            dialect=dialect)).strip()]
+        for index in self.table.indexes:
+            statements.append(unicode(CreateIndex(index).compile(
+                dialect=dialect)))
+        return statements
+
+    def apply(self, engine, user):
+        self.table.create(bind=engine)
+        grant_privileges(engine, user, [self.table])
+
+
+class AddColumnStep(object):
+    """Add a missing nullable column to an existing table"""
+    def __init__(self, column):
+        self.column = column
+
+    def __str__(self):
+        return "add column %s.%s" % (self.column.table.name,
+                                     self.column.name)
+
+    def statements(self, dialect):
+        column = self.column
+        type_ = column.type
+        if isinstance(type_, NullType) and column.foreign_keys:
+            # Type of a ForeignKey column is that of its target
+            type_ = list(column.foreign_keys)[0].column.type
+        statement = "ALTER TABLE %s ADD COLUMN %s %s" % (
+            column.table.name, column.name, type_.compile(dialect=dialect))
+        for foreign_key in column.foreign_keys:
+            statement += " REFERENCES %s (%s)" % (
+                foreign_key.column.table.name, foreign_key.column.name)
+            if foreign_key.ondelete:
+                statement += " ON DELETE %s" % foreign_key.ondelete
+        return [statement]
+
+    def apply(self, engine, user):
+        for statement in self.statements(engine.dialect):
+            engine.execute(statement)
+
+
+class ReplaceViewStep(object):
+    """Present a normalized table's store columns through its view
+
+    Replaces the view and its INSTEAD OF trigger function, so reads
+    and the channels' writes cover columns added to the store table.
+    CREATE OR REPLACE keeps the view's grants and trigger, but may
+    only append columns; see `plan_migration`.
+
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def __str__(self):
+        return "replace view %s" % self.table.name
+
+    def statements(self, dialect):
+        return [view_ddl(self.table, replace=True),
+                trigger_ddl(self.table)[0]]
+
+    def apply(self, engine, user):
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            for statement in self.statements(engine.dialect):
+                connection.execute(text(statement))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+class CreateIndexStep(object):
+    """Build a missing (or invalid) index without blocking writes"""
+    def __init__(self, index, invalid=False):
+        self.index = index
+        self.invalid = invalid
+
+    def __str__(self):
+        if self.invalid:
+            return "rebuild invalid index %s" % self.index.name
+        return "create index %s" % self.index.name
+
+    def statements(self, dialect):
+        index = self.index
+        statements = []
+        if self.invalid:
+            statements.append("DROP INDEX CONCURRENTLY IF EXISTS %s" %
+                              index.name)
+        statements.append("CREATE %sINDEX CONCURRENTLY %s ON %s (%s)" % (
+            'UNIQUE ' if index.unique else '', index.name,
+            index.table.name,
+            ', '.join(column.name for column in index.columns)))
+        return statements
+
+    def apply(self, engine, user):
+        # CONCURRENTLY can't run within a transaction block.  The
+        # connection returns to the pool, so restore its isolation level
+        connection = engine.raw_connection()
+        isolation_level = connection.isolation_level
+        try:
+            connection.set_isolation_level(0)  # autocommit
+            cursor = connection.cursor()
+            for statement in self.statements(engine.dialect):
+                cursor.execute(statement)
+            cursor.close()
+        finally:
+            connection.set_isolation_level(isolation_level)
+            connection.close()
+
+
+def invalid_indexes(engine):
+    """Returns set of index names left invalid by failed builds"""
+    return set(row[0] for row in engine.execute(
+        """SELECT c.relname FROM pg_index i
+           JOIN pg_class c ON c.oid = i.indexrelid
+           WHERE NOT i.indisvalid"""))
+
+
+def plan_migration(engine, metadata=metadata):
+    """Compare the live schema with the declared metadata
+
+    Returns tuple (steps, manual).  Steps are the additive changes
+    safe to apply online, in dependency order; manual is a list of
+    differences found that require a table rewrite or backfill, and
+    must be handled by hand.
+
+    """
+    inspector = Inspector.from_engine(engine)
+    existing = set(inspector.get_table_names())
+    invalid = invalid_indexes(engine)
+    steps, manual = [], []
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            steps.append(CreateTableStep(table))
+            continue
+
+        live_columns = dict((column['name'], column) for column in
+                            inspector.get_columns(table.name))
+        for column in table.columns:
+            live = live_columns.get(column.name)
+            if live is None:
+                if column.nullable and (
+                        column.server_default is None or
+                        type(column.server_default) is FetchedValue):
+                    steps.append(AddColumnStep(column))
+                else:
+                    manual.append("add column %s.%s: NOT NULL or server "
+                                  "default requires a backfill" %
+                                  (table.name, column.name))
+            elif live['nullable'] != column.nullable and \
+                    not column.primary_key:
+                manual.append("column %s.%s: nullable is %s, declared %s" %
+                              (table.name, column.name, live['nullable'],
+                               column.nullable))
+
+        live_indexes = set(index['name'] for index in
+                           inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in invalid:
+                steps.append(CreateIndexStep(index, invalid=True))
+            elif index.name not in live_indexes:
+                steps.append(CreateIndexStep(index))
+
+    if TEXT_TABLE in metadata.tables:
+        # normalized mode, the views must present all store columns
+        views = set(inspector.get_view_names())
+        for table in normalized_views():
+            name = table.name
+            if name not in views:
+                manual.append("view %s: missing, see create_normalized" %
+                              name)
+                continue
+            live = [column['name'] for column in
+                    inspector.get_columns(name)]
+            declared = [column.name for column in table.columns]
+            if live == declared:
+                continue
+            if declared[:len(live)] == live:
+                steps.append(ReplaceViewStep(table))
+            else:
+                manual.append("view %s: columns %s, declared %s" % (
+                    name, ', '.join(live), ', '.join(declared)))
+    return steps, manual
+
+
+def migrate(engine, user, steps):
+    """Apply the planned steps, generating each step once complete
+
+    :param engine: engine connected as the table owner
+    :param user: database user to grant access on new tables
+
+    """
+    for step in steps:
+        step.apply(engine, user)
+        yield step
+
+
+def migrate_warehouse():
+    """Entry point to bring the warehouse schema up to date in place"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="apply additive changes "
+                                 "(tables, nullable columns and indexes) "
+                                 "to the warehouse schema without "
+                                 "dropping any data")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'create_table_user'),
+                    help="database user owning the tables "
+                    "(overrides [warehouse]create_table_user)")
+    ap.add_argument("-n", "--dry_run", action='store_true',
+                    help="report the planned statements without "
+                    "applying any")
+    args = ap.parse_args()
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    engine = create_engine(engine_url(args.user, password, args.db))
+
+    if normalized_mode(config):
+        steps, manual = plan_migration(engine, normalized_metadata())
+    else:
+        steps, manual = plan_migration(engine)
+    for difference in manual:
+        print "manual migration required:", difference
+    if args.dry_run:
+        if not steps:
+            print "schema is up to date"
+        for step in steps:
+            print "%s:" % step
+            for statement in step.statements(engine.dialect):
+                print "  %s;" % statement
+        return
+
+    if steps:
+        database_user = config.get('warehouse', 'database_user')
+        for step in migrate(engine, database_user, steps):
+            print "done:", step
+    else:
+        print "schema is up to date"
+
+    # The hash keys and fingerprints are trigger maintained, and
+    # existing rows need them computed.  Both steps are idempotent, so
+    # run regardless, repairing a database missing its triggers
+    create_key_triggers(engine)
+    create_fingerprint_triggers(engine, normalized_mode(config))
+    backfilled = 0
+    for count in backfill_keys(engine):
+        backfilled += count
+        print "computed hash keys for %d hl7_visit rows" % backfilled
+    backfilled = {}
+    for table, count in backfill_fingerprints(engine):
+        backfilled[table] = backfilled.get(table, 0) + count
+        print "computed fingerprints for %d %s rows" % (backfilled[table],
+                                                        table)
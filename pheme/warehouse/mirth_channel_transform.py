@@ -1,9 +1,23 @@
 #!/usr/bin/env python
+import copy
+import hashlib
+import json
 from lxml import etree
 import os
+import re
 import sys
 
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import NullType
+from sqlalchemy.types import String
+
 from pheme.util.config import Config
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Nte_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
 
 
 def transformer_factory(tree, options):
@@ -20,13 +34,43 @@ def transformer_factory(tree, options):
     channel_name = tree.xpath("/channel/name")
     if channel_name[0].text == 'PHEME_http_receiver':
         return PHEME_http_receiverTransferAgent(tree, options)
+    if getattr(options, 'batched_inserts', False):
+        return BatchedInsertTransferAgent(tree, options)
     return CommonTransferAgent(tree, options)
 
 
+# globalChannelMap key of the connection shared by a channel's scripts
+POOLED_CONNECTION = 'pheme_dbConn'
+
+# Replaces the per message createDatabaseConnection() call, reconnecting
+# should the shared connection have been closed
+POOLED_CALL = """(function () {
+    var conn = globalChannelMap.get('%(key)s');
+    if (conn == null || conn.getConnection().isClosed()) {
+        conn = %(call)s;
+        globalChannelMap.put('%(key)s', conn);
+    }
+    return conn;
+})()"""
+
+DEPLOY_POOLED = """// open the connection shared by all messages, see shutdownScript
+globalChannelMap.put('%(key)s', %(call)s);
+"""
+
+SHUTDOWN_POOLED = """// close the connection opened by the deployScript
+var conn = globalChannelMap.get('%(key)s');
+if (conn != null) {
+    conn.close();
+    globalChannelMap.remove('%(key)s');
+}
+"""
+
+
 class CommonTransferAgent(object):
     def __init__(self, channel, options):
         self.tree = channel
         self.options = options
+        self.connection_call = None
 
     def transform(self):
         """Perform the transformation"""
@@ -49,9 +93,15 @@ class CommonTransferAgent(object):
             "/channel/destinationConnectors/connector/properties")
         map(self._adjust_destination, destinations)
 
+        if self.connection_call:
+            self._adjust_lifecycle_scripts()
+
         # Return the transformed channel
         return self.tree
 
+    def _pooled(self):
+        return getattr(self.options, 'pooled_connections', False)
+
     def _adjust_source_connector(self, srcProps):
         #the same source_connector element is used for all types
         #don't break other connector types (i.e. by writing path information
@@ -157,7 +207,52 @@ class CommonTransferAgent(object):
         params[3] = "'" + self.options.password + "'"
 
         # Reassemble the pieces
-        return text[:paramsStart+1] + ",".join(params) + text[paramsEnd:]
+        text = text[:paramsStart+1] + ",".join(params) + text[paramsEnd:]
+        if self._pooled():
+            text = self._pool_createDbCall(text)
+        return text
+
+    def _pool_createDbCall(self, text):
+        """Rewrite db connection in javascript snippet to a shared one
+
+        Replaces the (adjusted) createDatabaseConnection() call with
+        one fetching the channel's connection from globalChannelMap,
+        opened by the deployScript, and drops the per message close()
+        of the variable it was assigned to.
+
+        returns adjusted text
+
+        """
+        callStart = text.find(
+            "DatabaseConnectionFactory.createDatabaseConnection")
+        if callStart < 0:
+            raise RuntimeError("Only calls to 'DatabaseConnectionFactory."
+                               "createDatabaseConnection()' supported.")
+        callEnd = text.index(")", callStart) + 1
+        call = text[callStart:callEnd]
+        if self.connection_call not in (None, call):
+            raise RuntimeError("Differing 'createDatabaseConnection()' "
+                               "calls in one channel not supported.")
+        self.connection_call = call
+
+        pooled = POOLED_CALL % {'key': POOLED_CONNECTION, 'call': call}
+        assigned = re.search(r"var\s+(\w+)\s*=\s*$", text[:callStart])
+        text = text[:callStart] + pooled + text[callEnd:]
+        if assigned:
+            name = assigned.group(1)
+            text = re.sub(r"\b%s\.close\(\);?" % name,
+                          "// %s stays open, see shutdownScript" % name,
+                          text)
+        return text
+
+    def _adjust_lifecycle_scripts(self):
+        """Open the shared connection on deploy, close on shutdown"""
+        values = {'key': POOLED_CONNECTION, 'call': self.connection_call}
+        for path, script in (("/channel/deployScript", DEPLOY_POOLED),
+                             ("/channel/shutdownScript", SHUTDOWN_POOLED)):
+            elements = self.tree.xpath(path)
+            assert(len(elements) == 1)
+            elements[0].text = script % values + (elements[0].text or '')
 
 
 class PHEME_http_receiverTransferAgent(CommonTransferAgent):
@@ -174,6 +269,482 @@ class PHEME_http_receiverTransferAgent(CommonTransferAgent):
                 prop.text = self.options.input_dir
 
 
+
+# Largest number of bind parameters in one statement
+MAX_PARAMS = 32767
+
+BATCH_PRELUDE = """// Multi-row parameterized inserts, generated by transform_channels
+// --batched_inserts in place of the string built, per row statements
+
+function sqlValue(literal) {
+    // Returns the value PostgreSQL reads from the SQL literal (as
+    // built by quoteOrNull, or unquoted numbers), null for NULL.
+    // quoteOrNull doubles both quotes and backslashes, the latter
+    // read back as one with standard_conforming_strings off
+    if (literal == null) {
+        return null
+    }
+    var value = String(literal)
+    if (value.length > 1 && value.charAt(0) == "'" &&
+            value.charAt(value.length - 1) == "'") {
+        return value.substring(1, value.length - 1).replace(
+            /\\\\\\\\|''/g, function (pair) { return pair.charAt(1) })
+    }
+    if (value == '' || value == 'null' || value == 'NaN') {
+        return null
+    }
+    return value
+}
+
+function InsertBatch(table, columns, placeholders) {
+    this.table = table
+    this.columns = columns
+    this.placeholders = placeholders
+    this.rows = new Array()
+}
+
+InsertBatch.prototype.add = function (literals) {
+    this.rows.push(literals)
+}
+
+InsertBatch.prototype.execute = function (dbConn) {
+    // A single statement for all rows, within the bind parameter limit
+    var perStatement = Math.floor(%(max_params)d / this.columns.length)
+    for (var start = 0; start < this.rows.length; start += perStatement) {
+        var rows = this.rows.slice(start, start + perStatement)
+        var values = new Array()
+        var params = new java.util.ArrayList()
+        for (var i = 0; i < rows.length; i++) {
+            values.push(this.placeholders)
+            for (var j = 0; j < rows[i].length; j++) {
+                params.add(sqlValue(rows[i][j]))
+            }
+        }
+        dbConn.executeUpdate("INSERT INTO " + this.table + " (" +
+            this.columns.join(", ") + ") VALUES " + values.join(", "),
+            params)
+    }
+}
+
+function nextIds(dbConn, sequence, count) {
+    // Returns count values of the sequence, in a single round trip
+    var ids = new Array()
+    if (count > 0) {
+        var result = dbConn.executeCachedQuery("SELECT nextval('" +
+            sequence + "') FROM generate_series(1, " + count + ")")
+        while (result.next()) {
+            ids.push(result.getInt(1))
+        }
+    }
+    return ids
+}
+
+"""
+
+BATCH_EXECUTE = """
+var dbConn = %(call)s;
+try {
+    dbConn.getConnection().setAutoCommit(false)
+%(body)s
+    dbConn.getConnection().commit()
+} catch (e) {
+    logger.error("Exception caught on %(table)s insert")
+    logger.error("message_control_id: " + $('message_control_id'))
+    logger.error(e)
+    logger.error("Executing ROLLBACK...")
+    dbConn.getConnection().rollback()
+} finally {
+    dbConn.getConnection().setAutoCommit(true)
+    dbConn.close();
+}"""
+
+VISIT_BODY = """%(visit)s
+    visits.add([parseInt(channelMap.get("hl7_msh_id")),
+        channelMap.get("visit_id"), channelMap.get("patient_id"),
+        channelMap.get("zipcode"), channelMap.get("countrycode"),
+        channelMap.get("admit_datetime"), channelMap.get("patient_gender"),
+        channelMap.get("patient_dob"), channelMap.get("chief_complaint"),
+        channelMap.get("patient_class"),
+        channelMap.get("discharge_disposition"), channelMap.get("county"),
+        channelMap.get("race_ethnicity"), channelMap.get("service_code"),
+        channelMap.get("service_alt_id"), channelMap.get("admission_source"),
+        channelMap.get("assigned_patient_location"), channelMap.get("state"),
+        channelMap.get("discharge_datetime")])
+    visits.execute(dbConn)"""
+
+DX_BODY = """%(dx)s
+    for (var i = 0; i < $('dg1Array').length(); i++) {
+        var dg1 = $('dg1Array')[i]
+        var dx_description = dg1['DG1.3']['DG1.3.2'].toString()
+        dx_description = dx_description.replace(/'/g, "''")
+        dx_description = dx_description.replace(/\\\\/g, "\\\\\\\\")
+        dxs.add([dg1['DG1.1']['DG1.1.1'], "'" + dg1['DG1.3']['DG1.3.1'] + "'",
+            "'" + dx_description + "'", "'" + dg1['DG1.6']['DG1.6.1'] + "'",
+            parseInt(channelMap.get("hl7_msh_id"))])
+    }
+    dxs.execute(dbConn)"""
+
+OBX_BODY = """%(obx)s
+    for (var i = 0; i < $('obxArray').length(); i++) {
+        var obx = $('obxArray')[i]
+        var units
+        if (obx['OBX.6']['OBX.6.5'].toString().length > 0) {
+            units = quoteOrNull(obx['OBX.6']['OBX.6.5'].toString())
+        } else {
+            units = quoteOrNull(obx['OBX.6']['OBX.6.2'].toString())
+        }
+        obxs.add([parseInt(channelMap.get("hl7_msh_id")),
+            quoteOrNull(obx['OBX.2']['OBX.2.1'].toString()),
+            quoteOrNull(obx['OBX.3']['OBX.3.1'].toString()),
+            quoteOrNull(obx['OBX.3']['OBX.3.2'].toString()),
+            quoteOrNull(obx['OBX.5'].toString()), units,
+            quoteOrNull(obx['OBX.11']['OBX.11.2'].toString()),
+            quoteOrNull(datetimeForSQL(obx['OBX.14']['OBX.14.1'].toString())),
+            quoteOrNull(obx['OBX.15']['OBX.15.4'].toString())])
+    }
+    obxs.execute(dbConn)"""
+
+OBR_BODY = """%(obr)s
+%(obx)s
+%(obx_nte)s
+%(obr_nte)s
+%(spm)s
+    var hl7_msh_id = parseInt(channelMap.get("hl7_msh_id"))
+    var labArray = $('labArray')
+    var obxCount = 0
+    for (var i = 0; i < labArray.length; i++) {
+        obxCount += labArray[i].obxArray.length
+    }
+    var obrIds = nextIds(dbConn, 'hl7_obr_hl7_obr_id_seq', labArray.length)
+    var obxIds = nextIds(dbConn, 'hl7_obx_hl7_obx_id_seq', obxCount)
+
+    var o = 0
+    for (var i = 0; i < labArray.length; i++) {
+        var group = labArray[i]
+        var next_id = obrIds[i]
+        obrs.add([next_id, group.obr.loinc_code, group.obr.loinc_text,
+            group.obr.alt_text, group.obr.observation_datetime,
+            group.obr.status, group.obr.report_datetime,
+            group.obr.specimen_source, hl7_msh_id, group.obr.filler_order_no,
+            group.obr.coding, group.obr.alt_code, group.obr.alt_coding])
+
+        for (var j = 0; j < group.obxArray.length; j++) {
+            var obx = group.obxArray[j]
+            var next_obx_id = obxIds[o++]
+            obxs.add([next_obx_id, next_id, obx.value_type,
+                obx.observation_id, obx.observation_text,
+                obx.observation_result, obx.units, obx.result_status,
+                obx.observation_datetime, obx.performing_lab_code,
+                obx.coding, obx.alt_id, obx.alt_text, obx.alt_coding,
+                obx.reference_range, obx.abnorm_id, obx.abnorm_text,
+                obx.abnorm_coding, obx.alt_abnorm_id, obx.alt_abnorm_text,
+                obx.alt_abnorm_coding, obx.sequence, hl7_msh_id])
+            for (var n = 0; n < obx.nteArray.length; n++) {
+                var nte = obx.nteArray[n]
+                obxNotes.add([nte.sequence, nte.note, next_obx_id])
+            }
+        }
+
+        for (var n = 0; n < group.nteArray.length; n++) {
+            var nte = group.nteArray[n]
+            obrNotes.add([nte.sequence, nte.note, next_id])
+        }
+
+        for (var k = 0; k < group.spmArray.length; k++) {
+            var spm = group.spmArray[k]
+            spms.add([next_id, spm.id, spm.code, spm.description])
+        }
+    }
+    obrs.execute(dbConn)
+    obxs.execute(dbConn)
+    obxNotes.execute(dbConn)
+    obrNotes.execute(dbConn)
+    spms.execute(dbConn)"""
+
+
+def placeholder(column):
+    """Returns the bind parameter for column, cast unless a string
+
+    Parameters are bound as strings, so other types require a cast.
+
+    """
+    column_type = column.type
+    if isinstance(column_type, NullType) and column.foreign_keys:
+        column_type = list(column.foreign_keys)[0].column.type
+    if isinstance(column_type, String):
+        return '?'
+    return '?::' + column_type.compile(dialect=postgresql.dialect())
+
+
+def insert_batch(variable, table, columns):
+    """Returns javascript declaring an InsertBatch of table columns"""
+    return "    var %s = new InsertBatch('%s', [%s],\n        '(%s)')" % (
+        variable, table.name, ', '.join("'%s'" % c for c in columns),
+        ', '.join(placeholder(table.c[c]) for c in columns))
+
+
+class BatchedInsertTransferAgent(CommonTransferAgent):
+    """Transform agent batching the inserts of the insert channels
+
+    The insert channels build their SQL by string concatenation, one
+    INSERT per row, and the OBR channel fetches each new id in a round
+    trip of its own.  With the `batched_inserts` option, the
+    destination script is replaced by one collecting the same values
+    (the SQL literals the original would build) as rows, inserted by a
+    single multi-row parameterized INSERT per table, within one
+    transaction.  Ids are reserved in one query per sequence.
+
+    Insert scripts are recognized by the table of their first INSERT,
+    so those inlined in a consolidated channel are batched as well;
+    other scripts are left as is.
+
+    """
+    def _batched_script(self, call, table):
+        """Returns the replacement for the script inserting to table"""
+        if table == 'hl7_visit':
+            table, body = 'hl7_visit', VISIT_BODY % {
+                'visit': insert_batch('visits', hl7Visit_table, (
+                    'hl7_msh_id', 'visit_id', 'patient_id', 'zip',
+                    'country', 'admit_datetime', 'gender', 'dob',
+                    'chief_complaint', 'patient_class', 'disposition',
+                    'county', 'race', 'service_code', 'service_alt_id',
+                    'admission_source', 'assigned_patient_location',
+                    'state', 'discharge_datetime'))}
+        elif table == 'hl7_dx':
+            table, body = 'hl7_dx', DX_BODY % {
+                'dx': insert_batch('dxs', hl7Dx_table, (
+                    'rank', 'dx_code', 'dx_description', 'dx_type',
+                    'hl7_msh_id'))}
+        elif table == 'hl7_obx':
+            table, body = 'hl7_obx', OBX_BODY % {
+                'obx': insert_batch('obxs', hl7Obx_table, (
+                    'hl7_msh_id', 'value_type', 'observation_id',
+                    'observation_text', 'observation_result', 'units',
+                    'result_status', 'observation_datetime',
+                    'performing_lab_code'))}
+        elif table == 'hl7_obr':
+            table, body = 'hl7_obr', OBR_BODY % {
+                'obr': insert_batch('obrs', hl7Obr_table, (
+                    'hl7_obr_id', 'loinc_code', 'loinc_text', 'alt_text',
+                    'observation_datetime', 'status', 'report_datetime',
+                    'specimen_source', 'hl7_msh_id', 'filler_order_no',
+                    'coding', 'alt_code', 'alt_coding')),
+                'obx': insert_batch('obxs', hl7Obx_table, (
+                    'hl7_obx_id', 'hl7_obr_id', 'value_type',
+                    'observation_id', 'observation_text',
+                    'observation_result', 'units', 'result_status',
+                    'observation_datetime', 'performing_lab_code',
+                    'coding', 'alt_id', 'alt_text', 'alt_coding',
+                    'reference_range', 'abnorm_id', 'abnorm_text',
+                    'abnorm_coding', 'alt_abnorm_id', 'alt_abnorm_text',
+                    'alt_abnorm_coding', 'sequence', 'hl7_msh_id')),
+                'obx_nte': insert_batch('obxNotes', hl7Nte_table, (
+                    'sequence_number', 'note', 'hl7_obx_id')),
+                'obr_nte': insert_batch('obrNotes', hl7Nte_table, (
+                    'sequence_number', 'note', 'hl7_obr_id')),
+                'spm': insert_batch('spms', hl7Spm_table, (
+                    'hl7_obr_id', 'id', 'code', 'description'))}
+        else:
+            return None
+        return BATCH_PRELUDE % {'max_params': MAX_PARAMS} + \
+            BATCH_EXECUTE % {'call': call, 'table': table, 'body': body}
+
+    def _adjust_destination(self, destProps):
+        """Replace the insert script, then adjust as usual"""
+        for prop in destProps.iter(tag='property'):
+            if prop.attrib['name'] != 'script' or not prop.text:
+                continue
+            table = re.search(r"INSERT INTO (\w+)", prop.text)
+            call = re.search(r"DatabaseConnectionFactory\."
+                             r"createDatabaseConnection\([^)]*\)",
+                             prop.text)
+            if table and call:
+                prop.text = self._batched_script(
+                    call.group(0), table.group(1)) or prop.text
+        super(BatchedInsertTransferAgent, self).\
+            _adjust_destination(destProps)
+
+
+
+def _renumber(elements):
+    for sequence, element in enumerate(elements):
+        element.find('sequenceNumber').text = str(sequence)
+
+
+def _inline_destination(connector, channel, target):
+    """Returns connector, running target of channel in its place
+
+    The Channel Writer connector is copied, keeping its name and
+    filter rules, then given the target destination's writer and
+    properties.  The channel's source filter rules and transformer
+    steps, then those of the target destination, are appended to the
+    connector's, to run on the consumer's message rather than on a
+    serialized copy of it.
+
+    """
+    inlined = copy.deepcopy(connector)
+    inlined.replace(inlined.find('properties'),
+                    copy.deepcopy(target.find('properties')))
+    inlined.find('transportName').text = target.findtext('transportName')
+
+    steps = inlined.find('transformer/steps')
+    for step in list(steps):
+        steps.remove(step)
+    for step in channel.xpath(
+            "/channel/sourceConnector/transformer/steps/step") + \
+            target.xpath("transformer/steps/step"):
+        steps.append(copy.deepcopy(step))
+    _renumber(steps)
+    # the trimmed outbound message is no longer serialized
+    inlined.find('transformer/outboundTemplate').text = None
+
+    rules = inlined.find('filter/rules')
+    appended = channel.xpath("/channel/sourceConnector/filter/rules/rule") \
+        + target.xpath("filter/rules/rule")
+    if len(rules) and any(rule.findtext('operator') == 'OR'
+                          for rule in appended):
+        raise RuntimeError("Inlining 'OR' filter rules not supported.")
+    for rule in appended:
+        rule = copy.deepcopy(rule)
+        if len(rules):
+            rule.find('operator').text = 'AND'
+        rules.append(rule)
+    _renumber(rules)
+    return inlined
+
+
+def consolidate(consumer, channels):
+    """Inline the channels fed by the consumer channel into it
+
+    :param consumer: parsed channel, such as PHEME_batchfile_consumer,
+      passing messages to other channels via Channel Writer
+      destinations
+    :param channels: the parsed channels to inline
+
+    Each Channel Writer destination targeting one of the channels is
+    replaced by the channel's own destination(s), so the consolidated
+    channel does the work directly, without serializing the message
+    for, and queueing it to, another channel.  Disabled destinations
+    are inlined as well, remaining disabled.
+
+    Returns the consolidated consumer, still named as the consumer.
+
+    """
+    by_id = dict((channel.xpath("/channel/id")[0].text, channel)
+                 for channel in channels)
+    destinations = consumer.xpath("/channel/destinationConnectors")[0]
+    for connector in list(destinations):
+        if connector.findtext('transportName') != 'Channel Writer':
+            continue
+        hosts = [prop.text for prop in connector.iterfind(
+            'properties/property') if prop.attrib['name'] == 'host']
+        channel = by_id.get(hosts[0] if hosts else None)
+        if channel is None:
+            continue
+        index = destinations.index(connector)
+        destinations.remove(connector)
+        targets = channel.xpath("/channel/destinationConnectors/connector")
+        for offset, target in enumerate(targets):
+            inlined = _inline_destination(connector, channel, target)
+            if len(targets) > 1:
+                inlined.find('name').text += ': ' + target.findtext('name')
+            destinations.insert(index + offset, inlined)
+    return consumer
+
+
+# The transform options altering the transformed channels
+TRANSFORM_OPTIONS = ('db', 'user', 'password', 'input_dir', 'output_dir',
+                     'error_dir', 'pooled_connections', 'batched_inserts')
+
+
+def file_hash(path):
+    """Returns hex digest of the file's content, None if missing"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as content:
+        for block in iter(lambda: content.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sources_hash(src):
+    """Returns hex digest of the source file, or list of files"""
+    if isinstance(src, basestring):
+        return file_hash(src)
+    digest = hashlib.sha1()
+    for path in src:
+        digest.update('%s\0' % file_hash(path))
+    return digest.hexdigest()
+
+
+def options_hash(options):
+    """Returns hex digest of the options relevant to the transform"""
+    if options is None:
+        return None
+    digest = hashlib.sha1()
+    for option in TRANSFORM_OPTIONS:
+        digest.update('%s=%r\0' % (option, getattr(options, option, None)))
+    return digest.hexdigest()
+
+
+class TransformManifest(object):
+    """Record of the transformed and deployed channel files
+
+    Persisted as JSON in the target directory, the manifest holds for
+    each transformed file the content hashes of its source, of the
+    transform options used, of the written file and of the file last
+    deployed.  It identifies the channels needing to be transformed,
+    as their source or the options changed, and those needing to be
+    deployed, as the transformed file changed since last deployed.
+
+    """
+    FILENAME = '.transform_manifest.json'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.FILENAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as manifest:
+                self.entries = json.load(manifest)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as manifest:
+            json.dump(self.entries, manifest, indent=2, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def is_current(self, src, target, options):
+        """True if target was transformed from src as is, with options
+
+        :param src: the source file, or list of source files
+
+        """
+        entry = self.entries.get(os.path.basename(target))
+        return bool(entry) and \
+            entry.get('source') == sources_hash(src) and \
+            entry.get('options') == options_hash(options) and \
+            entry.get('target') == file_hash(target)
+
+    def record_transform(self, src, target, options):
+        entry = self.entries.setdefault(os.path.basename(target), {})
+        entry.update({'source': sources_hash(src),
+                      'options': options_hash(options),
+                      'target': file_hash(target)})
+
+    def forget(self, target):
+        self.entries.pop(os.path.basename(target), None)
+
+    def needs_deploy(self, target):
+        """True if target changed since last recorded as deployed"""
+        entry = self.entries.get(os.path.basename(target), {})
+        return entry.get('deployed') is None or \
+            entry.get('deployed') != file_hash(target)
+
+    def record_deploy(self, target):
+        entry = self.entries.setdefault(os.path.basename(target), {})
+        entry['deployed'] = file_hash(target)
+
+
 class TransformManager(object):
     """Transform a mirth channel as directed
 
@@ -181,27 +752,59 @@ class TransformManager(object):
     transformation work to the appropriate transform agent and writing
     out the results.
 
+    Given a `TransformManifest`, channels whose source and transform
+    options are unchanged since last written are skipped, unless
+    `force` is set.
+
+    The channel files named in `inline` are consolidated into the src
+    channel before its transformation, see `consolidate`.
+
     """
 
-    def __init__(self, src, target_dir, options):
+    def __init__(self, src, target_dir, options, manifest=None,
+                 force=False, inline=()):
         self.src = src
         self.target_dir = target_dir
         self.options = options
+        self.manifest = manifest
+        self.force = force
+        self.inline = inline
+
+    def _sources(self):
+        return [self.src] + list(self.inline) if self.inline else self.src
+
+    def _targetFilename(self):
+        return os.path.join(self.target_dir, os.path.basename(self.src))
 
     def _targetFile(self):
         """Returns an open file handle ready for writes"""
-        basename = os.path.basename(self.src)
-        filename = os.path.join(self.target_dir, basename)
-        return open(filename, 'w')
+        return open(self._targetFilename(), 'w')
 
     def __call__(self):
-        """Perform standard transformer steps"""
+        """Perform standard transformer steps
+
+        Returns True if the channel was (re)written, False if skipped
+        as unchanged.
+
+        """
+        if self.manifest and not self.force and self.manifest.is_current(
+                self._sources(), self._targetFilename(), self.options):
+            print 'unchanged channel:', self._targetFilename()
+            return False
+
         self.tree = etree.parse(self.src)
+        if self.inline:
+            self.tree = consolidate(self.tree, [etree.parse(path) for path
+                                                in self.inline])
 
         agent = transformer_factory(self.tree, self.options)
         self.tree = agent.transform()
 
         # Write out the finished product
-        file = self._targetFile()
-        self.tree.write(file, pretty_print=False)
+        with self._targetFile() as file:
+            self.tree.write(file, pretty_print=False)
         print 'wrote transformed channel:', file.name
+        if self.manifest:
+            self.manifest.record_transform(self._sources(), file.name,
+                                           self.options)
+        return True
@@ -6,11 +6,15 @@ Project setup.py defines entry points for the functions below.
 import argparse
 import getpass
 import os
+import re
+import select
 import shutil
-import tempfile
+import subprocess
+import time
 
 from pheme.util.config import Config
 from pheme.warehouse.mirth_channel_transform import TransformManager
+from pheme.warehouse.mirth_channel_transform import TransformManifest
 
 
 CHANNELS = ('PHEME_hl7_obx_insert',
@@ -21,6 +25,177 @@ CHANNELS = ('PHEME_hl7_obx_insert',
             'PHEME_hl7_obr_insert',
             'dump_to_disk',)
 
+# Channels fed by PHEME_batchfile_consumer, inlined when consolidated
+INSERT_CHANNELS = ('PHEME_hl7_visit_insert',
+                   'PHEME_hl7_dx_insert',
+                   'PHEME_hl7_obr_insert',
+                   'PHEME_hl7_obx_insert',)
+
+
+class MirthShellError(RuntimeError):
+    """A mirth shell command failed, or the shell itself"""
+
+
+SENTINEL_PREFIX = '__pheme_end_'
+
+STATUS_PATTERN = re.compile(r'^\s*[0-9a-f]{8}-[0-9a-f-]{27}\s')
+
+
+def parse_status(lines):
+    """Returns dictionary of channel state by name, from status output
+
+    The mirth shell lists a line per channel, starting with the channel
+    id and its state, ending with its name.
+
+    """
+    states = {}
+    for line in lines:
+        if STATUS_PATTERN.match(line):
+            fields = line.split()
+            states[fields[-1]] = fields[1]
+    return states
+
+
+class MirthSession(object):
+    """A persistent mirth shell session
+
+    Starting the mirth shell JVM and logging in dominate the run time
+    of a short script, so a session keeps a single interactive
+    `mccommand` process alive, streaming commands to it and parsing
+    the output of each.
+
+    As the shell doesn't delimit command output, each command is
+    followed by a sentinel, an unknown command whose complaint marks
+    the end of the output.  Output lines matching `ERROR_PATTERN`,
+    the shell's complaints and any reported Java exception, are taken
+    as failure of the command; words such as "error" elsewhere in a
+    line, say in a path, are not.
+
+    :param mirth_home: directory holding the `mccommand` executable
+    :param mirth_system_user: user to run the shell as, via sudo
+      when not the current user
+    :param command: the shell command line, for testing
+
+    Use as a context manager, or `start` and `close` explicitly.
+
+    """
+    TIMEOUT = 300
+    ERROR_PATTERN = re.compile(r'^(error|could not|unknown command)\b|'
+                               r'^[\w.$]*(exception|error)\b:',
+                               re.IGNORECASE)
+
+    def __init__(self, mirth_home, mirth_system_user=None,
+                 command=('./mccommand',), timeout=TIMEOUT):
+        self.mirth_home = mirth_home
+        self.mirth_system_user = mirth_system_user
+        self.command = list(command)
+        self.timeout = timeout
+        self.process = None
+        self._buffer = ''
+        self._sentinels = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """Launch the shell and wait for it to accept commands"""
+        args = self.command
+        if self.mirth_system_user and \
+                getpass.getuser() != self.mirth_system_user:
+            args = ['sudo', '-H', '-u', self.mirth_system_user] + args
+        self.process = subprocess.Popen(
+            args, cwd=self.mirth_home, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        sentinel = self._next_sentinel()
+        self._write([sentinel])
+        self._read_until(sentinel)
+
+    def close(self):
+        """End the session, waiting on the shell to exit"""
+        if not self.process:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.close()
+            deadline = time.time() + 10
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.terminate()
+                self.process.wait()
+        except IOError:
+            pass  # shell already gone
+        finally:
+            self.process = None
+
+    def _next_sentinel(self):
+        self._sentinels += 1
+        return '%s%d__' % (SENTINEL_PREFIX, self._sentinels)
+
+    def _write(self, lines):
+        try:
+            self.process.stdin.write(''.join(line + "\n"
+                                             for line in lines))
+            self.process.stdin.flush()
+        except IOError:
+            raise MirthShellError("mirth shell exited: %s" %
+                                  self._buffer.strip())
+
+    def _read_until(self, sentinel):
+        """Returns the output lines preceding the sentinel's"""
+        deadline = time.time() + self.timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            lines = self._buffer.split("\n")
+            for i, line in enumerate(lines[:-1]):
+                if sentinel in line:
+                    self._buffer = "\n".join(lines[i + 1:])
+                    # skip complaints of earlier, echoed sentinels
+                    return [l.lstrip('$ ').rstrip() for l in lines[:i]
+                            if SENTINEL_PREFIX not in l]
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise MirthShellError("mirth shell timed out after %d "
+                                      "seconds" % self.timeout)
+            if select.select([fd], [], [], remaining)[0]:
+                data = os.read(fd, 4096)
+                if not data:
+                    raise MirthShellError("mirth shell exited: %s" %
+                                          self._buffer.strip())
+                self._buffer += data
+
+    def run(self, commands):
+        """Run the commands, returns list of (command, output lines)
+
+        The commands are pipelined, all sent before reading the output
+        of the first.  Raises `MirthShellError` naming each failed
+        command and its output, once all have run.
+
+        """
+        commands = list(commands)
+        sentinels = [self._next_sentinel() for command in commands]
+        self._write([line for pair in zip(commands, sentinels)
+                     for line in pair])
+        results, failures = [], []
+        for command, sentinel in zip(commands, sentinels):
+            output = [line for line in self._read_until(sentinel) if line]
+            results.append((command, output))
+            if any(self.ERROR_PATTERN.search(line) for line in output):
+                failures.append("%s: %s" % (command, ' '.join(output)))
+        if failures:
+            raise MirthShellError("mirth shell command(s) failed; " +
+                                  '; '.join(failures))
+        return results
+
+    def status(self):
+        """Returns dictionary of channel state by name"""
+        return parse_status(self.run(['status'])[0][1])
+
 
 class MirthShell(object):
     """Sets up and executes common tasks via the mirth shell
@@ -36,60 +211,43 @@ class MirthShell(object):
         self.mirth_home = self.config.get('mirth', 'mirth_home')
         self.mirth_system_user = self.config.get('mirth', 'mirth_system_user')
 
-    def write_script(self, script_file, imports=[], exports=[],):
-        """Generate script for mirth shell to run
+    def script_commands(self, imports=[], exports=[], codetemplates=True):
+        """Returns the list of mirth shell commands for the operations
 
-        :param script_file: An open file handle to a writable file
         :param imports: The mirth channel(s) XML export to import
         :param exports: The list of (channel name, output path) to
           export.
-
-        Writes the necessary mirth shell instructions to the
-        script_file so that the file can be executed via the mirth
-        shell.  NB - this takes the liberty of relaxing the 0600 mode
-        settings hardcoded in NamedTemporaryFile so mirth shell will
-        have read access if running as a different user.
+        :param codetemplates: Set False to skip the codetemplates
+          import, when unchanged
 
         Codetemplates are also imported or exported (if imports or
         exports are defined) into the same directory as the first named
         import / export in a file named "codetemplates.xml".
 
+        Imports are followed by a `deploy`, redeploying all channels;
+        the Mirth 2.2 shell has no command to deploy a single channel.
+
         """
+        commands = []
         for channel in imports:
             assert(os.path.exists(channel))
-            script_file.write("import %s force\n" % channel)
+            commands.append("import %s force" % channel)
         for channel, output in exports:
-            script_file.write("export %s %s\n" % (channel, output))
+            commands.append("export %s %s" % (channel, output))
         if imports:
-            codetemplates = os.path.join(os.path.dirname(imports[0]),
-                                         "codetemplates.xml")
-            script_file.write("importcodetemplates %s\n" % codetemplates)
-            script_file.write("deploy\n")
-            script_file.write("status\n")
+            if codetemplates:
+                commands.append("importcodetemplates %s" % os.path.join(
+                    os.path.dirname(imports[0]), "codetemplates.xml"))
+            commands.append("deploy")
+            commands.append("status")
         if exports:
-            codetemplates = os.path.join(os.path.dirname(exports[0][1]),
-                                         "codetemplates.xml")
-            script_file.write("exportcodetemplates %s\n" % codetemplates)
-        script_file.flush()
-        script_file.seek(0)
-        os.chmod(script_file.name, 0644)
-
-    def execute_script(self, script):
-        "Execute the given script via the mirth shell"
-        try:
-            orig_dir = os.getcwd()
-            os.chdir(self.mirth_home)
-            sudo = ''
-            if getpass.getuser() != self.mirth_system_user:
-                sudo = 'sudo -H -u %s' % self.mirth_system_user
-            command = "%s ./mccommand -s %s" %\
-                (sudo, script.name)
-            print command
-            os.system(command)
-        except:
-            raise
-        finally:
-            os.chdir(orig_dir)
+            commands.append("exportcodetemplates %s" % os.path.join(
+                os.path.dirname(exports[0][1]), "codetemplates.xml"))
+        return commands
+
+    def session(self):
+        """Returns a `MirthSession`, to be started, for this install"""
+        return MirthSession(self.mirth_home, self.mirth_system_user)
 
 
 def transform_channels():
@@ -104,6 +262,14 @@ def transform_channels():
     NB - values defined in the project configuration file will be used
     unless provided as optional arguments.  See
     `pheme.util.config.Config`
+
+    Only channels whose source or transform options changed since
+    last written to the target directory are transformed, see
+    `pheme.warehouse.mirth_channel_transform.TransformManifest`.
+
+    With --consolidated, the insert channels are inlined into
+    PHEME_batchfile_consumer, which then does their work directly, and
+    are not written themselves.
     """
     config = Config()
     ap = argparse.ArgumentParser(description=doc)
@@ -131,42 +297,111 @@ def transform_channels():
                     default=config.get('warehouse', 'error_dir'),
                     help="filesystem directory for channel errors "
                     "(overrides [warehouse]error_dir)")
+    ap.add_argument("--pooled_connections", action='store_true',
+                    help="keep one database connection per channel, "
+                    "opened on deploy, rather than one per message")
+    ap.add_argument("--batched_inserts", action='store_true',
+                    help="replace the per row INSERT statements of the "
+                    "insert channels with multi-row parameterized ones")
+    ap.add_argument("--consolidated", action='store_true',
+                    help="generate a single channel in place of "
+                    "PHEME_batchfile_consumer and the insert channels "
+                    "it feeds")
     ap.add_argument("source_directory",
                     help="directory containing source channel "
                     "definition files")
     ap.add_argument("target_directory",
                     help="directory to write transformed channel "
                     "definition files")
+    ap.add_argument("--force", action='store_true',
+                    help="transform all channels, even if unchanged")
     args = ap.parse_args()
     source_dir = os.path.realpath(args.source_directory)
     target_dir = os.path.realpath(args.target_directory)
 
+    manifest = TransformManifest(target_dir)
     transformer = TransformManager(src=None,
                                    target_dir=target_dir,
-                                   options=args)
+                                   options=args,
+                                   manifest=manifest,
+                                   force=args.force)
+    inline = []
+    if args.consolidated:
+        inline = [os.path.join(source_dir, '%s.xml' % c)
+                  for c in INSERT_CHANNELS]
     for c in CHANNELS:
+        if args.consolidated and c in INSERT_CHANNELS:
+            # remove any unconsolidated copy, lest it be deployed
+            stale = os.path.join(target_dir, '%s.xml' % c)
+            if os.path.exists(stale):
+                os.remove(stale)
+            manifest.forget(stale)
+            continue
         transformer.src = os.path.join(source_dir, '%s.xml' % c)
+        transformer.inline = inline if c == 'PHEME_batchfile_consumer' \
+            else ()
         transformer()
     # no transformation on codetemplates at this time - but the
     # importer expects the codetemplates.xml file to be in the same
     # directory, so copy it over.
-    shutil.copy(os.path.join(source_dir, 'codetemplates.xml'), target_dir)
+    src = os.path.join(source_dir, 'codetemplates.xml')
+    target = os.path.join(target_dir, 'codetemplates.xml')
+    if args.force or not manifest.is_current(src, target, None):
+        shutil.copy(src, target_dir)
+        manifest.record_transform(src, target, None)
+    manifest.save()
 
 
 def deploy_channels():
-    """Entry point to deploy the channels to mirth on localhost"""
+    """Entry point to deploy the channels to mirth on localhost
+
+    Only the channels changed since last deployed from the directory,
+    per its `TransformManifest`, are imported, unless `--all` is given
+    or the code templates changed.  The shell can only redeploy all
+    channels though, so all are restarted whenever any changed.  Channels missing from the directory, such
+    as the insert channels of a consolidated transform, are skipped.
+    Raises `MirthShellError` if any command fails or a deployed
+    channel isn't started.
+
+    """
     ap = argparse.ArgumentParser(description="deploy known PHEME channels "
                                  "and code templates to Mirth Connect")
     ap.add_argument("deploy_directory",
                     help="directory containing channel definition files")
+    ap.add_argument("--all", action='store_true',
+                    help="import and redeploy all channels, even if "
+                    "unchanged")
     args = ap.parse_args()
     path = os.path.realpath(args.deploy_directory)
 
-    imports = [os.path.join(path, '%s.xml' % c) for c in CHANNELS]
+    manifest = TransformManifest(path)
+    codetemplates = os.path.join(path, 'codetemplates.xml')
+    # channels include the code templates when deployed, so changed
+    # templates require redeploying all
+    redeploy_all = args.all or manifest.needs_deploy(codetemplates)
+    available = [c for c in CHANNELS
+                 if os.path.exists(os.path.join(path, '%s.xml' % c))]
+    channels = [c for c in available if redeploy_all or
+                manifest.needs_deploy(os.path.join(path, '%s.xml' % c))]
+    if not channels:
+        print "no channels changed since last deployed"
+        return
+
+    imports = [os.path.join(path, '%s.xml' % c) for c in channels]
     ms = MirthShell()
-    with tempfile.NamedTemporaryFile('w') as script_file:
-        ms.write_script(script_file, imports=imports)
-        ms.execute_script(script_file)
+    with ms.session() as session:
+        results = session.run(ms.script_commands(
+            imports=imports, codetemplates=redeploy_all))
+    states = parse_status(results[-1][1])
+    for c in channels:
+        print "%s: %s" % (c, states.get(c, 'not deployed'))
+    failed = [c for c in channels if states.get(c) != 'STARTED']
+    if failed:
+        raise MirthShellError("channel(s) not started: %s" %
+                              ', '.join(failed))
+    for target in imports + [codetemplates]:
+        manifest.record_deploy(target)
+    manifest.save()
 
 
 def export_channels():
@@ -185,6 +420,6 @@ def export_channels():
         exports.append((c, os.path.join(path, '%s.xml' % c)))
 
     ms = MirthShell()
-    with tempfile.NamedTemporaryFile('w') as script_file:
-        ms.write_script(script_file, exports=exports)
-        ms.execute_script(script_file)
+    with ms.session() as session:
+        session.run(ms.script_commands(exports=exports))
+    print "exported %d channels to %s" % (len(exports), path)
@@ -0,0 +1,312 @@
+"""Optional normalized (dictionary encoded) storage of repetitive text
+
+A handful of text columns repeat the same few thousand strings across
+millions of rows.  In normalized mode (config [warehouse]normalized)
+those values are stored once in the `hl7_text` dictionary table, and
+the rows of the affected tables carry an integer text_id instead:
+
+    =========  ===========================================
+    table      dictionary encoded columns
+    =========  ===========================================
+    hl7_msh    facility
+    hl7_dx     dx_description
+    hl7_obr    loinc_text
+    hl7_obx    observation_text, units, result_status
+    =========  ===========================================
+
+The rows live in `<table>_store` tables, e.g. `hl7_obx_store` with
+an `observation_text_id` column.  A view under the original table
+name joins the text back in, keeping the existing column shapes for
+readers (including the ORM mappings in `pheme.warehouse.tables`).
+INSTEAD OF triggers on the views accept the inserts, updates and
+deletes issued by the Mirth channels, encoding text via the
+`hl7_text_id()` database function.
+
+The native ingester bypasses the triggers, writing to the store
+tables directly with keys from an in-memory `TextDictionary`.
+
+"""
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import func
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Sequence
+from sqlalchemy import Table
+from sqlalchemy import text
+from sqlalchemy import TEXT
+from sqlalchemy.types import NullType
+
+from pheme.util.config import Config
+from pheme.warehouse.tables import grant_privileges
+from pheme.warehouse.tables import metadata
+
+
+NORMALIZED_COLUMNS = {
+    'hl7_msh': ('facility',),
+    'hl7_dx': ('dx_description',),
+    'hl7_obr': ('loinc_text',),
+    'hl7_obx': ('observation_text', 'units', 'result_status'),
+}
+
+TEXT_TABLE = 'hl7_text'
+
+
+def normalized_mode(config=None):
+    """True if the config enables [warehouse]normalized"""
+    value = (config or Config()).get('warehouse', 'normalized')
+    return bool(value) and value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def normalized_views():
+    """Returns the tables presented as views over store tables"""
+    return [table for table in metadata.sorted_tables
+            if table.name in NORMALIZED_COLUMNS]
+
+
+def store_name(table_name):
+    """Name of the table holding rows for the named (view) table"""
+    if table_name in NORMALIZED_COLUMNS:
+        return table_name + '_store'
+    return table_name
+
+
+def _copy_column(column):
+    """Copy column for the normalized metadata, retargeting FKs"""
+    type_ = column.type
+    args = []
+    for foreign_key in column.foreign_keys:
+        target = foreign_key.column
+        if isinstance(type_, NullType):
+            type_ = target.type
+        args.append(ForeignKey('%s.%s' % (store_name(target.table.name),
+                                          target.name),
+                               ondelete=foreign_key.ondelete))
+    kwargs = dict(primary_key=column.primary_key,
+                  nullable=column.nullable, index=column.index,
+                  unique=column.unique, default=column.default)
+    table_name = column.table.name
+    if column.primary_key and table_name in NORMALIZED_COLUMNS:
+        # Retain the sequence the channels use, i.e.
+        # nextval('hl7_obx_hl7_obx_id_seq')
+        sequence = '%s_%s_seq' % (table_name, column.name)
+        args.append(Sequence(sequence))
+        kwargs['server_default'] = text("nextval('%s')" % sequence)
+    return Column(column.name, type_, *args, **kwargs)
+
+
+def normalized_metadata():
+    """Build the MetaData for the normalized schema
+
+    Contains the `hl7_text` dictionary, the `<table>_store` tables
+    and the remaining tables unchanged but for foreign keys, which
+    refer to the store tables.
+
+    """
+    normalized = MetaData()
+    Table(TEXT_TABLE, normalized,
+          Column('text_id', Integer, primary_key=True),
+          Column('value', TEXT, nullable=False, index=True, unique=True))
+    for table in metadata.sorted_tables:
+        encoded = NORMALIZED_COLUMNS.get(table.name, ())
+        columns = []
+        for column in table.columns:
+            if column.name in encoded:
+                # Indexed, as for any foreign key queried by value
+                # and checked on hl7_text deletes
+                columns.append(Column(
+                    column.name + '_id', Integer,
+                    ForeignKey('%s.text_id' % TEXT_TABLE),
+                    nullable=column.nullable, index=True))
+            else:
+                columns.append(_copy_column(column))
+        Table(store_name(table.name), normalized, *columns)
+    return normalized
+
+
+TEXT_ID_FUNCTION = """
+CREATE OR REPLACE FUNCTION hl7_text_id(text_value TEXT) RETURNS INTEGER AS $$
+DECLARE
+    key INTEGER;
+BEGIN
+    IF text_value IS NULL THEN
+        RETURN NULL;
+    END IF;
+    LOOP
+        SELECT text_id INTO key FROM hl7_text WHERE value = text_value;
+        IF FOUND THEN
+            RETURN key;
+        END IF;
+        BEGIN
+            INSERT INTO hl7_text (value) VALUES (text_value)
+                RETURNING text_id INTO key;
+            RETURN key;
+        EXCEPTION WHEN unique_violation THEN
+            -- concurrent insert of the same value, loop to select it
+        END;
+    END LOOP;
+END
+$$ LANGUAGE plpgsql"""
+
+
+def view_ddl(table, replace=False):
+    """Returns the CREATE VIEW statement presenting table's shape
+
+    :param replace: CREATE OR REPLACE the view, such as to present
+      columns added to the store table since it was created
+
+    """
+    encoded = NORMALIZED_COLUMNS[table.name]
+    columns, joins = [], []
+    for column in table.columns:
+        if column.name in encoded:
+            alias = 't_' + column.name
+            columns.append('%s.value AS %s' % (alias, column.name))
+            joins.append('LEFT JOIN %s %s ON %s.text_id = s.%s_id' %
+                         (TEXT_TABLE, alias, alias, column.name))
+        else:
+            columns.append('s.' + column.name)
+    return 'CREATE %sVIEW %s AS SELECT %s FROM %s s %s' % (
+        'OR REPLACE ' if replace else '', table.name, ', '.join(columns), store_name(table.name),
+        ' '.join(joins))
+
+
+def trigger_ddl(table):
+    """Returns the statements creating the view's INSTEAD OF trigger"""
+    encoded = NORMALIZED_COLUMNS[table.name]
+    pk = list(table.primary_key.columns)[0].name
+    store_columns, values, assignments = [], [], []
+    for column in table.columns:
+        if column.name in encoded:
+            name = column.name + '_id'
+            value = 'hl7_text_id(NEW.%s)' % column.name
+        else:
+            name, value = column.name, 'NEW.' + column.name
+        store_columns.append(name)
+        values.append(value)
+        if column.name != pk:
+            assignments.append('%s = %s' % (name, value))
+    substitutions = {
+        'table': table.name, 'store': store_name(table.name), 'pk': pk,
+        'columns': ', '.join(store_columns), 'values': ', '.join(values),
+        'assignments': ', '.join(assignments)}
+    function = """
+CREATE OR REPLACE FUNCTION %(table)s_write() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM %(store)s WHERE %(pk)s = OLD.%(pk)s;
+        RETURN OLD;
+    ELSIF TG_OP = 'UPDATE' THEN
+        UPDATE %(store)s SET %(assignments)s WHERE %(pk)s = OLD.%(pk)s;
+        RETURN NEW;
+    END IF;
+    IF NEW.%(pk)s IS NULL THEN
+        NEW.%(pk)s := nextval('%(table)s_%(pk)s_seq');
+    END IF;
+    INSERT INTO %(store)s (%(columns)s) VALUES (%(values)s);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql""" % substitutions
+    trigger = "CREATE TRIGGER %(table)s_write INSTEAD OF INSERT OR "\
+        "UPDATE OR DELETE ON %(table)s FOR EACH ROW EXECUTE PROCEDURE "\
+        "%(table)s_write()" % substitutions
+    return [function, trigger]
+
+
+def drop_normalized(engine):
+    """Drop the normalized views, functions and tables, if present"""
+    if not engine.has_table(TEXT_TABLE):
+        return
+    for table_name in NORMALIZED_COLUMNS:
+        engine.execute("DROP VIEW IF EXISTS %s CASCADE" % table_name)
+        engine.execute("DROP FUNCTION IF EXISTS %s_write()" % table_name)
+    engine.execute("DROP FUNCTION IF EXISTS hl7_text_id(TEXT)")
+    normalized_metadata().drop_all(bind=engine)
+
+
+def create_normalized(engine, user, enable_delete=False):
+    """Create the normalized schema, granting user access
+
+    :param engine: engine connected as the table owner
+    :param user: the database user writing to the warehouse (Mirth)
+    :param enable_delete: grant DELETE as well
+
+    """
+    normalized = normalized_metadata()
+    normalized.create_all(bind=engine)
+    engine.execute(text(TEXT_ID_FUNCTION).execution_options(
+        autocommit=True))
+    views = normalized_views()
+    for table in views:
+        engine.execute(text(view_ddl(table)).execution_options(
+            autocommit=True))
+        for statement in trigger_ddl(table):
+            engine.execute(text(statement).execution_options(
+                autocommit=True))
+    grant_privileges(engine, user, normalized.sorted_tables,
+                     enable_delete=enable_delete)
+    # Views have no sequences of their own, see sequence_names
+    engine.execute("BEGIN; GRANT SELECT, INSERT, UPDATE %s ON %s TO %s; "
+                   "COMMIT;" % (", DELETE" if enable_delete else '',
+                                ', '.join(t.name for t in views), user))
+
+
+class TextDictionary(object):
+    """In-memory cache of the hl7_text dictionary
+
+    Used at ingest to assign text_id values without a database round
+    trip for values already seen.  New values are added via the
+    `hl7_text_id()` function on a separate, autocommitted connection,
+    so a rolled back ingest transaction can't leave the cache holding
+    keys that don't exist.
+
+    :param engine: warehouse engine
+    :param preload: load the whole dictionary up front, it is small
+
+    """
+    def __init__(self, engine, preload=True):
+        self.engine = engine
+        self.normalized = normalized_metadata()
+        self.text_table = self.normalized.tables[TEXT_TABLE]
+        self._keys = {}
+        self.misses = 0
+        if preload:
+            for text_id, value in engine.execute(select(
+                    [self.text_table.c.text_id, self.text_table.c.value])):
+                self._keys[value] = text_id
+
+    def __len__(self):
+        return len(self._keys)
+
+    def key(self, value):
+        """Returns the text_id for value, adding it if new"""
+        if value is None:
+            return None
+        try:
+            return self._keys[value]
+        except KeyError:
+            self.misses += 1
+            key = self.engine.execute(
+                select([func.hl7_text_id(value)]).execution_options(
+                    autocommit=True)).scalar()
+            self._keys[value] = key
+            return key
+
+    def encode(self, table, rows):
+        """Map rows for table onto its store table
+
+        Returns tuple (store table, encoded rows); tables without
+        dictionary encoded columns are returned unchanged.
+
+        """
+        encoded_columns = NORMALIZED_COLUMNS.get(table.name)
+        if not encoded_columns:
+            return table, rows
+        encoded_rows = []
+        for row in rows:
+            row = dict(row)
+            for column in encoded_columns:
+                row[column + '_id'] = self.key(row.pop(column, None))
+            encoded_rows.append(row)
+        return self.normalized.tables[store_name(table.name)], encoded_rows
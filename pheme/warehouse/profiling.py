@@ -0,0 +1,98 @@
+"""Opt-in profiling of the next N batch files ingested
+
+Diagnosing a pathological feed shouldn't require reproducing it.  A
+`BatchProfiler` runs cProfile over the ingest of the next N batch
+files, when armed either by config::
+
+    [warehouse]
+    profile_batches = 3
+
+(profiling the first 3 files of each run) or by sending SIGUSR1 to a
+running `ingest_batchfiles`, which profiles the next
+[warehouse]profile_signal_batches files (default 1).
+
+For each profiled batch file, `<batch file>.prof` (pstats data, for
+snakeviz, gprof2dot or `python -m pstats`) and `<batch file>.prof.txt`
+(the top functions by cumulative time) are written to
+[warehouse]output_dir, alongside the processed batch files.
+
+"""
+import cProfile
+from contextlib import contextmanager
+import os
+import pstats
+import signal
+
+from pheme.util.config import Config
+
+
+# Number of functions listed in the text summary
+SUMMARY_LIMIT = 40
+
+
+def _config_int(config, option, default):
+    value = config.get('warehouse', option)
+    return int(value) if value else default
+
+
+class BatchProfiler(object):
+    """Profile the ingest of the next `batches` batch files
+
+    :param batches: number of batch files to profile from the start
+    :param output_dir: directory for the profile output, defaults to
+      that of each batch file
+    :param signal_batches: number of batch files to profile each time
+      the signal handler is triggered
+
+    """
+    def __init__(self, batches=0, output_dir=None, signal_batches=1):
+        self.remaining = batches
+        self.output_dir = output_dir
+        self.signal_batches = signal_batches
+
+    @classmethod
+    def from_config(cls, config=None):
+        """Build a profiler from the [warehouse] config values"""
+        config = config or Config()
+        return cls(batches=_config_int(config, 'profile_batches', 0),
+                   output_dir=config.get('warehouse', 'output_dir'),
+                   signal_batches=_config_int(
+                       config, 'profile_signal_batches', 1))
+
+    def arm(self, batches):
+        """Profile the next `batches` batch files (in addition)"""
+        self.remaining += batches
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        """Arm the profiler for `signal_batches` files on signum"""
+        def handler(signum, frame):
+            self.arm(self.signal_batches)
+        signal.signal(signum, handler)
+
+    def output_path(self, path):
+        """Returns the path of the pstats output for a batch file"""
+        return os.path.join(self.output_dir or os.path.dirname(path),
+                            os.path.basename(path) + '.prof')
+
+    @contextmanager
+    def profile(self, path):
+        """Profile the with block, if armed, as the ingest of path
+
+        Yields the output path when profiling, otherwise None.
+
+        """
+        if self.remaining <= 0:
+            yield None
+            return
+        self.remaining -= 1
+        output_path = self.output_path(path)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield output_path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path)
+            with open(output_path + '.txt', 'w') as summary:
+                stats = pstats.Stats(profiler, stream=summary)
+                stats.sort_stats('cumulative').print_stats(SUMMARY_LIMIT)
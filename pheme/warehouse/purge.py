@@ -0,0 +1,176 @@
+"""Bulk removal of warehouse messages
+
+Removes every row related to the selected messages, such as a bad
+batch file or messages outside the retention window.  Deletes are set
+based and chunked, proceeding from the leaf tables upward, rather than
+relying on row by row `ON DELETE CASCADE` processing.
+
+Project setup.py defines the `purge_warehouse` entry point.
+
+"""
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import getpass
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import select
+
+from pheme.util.config import Config
+from pheme.warehouse.selection import add_selection_arguments
+from pheme.warehouse.selection import chunked
+from pheme.warehouse.selection import MessageSelection
+from pheme.warehouse.tables import delete_derived_rows
+from pheme.warehouse.tables import derived_row_criteria
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7RawMessage_table
+
+
+def _raw_message_criteria(msh_ids):
+    return hl7RawMessage_table.c.message_control_id.in_(
+        select([hl7Msh_table.c.message_control_id],
+               hl7Msh_table.c.hl7_msh_id.in_(msh_ids)))
+
+
+def count_rows(connection, selection, keep_raw=False):
+    """Count the rows a purge of the selection would remove
+
+    Returns list of (table name, row count) in delete order.
+
+    """
+    msh_ids = select([hl7Msh_table.c.hl7_msh_id], selection.where())
+    counts = []
+    criteria = derived_row_criteria(msh_ids)
+    if not keep_raw:
+        criteria.append((hl7RawMessage_table,
+                         _raw_message_criteria(msh_ids)))
+    criteria.append((hl7Msh_table, selection.where()))
+    for table, where in criteria:
+        count = connection.execute(
+            select([func.count()], from_obj=table).where(where)).scalar()
+        counts.append((table.name, count))
+    return counts
+
+
+def purge_chunk(connection, msh_ids, keep_raw=False):
+    """Delete the given messages and all related rows
+
+    All work for the chunk is done in a single transaction.
+
+    Returns dictionary of deleted row counts keyed by table name.
+
+    """
+    transaction = connection.begin()
+    try:
+        counts = delete_derived_rows(connection, msh_ids)
+        if not keep_raw:
+            result = connection.execute(hl7RawMessage_table.delete().where(
+                _raw_message_criteria(msh_ids)))
+            counts[hl7RawMessage_table.name] = result.rowcount
+        result = connection.execute(hl7Msh_table.delete().where(
+            hl7Msh_table.c.hl7_msh_id.in_(msh_ids)))
+        counts[hl7Msh_table.name] = result.rowcount
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    return counts
+
+
+def purge(connection, selection, keep_raw=False, chunk_size=1000):
+    """Purge the selected messages, generating progress
+
+    :param connection: database connection, the user requires DELETE
+      permission
+    :param selection: `MessageSelection` naming the messages
+    :param keep_raw: retain the hl7_raw_message rows if set, such as
+      when the messages will be fed back through Mirth
+    :param chunk_size: number of messages per transaction
+
+    Generates tuple (messages done, total messages, cumulative deleted
+    row counts keyed by table name) after each chunk completes.
+
+    """
+    msh_ids = selection.msh_ids(connection)
+    totals = {}
+    done = 0
+    for chunk in chunked(msh_ids, chunk_size):
+        counts = purge_chunk(connection, chunk, keep_raw)
+        for table, count in counts.items():
+            totals[table] = totals.get(table, 0) + count
+        done += len(chunk)
+        yield done, len(msh_ids), totals
+
+
+def retention_cutoff(retain_days, now=None):
+    """Returns the message_datetime ending a retention window
+
+    Messages older than the cutoff fall outside the window of
+    retain_days, counting back from now.
+
+    """
+    return (now or datetime.now()) - timedelta(days=retain_days)
+
+
+def purge_warehouse():
+    """Entry point to purge selected messages from the warehouse"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="remove the selected "
+                                 "messages and all related rows from "
+                                 "the warehouse")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'create_table_user'),
+                    help="database user with DELETE permission "
+                    "(overrides [warehouse]create_table_user)")
+    ap.add_argument("--chunk_size", type=int, default=1000,
+                    help="number of messages per transaction")
+    ap.add_argument("--keep_raw", action='store_true',
+                    help="retain the hl7_raw_message rows")
+    ap.add_argument("--retain_days", type=int,
+                    help="retention window; select messages with "
+                    "message_datetime older than the given number "
+                    "of days (overrides --until)")
+    ap.add_argument("-n", "--dry_run", action='store_true',
+                    help="report the number of rows to be removed "
+                    "without removing any")
+    add_selection_arguments(ap)
+    args = ap.parse_args()
+    if args.retain_days is not None:
+        args.until = retention_cutoff(args.retain_days)
+    try:
+        selection = MessageSelection.from_args(args)
+    except ValueError as e:
+        ap.error(str(e))
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    engine = create_engine(engine_url(args.user, password, args.db))
+    connection = engine.connect()
+
+    try:
+        if args.dry_run:
+            print "rows to purge where", selection
+            for table, count in count_rows(connection, selection,
+                                           args.keep_raw):
+                print "  %-16s %d" % (table, count)
+            return
+
+        print "purging messages where", selection
+        start = time.time()
+        totals = {}
+        for done, total, totals in purge(connection, selection,
+                                         keep_raw=args.keep_raw,
+                                         chunk_size=args.chunk_size):
+            print "purged %d of %d messages (%.1f seconds)" %\
+                (done, total, time.time() - start)
+        for table in sorted(totals):
+            print "  %-16s %d" % (table, totals[table])
+    finally:
+        connection.close()
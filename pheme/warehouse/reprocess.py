@@ -0,0 +1,219 @@
+"""Rebuild warehouse tables from the stored raw messages
+
+After a channel bug fix, the rows derived from already processed
+messages (hl7_visit, hl7_dx, hl7_obr, hl7_obx, hl7_nte and hl7_spm)
+can be rebuilt in place from hl7_raw_message, without a full reload
+through Mirth.  The existing hl7_msh rows (and therefore their
+hl7_msh_id values) are retained.
+
+Project setup.py defines the `reprocess_warehouse` entry point.
+
+"""
+import argparse
+from itertools import imap
+import getpass
+import logging
+import multiprocessing
+import time
+import zlib
+
+from sqlalchemy import and_
+from sqlalchemy import create_engine
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from pheme.util.config import Config
+from pheme.warehouse.archive import RawArchive
+from pheme.warehouse.ingest import Message
+from pheme.warehouse.ingest import MessageWriter
+from pheme.warehouse.normalized import normalized_mode
+from pheme.warehouse.normalized import TextDictionary
+from pheme.warehouse.selection import add_selection_arguments
+from pheme.warehouse.selection import chunked
+from pheme.warehouse.selection import MessageSelection
+from pheme.warehouse.tables import delete_derived_rows
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7RawMessage_table
+
+
+# Each worker process maintains its own engine, see _init_worker
+_engine = None
+_archive = None
+_dictionary = None
+
+
+def _init_worker(url):
+    global _engine, _dictionary
+    _engine = create_engine(url, pool_size=2)
+    if normalized_mode():
+        _dictionary = TextDictionary(_engine)
+
+
+def _raw_archive():
+    """Lazy load the archive, only needed for archived messages"""
+    global _archive
+    if _archive is None:
+        _archive = RawArchive()
+    return _archive
+
+
+def archived_raw_data(message_control_id, segment, offset):
+    """Returns the archived raw message, None (logged) if unavailable
+
+    Such as when the archive segment is missing, unreadable or purged.
+
+    """
+    try:
+        raw_data = _raw_archive().lookup(message_control_id, segment,
+                                         offset)
+    except (IOError, ValueError, zlib.error) as e:
+        raw_data = None
+        logging.error("Unable to read archived message control id %s "
+                      "(%s at %s): %s", message_control_id, segment,
+                      offset, e)
+    else:
+        if raw_data is None:
+            logging.error("Archived message control id %s not found "
+                          "(%s at %s)", message_control_id, segment,
+                          offset)
+    return raw_data
+
+
+def reprocess_chunk(msh_ids):
+    """Rebuild the rows derived from the given hl7_msh_ids
+
+    All work for the chunk is done in a single transaction, each
+    message's rebuild within a savepoint.  A message failing to store,
+    say violating a constraint, is logged and rolled back alone; its
+    derived rows are left removed, as a load through the channels
+    would have left them.  Archived raw messages are read back from
+    the archive.  Messages without a raw message, or whose archived
+    copy is unavailable, are left untouched.
+
+    Returns tuple (number of hl7_msh_ids in chunk, number rebuilt,
+    number failed)
+
+    """
+    msh, raw = hl7Msh_table.c, hl7RawMessage_table.c
+    connection = _engine.connect()
+    transaction = connection.begin()
+    try:
+        rows = connection.execute(select(
+            [msh.hl7_msh_id, raw.message_control_id, raw.raw_data,
+             raw.archive_segment, raw.archive_offset],
+            and_(msh.hl7_msh_id.in_(msh_ids),
+                 msh.message_control_id == raw.message_control_id,
+                 or_(raw.raw_data != None,
+                     raw.archive_segment != None)))).fetchall()
+        messages = []
+        for hl7_msh_id, message_control_id, raw_data, segment, offset \
+                in rows:
+            if raw_data is None:
+                raw_data = archived_raw_data(message_control_id, segment,
+                                             offset)
+                if raw_data is None:
+                    continue
+            messages.append((hl7_msh_id, message_control_id, raw_data))
+        delete_derived_rows(connection, [m[0] for m in messages])
+        writer = MessageWriter(connection, _dictionary)
+        failed = 0
+        for hl7_msh_id, message_control_id, raw_data in messages:
+            message = Message(raw_data)
+            savepoint = connection.begin_nested()
+            try:
+                writer.update_msh(message, hl7_msh_id)
+                writer.write_derived(message, hl7_msh_id)
+                savepoint.commit()
+            except SQLAlchemyError as e:
+                savepoint.rollback()
+                logging.error("Failed to rebuild message control id %s: "
+                              "%s", message_control_id, e)
+                failed += 1
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+    return len(msh_ids), len(messages) - failed, failed
+
+
+def reprocess(url, selection, workers=1, chunk_size=500):
+    """Rebuild the selected messages, generating progress
+
+    :param url: database URL (see `tables.engine_url`), the user
+      requires DELETE permission
+    :param selection: `MessageSelection` naming the messages
+    :param workers: number of worker processes
+    :param chunk_size: number of messages per transaction
+
+    Generates tuple (messages done, messages rebuilt, messages failed,
+    total messages) after each chunk completes.
+
+    """
+    _init_worker(url)
+    msh_ids = selection.msh_ids(_engine)
+    chunks = chunked(msh_ids, chunk_size)
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (url,))
+        results = pool.imap_unordered(reprocess_chunk, chunks)
+    else:
+        results = imap(reprocess_chunk, chunks)
+
+    done = rebuilt = failed = 0
+    try:
+        for chunk_count, chunk_rebuilt, chunk_failed in results:
+            done += chunk_count
+            rebuilt += chunk_rebuilt
+            failed += chunk_failed
+            yield done, rebuilt, failed, len(msh_ids)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def reprocess_warehouse():
+    """Entry point to rebuild selected warehouse rows from raw messages"""
+    config = Config()
+    ap = argparse.ArgumentParser(description="rebuild the warehouse rows "
+                                 "derived from the selected messages, "
+                                 "using the stored raw messages")
+    ap.add_argument("-d", "--database", dest="db",
+                    default=config.get('warehouse', 'database'),
+                    help="name of database (overrides "
+                    "[warehouse]database)")
+    ap.add_argument("-u", "--user", dest="user",
+                    default=config.get('warehouse', 'create_table_user'),
+                    help="database user with DELETE permission "
+                    "(overrides [warehouse]create_table_user)")
+    ap.add_argument("-w", "--workers", type=int,
+                    default=multiprocessing.cpu_count(),
+                    help="number of worker processes")
+    ap.add_argument("--chunk_size", type=int, default=500,
+                    help="number of messages per transaction")
+    add_selection_arguments(ap)
+    args = ap.parse_args()
+    try:
+        selection = MessageSelection.from_args(args)
+    except ValueError as e:
+        ap.error(str(e))
+
+    print "password for PostgreSQL user:", args.user
+    password = getpass.getpass()
+    url = engine_url(args.user, password, args.db)
+
+    print "reprocessing messages where", selection
+    start = time.time()
+    done = rebuilt = failed = 0
+    for done, rebuilt, failed, total in reprocess(
+            url, selection, workers=args.workers,
+            chunk_size=args.chunk_size):
+        print "reprocessed %d of %d messages" % (done, total)
+    print "rebuilt %d messages (%d lacked raw data, %d failed, see "\
+        "log) in %.1f seconds" % (rebuilt, done - rebuilt - failed,
+                                  failed, time.time() - start)
@@ -0,0 +1,173 @@
+"""Time windowed, parallel scans of the warehouse
+
+Large extracts (such as a month of visits joined to their messages)
+run as a single query on a single connection and core.  `scan` instead
+splits the requested range into windows on one of the indexed datetime
+columns (hl7_visit.admit_datetime, hl7_visit.discharge_datetime or
+hl7_msh.message_datetime), so each window is an index range scan, and
+runs the windows concurrently on pooled connections.
+
+Rows are streamed back either as windows complete (unordered), or in
+window order (ordered, each window sorted on the scan column).  At
+most a few windows per worker are buffered at any time.
+
+"""
+from datetime import timedelta
+import Queue
+import threading
+
+from sqlalchemy import and_
+from sqlalchemy import select
+
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Visit_table
+
+
+SCAN_COLUMNS = {
+    'admit_datetime': hl7Visit_table.c.admit_datetime,
+    'discharge_datetime': hl7Visit_table.c.discharge_datetime,
+    'message_datetime': hl7Msh_table.c.message_datetime,
+}
+
+
+def windows(start, end, size=timedelta(days=1)):
+    """Split [start, end) into consecutive [lo, hi) windows
+
+    Window boundaries fall on start + N * size; the last window is cut
+    short at end.
+
+    """
+    if size <= timedelta(0):
+        raise ValueError("window size must be positive")
+    lo = start
+    while lo < end:
+        hi = min(lo + size, end)
+        yield lo, hi
+        lo = hi
+
+
+def visit_query(column, lo, hi, columns=None):
+    """Select hl7_visit rows joined to hl7_msh within a window
+
+    :param column: name of the windowed column, see `SCAN_COLUMNS`
+    :param lo: inclusive lower bound
+    :param hi: exclusive upper bound
+    :param columns: columns to select, defaults to all hl7_visit
+      columns plus the hl7_msh message_control_id, message_type,
+      facility and message_datetime
+
+    """
+    scan_column = SCAN_COLUMNS[column]
+    if columns is None:
+        msh = hl7Msh_table.c
+        columns = [hl7Visit_table, msh.message_control_id,
+                   msh.message_type, msh.facility, msh.message_datetime]
+    return select(columns, and_(
+        hl7Visit_table.c.hl7_msh_id == hl7Msh_table.c.hl7_msh_id,
+        scan_column >= lo, scan_column < hi)).\
+        order_by(scan_column, hl7Visit_table.c.hl7_visit_id)
+
+
+def parallel_windows(fetch, window_list, workers=4, ordered=False):
+    """Run fetch(window) concurrently, generating the returned rows
+
+    :param fetch: callable returning the list of rows for a window
+    :param window_list: sequence of windows, passed to fetch
+    :param workers: number of worker threads
+    :param ordered: if set, rows are generated in window order,
+      otherwise each window's rows are generated as it completes
+
+    At most 2 * workers windows are dispatched but not yet consumed,
+    bounding memory use; in ordered mode a slow window holds back
+    further dispatch until its rows are generated.  An exception
+    raised by fetch is re-raised here, and stops any remaining work.
+
+    """
+    window_list = list(window_list)
+    pending = Queue.Queue()
+    completed = Queue.Queue()
+    stop = threading.Event()
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None or stop.is_set():
+                return
+            index, window = item
+            try:
+                completed.put((index, fetch(window), None))
+            except Exception as e:
+                completed.put((index, None, e))
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def dispatch(next_dispatch, consumed):
+        """Dispatch windows up to the bound, returns next to dispatch"""
+        limit = min(consumed + 2 * workers, len(window_list))
+        while next_dispatch < limit:
+            pending.put((next_dispatch, window_list[next_dispatch]))
+            next_dispatch += 1
+        return next_dispatch
+
+    next_dispatch = dispatch(0, 0)
+    buffered = {}
+    consumed = 0
+    try:
+        for _ in range(len(window_list)):
+            index, rows, error = completed.get()
+            if error is not None:
+                raise error
+            if ordered:
+                buffered[index] = rows
+                while consumed in buffered:
+                    for row in buffered.pop(consumed):
+                        yield row
+                    consumed += 1
+            else:
+                for row in rows:
+                    yield row
+                consumed += 1
+            next_dispatch = dispatch(next_dispatch, consumed)
+    finally:
+        stop.set()
+        for thread in threads:
+            pending.put(None)
+
+
+def scan(engine, start, end, column='admit_datetime',
+         window=timedelta(days=1), workers=4, ordered=False, columns=None):
+    """Scan visits within [start, end) of the named datetime column
+
+    :param engine: warehouse engine; its connection pool should allow
+      `workers` concurrent connections (the default pool size is 5)
+    :param start: inclusive datetime
+    :param end: exclusive datetime
+    :param column: scan column, one of `SCAN_COLUMNS`
+    :param window: timedelta size of each window
+    :param workers: number of windows queried concurrently
+    :param ordered: generate rows in scan column order if set,
+      otherwise as windows complete
+    :param columns: optional list of columns to select, see
+      `visit_query`
+
+    Generates result rows.
+
+    """
+    if column not in SCAN_COLUMNS:
+        raise ValueError("unsupported scan column '%s', use one of %s" %
+                         (column, ', '.join(sorted(SCAN_COLUMNS))))
+
+    def fetch(window):
+        lo, hi = window
+        connection = engine.connect()
+        try:
+            return connection.execute(
+                visit_query(column, lo, hi, columns)).fetchall()
+        finally:
+            connection.close()
+
+    return parallel_windows(fetch, windows(start, end, window),
+                            workers=workers, ordered=ordered)
@@ -0,0 +1,76 @@
+"""Keyword search of the free text columns
+
+Syndrome classification matches keywords against
+hl7_visit.chief_complaint and hl7_dx.dx_description.  Unindexed,
+`ILIKE '%cough%'` scans every row.  When the warehouse was created
+with a text index (see `tables.create_text_indexes` and the
+[warehouse]text_index config value), the queries generated here are
+shaped to use it:
+
+- 'trigram' searches match substrings via ILIKE, served by the
+  pg_trgm GIN indexes
+- 'fulltext' searches match (stemmed) words via the tsvector GIN
+  indexes, i.e. 'coughing' matches 'cough'
+
+"""
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import literal_column
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import union
+
+from pheme.warehouse.tables import TEXT_SEARCH_COLUMNS
+from pheme.warehouse.tables import TSVECTOR_EXPRESSION
+
+
+def like_pattern(term):
+    """Returns ILIKE pattern matching term as a literal substring"""
+    for special in ('\\', '%', '_'):
+        term = term.replace(special, '\\' + special)
+    return '%' + term + '%'
+
+
+def term_criteria(table, column, term, method):
+    """Returns criteria matching one term on the table's column"""
+    if method == 'trigram':
+        return table.c[column].ilike(like_pattern(term))
+    if method == 'fulltext':
+        return literal_column(TSVECTOR_EXPRESSION % column).op('@@')(
+            func.plainto_tsquery(literal_column("'english'"), term))
+    raise ValueError("unknown search method '%s'" % method)
+
+
+def search_query(terms, method='trigram', match_all=False,
+                 columns=TEXT_SEARCH_COLUMNS):
+    """Select the hl7_msh_ids with free text matching the terms
+
+    :param terms: sequence of keywords, such as the terms defining a
+      syndrome
+    :param method: 'trigram' or 'fulltext', to match the text index
+      built at table creation
+    :param match_all: require every term (within the same column
+      value) rather than any term
+    :param columns: sequence of (table, column name) to search
+
+    """
+    if not terms:
+        raise ValueError("at least one search term required")
+    combine = and_ if match_all else or_
+    selects = []
+    for table, column in columns:
+        criteria = [term_criteria(table, column, term, method)
+                    for term in terms]
+        selects.append(select([table.c.hl7_msh_id], combine(*criteria)))
+    return union(*selects)
+
+
+def search(connection, terms, method='trigram', match_all=False,
+           columns=TEXT_SEARCH_COLUMNS):
+    """Returns sorted list of hl7_msh_ids matching the terms
+
+    See `search_query` for the parameters.
+
+    """
+    query = search_query(terms, method, match_all, columns)
+    return sorted(row[0] for row in connection.execute(query))
@@ -0,0 +1,126 @@
+"""Selection of warehouse messages for bulk maintenance operations
+
+Maintenance commands (such as reprocessing) act on a set of hl7_msh
+rows, named by batch_filename, message_datetime window and/or
+hl7_msh_id range.  This module provides the shared argument handling
+and query generation.
+
+"""
+from datetime import datetime
+
+from sqlalchemy import and_
+from sqlalchemy import select
+
+from pheme.warehouse.tables import hl7Msh_table
+
+
+def parse_datetime(value):
+    """argparse type for datetime arguments
+
+    Accepts 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'
+
+    """
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("unrecognized datetime format '%s'" % value)
+
+
+def add_selection_arguments(parser):
+    """Add the message selection arguments to an ArgumentParser"""
+    parser.add_argument("--batch_filename", dest="batch_filenames",
+                        action="append", default=[],
+                        help="select messages from named batch file "
+                        "(may be repeated)")
+    parser.add_argument("--since", type=parse_datetime,
+                        help="select messages with message_datetime on "
+                        "or after ('YYYY-MM-DD[ HH:MM:SS]')")
+    parser.add_argument("--until", type=parse_datetime,
+                        help="select messages with message_datetime "
+                        "before ('YYYY-MM-DD[ HH:MM:SS]')")
+    parser.add_argument("--first_msh_id", type=int,
+                        help="select messages with hl7_msh_id >= value")
+    parser.add_argument("--last_msh_id", type=int,
+                        help="select messages with hl7_msh_id <= value")
+
+
+class MessageSelection(object):
+    """Criteria naming a set of hl7_msh rows
+
+    All given criteria must match (i.e. they are AND'd).  At least one
+    criterion is required, to prevent accidental operations on the
+    entire warehouse.
+
+    """
+    def __init__(self, batch_filenames=None, since=None, until=None,
+                 first_msh_id=None, last_msh_id=None):
+        self.batch_filenames = batch_filenames or []
+        self.since = since
+        self.until = until
+        self.first_msh_id = first_msh_id
+        self.last_msh_id = last_msh_id
+        if not self.criteria():
+            raise ValueError("at least one selection criterion required")
+
+    @classmethod
+    def from_args(cls, args):
+        """Construct from parsed `add_selection_arguments` arguments"""
+        return cls(batch_filenames=args.batch_filenames,
+                   since=args.since, until=args.until,
+                   first_msh_id=args.first_msh_id,
+                   last_msh_id=args.last_msh_id)
+
+    def __str__(self):
+        described = []
+        if self.batch_filenames:
+            described.append("batch_filename in (%s)" %
+                             ', '.join(self.batch_filenames))
+        if self.since:
+            described.append("message_datetime >= %s" % self.since)
+        if self.until:
+            described.append("message_datetime < %s" % self.until)
+        if self.first_msh_id is not None:
+            described.append("hl7_msh_id >= %d" % self.first_msh_id)
+        if self.last_msh_id is not None:
+            described.append("hl7_msh_id <= %d" % self.last_msh_id)
+        return ' and '.join(described)
+
+    def criteria(self):
+        """Returns list of SQL criteria on the hl7_msh table"""
+        msh = hl7Msh_table.c
+        criteria = []
+        if self.batch_filenames:
+            criteria.append(msh.batch_filename.in_(self.batch_filenames))
+        if self.since:
+            criteria.append(msh.message_datetime >= self.since)
+        if self.until:
+            criteria.append(msh.message_datetime < self.until)
+        if self.first_msh_id is not None:
+            criteria.append(msh.hl7_msh_id >= self.first_msh_id)
+        if self.last_msh_id is not None:
+            criteria.append(msh.hl7_msh_id <= self.last_msh_id)
+        return criteria
+
+    def where(self):
+        """Returns the combined SQL criteria on the hl7_msh table"""
+        return and_(*self.criteria())
+
+    def msh_ids(self, connection):
+        """Returns ordered list of the selected hl7_msh_id values"""
+        query = select([hl7Msh_table.c.hl7_msh_id], self.where()).\
+            order_by(hl7Msh_table.c.hl7_msh_id)
+        return [row[0] for row in connection.execute(query)]
+
+
+def chunked(sequence, size):
+    """Generate successive lists of at most `size` items"""
+    chunk = []
+    for item in sequence:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
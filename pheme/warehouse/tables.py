@@ -14,16 +14,24 @@ Try `%prog --help` for more information.
 
 import sys
 import getpass
+import hashlib
+from sqlalchemy import and_
 from sqlalchemy import create_engine
+from sqlalchemy import BigInteger
 from sqlalchemy import BOOLEAN
 from sqlalchemy import CHAR as Char
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import FetchedValue
 from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import func
 from sqlalchemy import UniqueConstraint 
 from sqlalchemy import Integer
 from sqlalchemy import MetaData
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import Sequence
 from sqlalchemy import SMALLINT
 from sqlalchemy import Table
 from sqlalchemy import text
@@ -32,6 +40,7 @@ from sqlalchemy import VARCHAR
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm import relation
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import synonym
 
 from pheme.util.config import Config
 from pheme.util.util import stringFields
@@ -39,11 +48,33 @@ from pheme.util.util import stringFields
 
 metadata = MetaData()
 
+
+def hash_key(value):
+    """Compact 64 bit key for a long identifier string
+
+    The first 64 bits of the MD5 digest, as a signed integer.  Matches
+    the database function hl7_hash_key(), see `HASH_KEY_DDL`.  Keys
+    may collide, always verify against the string (see
+    `visit_criteria`).
+
+    """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    key = int(hashlib.md5(value).hexdigest()[:16], 16)
+    if key >= 1 << 63:
+        key -= 1 << 64
+    return key
+
 """
 TABLE hl7_raw_message
 
 Contains all HL7 messages in raw form, with only the
 message_control_id extracted.
+
+Once archived (see `pheme.warehouse.archive`) raw_data is NULL, and
+the archive_segment and archive_offset locate the compressed copy.
 """
 hl7RawMessage_table = Table(
     'hl7_raw_message', metadata,
@@ -53,7 +84,9 @@ hl7RawMessage_table = Table(
     Column('message_control_id', VARCHAR(255), nullable=False,
            index=True, unique=True),
     Column('raw_data', TEXT, nullable=True),
-    Column('import_time', TEXT))
+    Column('import_time', TEXT),
+    Column('archive_segment', VARCHAR(255), nullable=True),
+    Column('archive_offset', BigInteger, nullable=True))
 
 
 class HL7_RawMessage(object):
@@ -65,7 +98,25 @@ class HL7_RawMessage(object):
         
     def __repr__(self):
         return '<HL7_RawMessage %s>' % self.hl7_raw_message_id
-mapper(HL7_RawMessage, hl7RawMessage_table)
+
+    def _get_raw_data(self):
+        """Returns raw_data, falling back to the archive if moved"""
+        if self._raw_data is None and self.archive_segment:
+            from pheme.warehouse.archive import RawArchive
+            return RawArchive().lookup(self.message_control_id,
+                                       self.archive_segment,
+                                       self.archive_offset)
+        return self._raw_data
+
+    def _set_raw_data(self, raw_data):
+        self._raw_data = raw_data
+
+mapper(HL7_RawMessage, hl7RawMessage_table,
+       properties={'_raw_data': hl7RawMessage_table.c.raw_data,
+                   'raw_data': synonym('_raw_data',
+                                       descriptor=property(
+                                           HL7_RawMessage._get_raw_data,
+                                           HL7_RawMessage._set_raw_data))})
     
 """
 TABLE hl7_msh
@@ -90,8 +141,9 @@ hl7Msh_table = Table(
            index=True),
     Column('message_type', VARCHAR(255), nullable=False),
     Column('facility', VARCHAR(255), nullable=False),
-    Column('message_datetime', DateTime, nullable=False),
-    Column('batch_filename', VARCHAR(255), nullable=False))
+    Column('message_datetime', DateTime, nullable=False, index=True),
+    Column('batch_filename', VARCHAR(255), nullable=False,
+           index=True))
 
 class HL7_Msh(object):
     def __init__(self, hl7_msh_id, message_control_id,
@@ -113,6 +165,10 @@ TABLE hl7_visit
         
 Contains a row for every HL7 message related to a visit
 
+visit_key and patient_key hold `hash_key` values of visit_id and
+patient_id, maintained by a trigger (see `HASH_KEY_DDL`).  Join and
+group on the keys, verifying the strings to rule out collisions.
+
 """
 hl7Visit_table = Table(
     'hl7_visit', metadata,
@@ -143,6 +199,8 @@ hl7Visit_table = Table(
     Column('state', Char(2), default=None, nullable=True),
     Column('discharge_datetime', DateTime, default=None, nullable=True,
            index=True),
+    Column('visit_key', BigInteger, nullable=True, index=True),
+    Column('patient_key', BigInteger, nullable=True, index=True),
     )
 
 class HL7_Visit(object):
@@ -175,6 +233,8 @@ class HL7_Visit(object):
         self.assigned_patient_location = assigned_patient_location
         self.state = state
         self.discharge_datetime = discharge_datetime
+        self.visit_key = hash_key(visit_id)
+        self.patient_key = hash_key(patient_id)
         
     def __repr__(self):
         return '<HL7_Visit %s>' % self.hl7_visit_id
@@ -200,7 +260,9 @@ hl7Dx_table = Table(
     Column('hl7_msh_id', ForeignKey('hl7_msh.hl7_msh_id',
                                     ondelete='CASCADE'),
            nullable=False, index=True),
-    Column('rank', SMALLINT, default=0, nullable=False))
+    Column('rank', SMALLINT, default=0, nullable=False),
+    Column('fingerprint', BigInteger, FetchedValue(), FetchedValue(
+        for_update=True), nullable=True, index=True))
 
 class HL7_Dx(object):
     def __init__(self, hl7_dx_id, dx_code=None,
@@ -222,7 +284,11 @@ class HL7_Dx(object):
         Diagnosis)
 
         """
-        return stringFields((self.dx_code,self.dx_type))
+        return stringFields(self.compare_fields())
+
+    def compare_fields(self):
+        """The fields compared, see `compare_str` and `fingerprint`"""
+        return (self.dx_code, self.dx_type)
 
 mapper(HL7_Dx, hl7Dx_table)
 
@@ -268,6 +334,8 @@ hl7Obx_table = Table(
     Column('alt_abnorm_id', TEXT, nullable=True),
     Column('alt_abnorm_text', TEXT, nullable=True),
     Column('alt_abnorm_coding', TEXT, nullable=True),
+    Column('fingerprint', BigInteger, FetchedValue(), FetchedValue(
+        for_update=True), nullable=True, index=True),
     )
 
 class HL7_Obx(object):
@@ -323,15 +391,19 @@ class HL7_Obx(object):
         use in comparisons w/ similar types. (i.e. HL7_Obx & Obx)
 
         """
+        return stringFields(self.compare_fields())
+
+    def compare_fields(self):
+        """The fields compared, see `compare_str` and `fingerprint`"""
         # Boolean logic for the value of hl7_obr_id - its value
         # would naturally be different between the two types.
-        return stringFields((self.hl7_obr_id and 't' or 'f', 
-                         self.value_type,
-                         self.observation_id,
-                         self.observation_text,
-                         self.observation_result,
-                         self.units,
-                         self.result_status)) 
+        return (self.hl7_obr_id and 't' or 'f',
+                self.value_type,
+                self.observation_id,
+                self.observation_text,
+                self.observation_result,
+                self.units,
+                self.result_status)
 
 mapper(HL7_Obx, hl7Obx_table)
 
@@ -351,7 +423,7 @@ hl7Obr_table = Table(
     Column('observation_datetime', DateTime, default=None, nullable=True),
     Column('hl7_msh_id', ForeignKey('hl7_msh.hl7_msh_id',
                                     ondelete='CASCADE'),
-           nullable=False),
+           nullable=False, index=True),
     Column('status', Char(1), default=None, nullable=True),
     Column('report_datetime', DateTime, default=None, nullable=True),
     Column('specimen_source', VARCHAR(20), default=None,
@@ -359,7 +431,9 @@ hl7Obr_table = Table(
     Column('filler_order_no', TEXT, nullable=True),
     Column('coding', TEXT, nullable=True,),
     Column('alt_code', TEXT, nullable=True,),
-    Column('alt_coding', TEXT, nullable=True,)
+    Column('alt_coding', TEXT, nullable=True,),
+    Column('fingerprint', BigInteger, FetchedValue(), FetchedValue(
+        for_update=True), nullable=True, index=True)
     )
 
 class HL7_Obr(object):
@@ -391,9 +465,13 @@ class HL7_Obr(object):
         use in comparisons w/ similar types. (i.e. HL7_Obr & Obr)
 
         """
+        return stringFields(self.compare_fields())
+
+    def compare_fields(self):
+        """The fields compared, see `compare_str` and `fingerprint`"""
         # When we get a loinc_code, we also get loinc_text - don't
         # need both in comparisons.
-        return stringFields((self.loinc_code, self.alt_text))
+        return (self.loinc_code, self.alt_text)
 
 mapper(HL7_Obr, hl7Obr_table,
        properties={'obxes' : relation(HL7_Obx)})
@@ -450,7 +528,7 @@ hl7Spm_table = Table(
     Column('code', VARCHAR(20), default=None, nullable=False),
     Column('hl7_obr_id', ForeignKey('hl7_obr.hl7_obr_id',
                                     ondelete='CASCADE'),
-           nullable=False), 
+           nullable=False, index=True),
     )
 
 class HL7_Spm(object):
@@ -468,6 +546,42 @@ class HL7_Spm(object):
 
 mapper(HL7_Spm, hl7Spm_table)
 
+"""Data quality check results
+
+One row per rule, per run of `warehouse_dq`, covering the messages
+with hl7_msh_id in (first_msh_id, last_msh_id].  See
+`pheme.warehouse.dq`.
+
+"""
+dqResult_table = Table(
+    'dq_result', metadata,
+    Column('dq_result_id', Integer, primary_key=True),
+    Column('run_datetime', DateTime, nullable=False, index=True),
+    Column('rule', VARCHAR(64), nullable=False, index=True),
+    Column('first_msh_id', Integer, nullable=False),
+    Column('last_msh_id', Integer, nullable=False),
+    Column('checked', Integer, nullable=False),
+    Column('failures', Integer, nullable=False),
+    Column('examples', TEXT, nullable=True),
+    )
+
+class DQ_Result(object):
+    def __init__(self, run_datetime, rule, first_msh_id, last_msh_id,
+                 checked, failures, examples=None):
+        self.run_datetime = run_datetime
+        self.rule = rule
+        self.first_msh_id = first_msh_id
+        self.last_msh_id = last_msh_id
+        self.checked = checked
+        self.failures = failures
+        self.examples = examples
+
+    def __repr__(self):
+        return '<DQ_Result %s %s>' % (self.rule, self.dq_result_id)
+
+
+mapper(DQ_Result, dqResult_table)
+
 class ObservationData(object):
     """Secondary mapper to make association access easy
 
@@ -506,7 +620,310 @@ mapper(FullMessage, hl7Msh_table,
                                         HL7_Spm.hl7_obr_id))))
 """
     
-def create_tables(user, password, dbname, enable_delete=False):
+HASH_KEY_DDL = ("""
+CREATE OR REPLACE FUNCTION hl7_hash_key(value TEXT) RETURNS BIGINT AS $$
+    SELECT ('x' || substr(md5($1), 1, 16))::bit(64)::bigint
+$$ LANGUAGE sql IMMUTABLE STRICT""", """
+CREATE OR REPLACE FUNCTION hl7_visit_keys() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.visit_key := hl7_hash_key(NEW.visit_id);
+    NEW.patient_key := hl7_hash_key(NEW.patient_id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS hl7_visit_keys ON hl7_visit",
+    "CREATE TRIGGER hl7_visit_keys BEFORE INSERT OR UPDATE OF visit_id, "
+    "patient_id ON hl7_visit FOR EACH ROW EXECUTE PROCEDURE "
+    "hl7_visit_keys()")
+
+
+# Per table, the SQL expressions of the `compare_fields` values
+FINGERPRINT_FIELDS = {
+    'hl7_dx': ('dx_code', 'dx_type'),
+    'hl7_obr': ('loinc_code', 'alt_text'),
+    'hl7_obx': ("CASE WHEN coalesce(hl7_obr_id, 0) = 0 THEN 'f' "
+                "ELSE 't' END", 'value_type', 'observation_id',
+                'observation_text', 'observation_result', 'units',
+                'result_status'),
+}
+
+FINGERPRINT_SEPARATOR = '\x1f'
+
+
+def fingerprint(values):
+    """Fingerprint of a `compare_fields` tuple
+
+    `hash_key` of the values joined by the ASCII unit separator, None
+    treated as empty (as `compare_str` does).  Equal for rows with
+    equal `compare_str`, so matching may be done on the indexed
+    fingerprint columns, or with sets of fingerprints, rather than by
+    building strings per object.  Being 64 bits, distinct rows may
+    (very rarely) share a fingerprint.
+
+    """
+    return hash_key(FINGERPRINT_SEPARATOR.join(
+        u'' if value is None else unicode(value) for value in values))
+
+
+def fingerprint_sql(table_name, encoded=()):
+    """SQL computing the fingerprint from the NEW row in a trigger
+
+    :param encoded: names of dictionary encoded columns (see
+      `pheme.warehouse.normalized`) to look up in hl7_text
+
+    """
+    fields = []
+    for field in FINGERPRINT_FIELDS[table_name]:
+        if field in encoded:
+            field = "(SELECT value FROM hl7_text WHERE text_id = "\
+                "NEW.%s_id)" % field
+        elif field.startswith('CASE'):
+            field = field.replace('hl7_obr_id', 'NEW.hl7_obr_id')
+        else:
+            field = 'NEW.' + field
+        fields.append("coalesce(%s::TEXT, '')" % field)
+    return "hl7_hash_key(%s)" % " || E'\\x1f' || ".join(fields)
+
+
+def create_fingerprint_triggers(engine, normalized=False):
+    """(Re)create the triggers maintaining the fingerprint columns
+
+    Requires the hl7_hash_key() function, see `create_key_triggers`.
+
+    """
+    # Deferred import, the normalized module builds on this one
+    from pheme.warehouse.normalized import NORMALIZED_COLUMNS
+    from pheme.warehouse.normalized import store_name
+    for table_name in sorted(FINGERPRINT_FIELDS):
+        encoded = NORMALIZED_COLUMNS[table_name] if normalized else ()
+        target = store_name(table_name) if normalized else table_name
+        statements = ("""
+CREATE OR REPLACE FUNCTION %(table)s_fingerprint() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.fingerprint := %(expression)s;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql""",
+            "DROP TRIGGER IF EXISTS %(table)s_fingerprint ON %(target)s",
+            "CREATE TRIGGER %(table)s_fingerprint BEFORE INSERT OR UPDATE "
+            "ON %(target)s FOR EACH ROW EXECUTE PROCEDURE "
+            "%(table)s_fingerprint()")
+        substitutions = {'table': table_name, 'target': target,
+                         'expression': fingerprint_sql(table_name,
+                                                       encoded)}
+        for statement in statements:
+            engine.execute(text(statement % substitutions).
+                           execution_options(autocommit=True))
+
+
+def backfill_fingerprints(engine, chunk_size=10000):
+    """Compute missing fingerprints, generating (table, rows updated)
+
+    The update fires the fingerprint trigger.  Each chunk is its own
+    transaction.
+
+    """
+    for table in (hl7Dx_table, hl7Obr_table, hl7Obx_table):
+        pk = list(table.primary_key.columns)[0]
+        missing = select([pk], table.c.fingerprint == None).\
+            limit(chunk_size)
+        while True:
+            result = engine.execute(table.update().where(
+                pk.in_(missing)).values(fingerprint=None))
+            if not result.rowcount:
+                break
+            yield table.name, result.rowcount
+
+
+def create_key_triggers(engine):
+    """(Re)create the trigger maintaining the hl7_visit hash keys"""
+    for statement in HASH_KEY_DDL:
+        engine.execute(text(statement).execution_options(autocommit=True))
+
+
+def backfill_keys(engine, chunk_size=10000):
+    """Compute missing hl7_visit hash keys, generating rows updated
+
+    For rows loaded before the key columns existed.  Each chunk is
+    its own transaction.
+
+    """
+    visit = hl7Visit_table.c
+    missing = select([visit.hl7_visit_id], or_(
+        visit.visit_key == None, visit.patient_key == None)).\
+        limit(chunk_size)
+    while True:
+        result = engine.execute(hl7Visit_table.update().where(
+            visit.hl7_visit_id.in_(missing)).values(
+                visit_key=func.hl7_hash_key(visit.visit_id),
+                patient_key=func.hl7_hash_key(visit.patient_id)))
+        if not result.rowcount:
+            break
+        yield result.rowcount
+
+
+def visit_criteria(visit_id, table=hl7Visit_table):
+    """Criteria selecting the visit by key, verified on the string"""
+    return and_(table.c.visit_key == hash_key(visit_id),
+                table.c.visit_id == visit_id)
+
+
+def patient_criteria(patient_id, table=hl7Visit_table):
+    """Criteria selecting the patient by key, verified on the string"""
+    return and_(table.c.patient_key == hash_key(patient_id),
+                table.c.patient_id == patient_id)
+
+
+def same_visit(left, right):
+    """Join criteria for two hl7_visit aliases sharing a visit
+
+    Compares the indexed keys first; the string comparison only
+    applies to key matches, guarding against collisions.
+
+    """
+    return and_(left.c.visit_key == right.c.visit_key,
+                left.c.visit_id == right.c.visit_id)
+
+
+def same_patient(left, right):
+    """Join criteria for two hl7_visit aliases sharing a patient"""
+    return and_(left.c.patient_key == right.c.patient_key,
+                left.c.patient_id == right.c.patient_id)
+
+
+def engine_url(user, password, dbname):
+    """Returns the SQLAlchemy URL for the named (localhost) database"""
+    return "postgresql://%s:%s@localhost/%s" % (user, password, dbname)
+
+
+def derived_row_criteria(msh_ids):
+    """Criteria naming all rows hanging off the given hl7_msh rows
+
+    :param msh_ids: sequence of hl7_msh_id values, or a select
+      statement producing them
+
+    Returns list of (table, criteria) pairs, ordered from the leaf
+    tables upward, i.e. the order safe for deletes.
+
+    """
+    if not hasattr(msh_ids, 'c'):
+        msh_ids = list(msh_ids)
+    obr_ids = select([hl7Obr_table.c.hl7_obr_id],
+                     hl7Obr_table.c.hl7_msh_id.in_(msh_ids))
+    obx_ids = select([hl7Obx_table.c.hl7_obx_id],
+                     hl7Obx_table.c.hl7_msh_id.in_(msh_ids))
+    return [
+        (hl7Nte_table, or_(hl7Nte_table.c.hl7_obx_id.in_(obx_ids),
+                           hl7Nte_table.c.hl7_obr_id.in_(obr_ids))),
+        (hl7Spm_table, hl7Spm_table.c.hl7_obr_id.in_(obr_ids)),
+        (hl7Obx_table, hl7Obx_table.c.hl7_msh_id.in_(msh_ids)),
+        (hl7Obr_table, hl7Obr_table.c.hl7_msh_id.in_(msh_ids)),
+        (hl7Dx_table, hl7Dx_table.c.hl7_msh_id.in_(msh_ids)),
+        (hl7Visit_table, hl7Visit_table.c.hl7_msh_id.in_(msh_ids)),
+        ]
+
+
+def delete_derived_rows(connection, msh_ids):
+    """Delete all rows hanging off the given hl7_msh rows
+
+    Deletes proceed from the leaf tables upward in set based
+    statements, rather than relying on the row by row cascades.  The
+    hl7_msh rows themselves are left in place.
+
+    :param connection: database connection, with any transaction
+      in the caller's control
+    :param msh_ids: sequence of hl7_msh_id values
+
+    Returns dictionary of deleted row counts keyed by table name.
+
+    """
+    counts = {}
+    for table, criteria in derived_row_criteria(msh_ids):
+        result = connection.execute(table.delete().where(criteria))
+        counts[table.name] = result.rowcount
+    return counts
+
+
+def sequence_names(tables):
+    """Returns names of the sequences backing the tables' primary keys
+
+    Explicit `Sequence` defaults are named as such, otherwise follows
+    the PostgreSQL SERIAL naming, `<table>_<column>_seq`.
+
+    """
+    names = []
+    for table in tables:
+        for column in table.primary_key.columns:
+            if isinstance(column.default, Sequence):
+                names.append(column.default.name)
+            elif isinstance(column.type, Integer) and column.autoincrement:
+                names.append('%s_%s_seq' % (table.name, column.name))
+    return names
+
+
+def grant_privileges(engine, user, tables=None, enable_delete=False):
+    """Grant the user access to the tables and their sequences
+
+    SELECT, INSERT and UPDATE (plus DELETE if enable_delete is set)
+    on the tables.  Sequences also require UPDATE.
+
+    :param engine: engine connected as a user able to grant
+    :param user: the database user to bless
+    :param tables: the tables to grant on, all of `metadata` by default
+
+    """
+    if tables is None:
+        tables = metadata.sorted_tables
+    engine.execute("""BEGIN; GRANT SELECT, INSERT, UPDATE %(delete)s ON
+                   %(tables)s TO %(user)s; COMMIT;""" %
+                   {'delete': ", DELETE" if enable_delete else '',
+                    'tables': ', '.join(table.name for table in tables),
+                    'user': user})
+    sequences = sequence_names(tables)
+    if sequences:
+        engine.execute("""BEGIN; GRANT SELECT, UPDATE ON %(sequences)s
+                       TO %(user)s; COMMIT;""" %
+                       {'sequences': ', '.join(sequences), 'user': user})
+
+
+# Free text columns searched by keyword, see `pheme.warehouse.search`
+TEXT_SEARCH_COLUMNS = ((hl7Visit_table, 'chief_complaint'),
+                       (hl7Dx_table, 'dx_description'))
+
+# Full text indexes are on this expression, which queries must repeat
+# verbatim for the planner to use the index
+TSVECTOR_EXPRESSION = "to_tsvector('english', coalesce(%s, ''))"
+
+
+def create_text_indexes(engine, kind, columns=TEXT_SEARCH_COLUMNS):
+    """Build indexes for keyword searches of TEXT_SEARCH_COLUMNS
+
+    :param engine: engine connected as the table owner
+    :param kind: 'trigram' for pg_trgm GIN indexes, which serve
+      `ILIKE '%term%'` substring matches, or 'fulltext' for GIN
+      indexes on the english tsvector of each column, which serve
+      word (stemmed) matches
+    :param columns: sequence of (table, column name) to index
+
+    The trigram option requires the pg_trgm extension be available.
+
+    """
+    if kind == 'trigram':
+        engine.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        template = "CREATE INDEX ix_%(table)s_%(column)s_trgm ON "\
+            "%(table)s USING gin (%(column)s gin_trgm_ops)"
+    elif kind == 'fulltext':
+        template = "CREATE INDEX ix_%(table)s_%(column)s_tsv ON "\
+            "%(table)s USING gin ((" + TSVECTOR_EXPRESSION % \
+            "%(column)s" + "))"
+    else:
+        raise ValueError("unknown text index kind '%s'" % kind)
+    for table, column in columns:
+        engine.execute(template % {'table': table.name, 'column': column})
+
+
+def create_tables(user, password, dbname, enable_delete=False,
+                  text_index=None, normalized=False):
     """Create the warehouse database tables.
 
     NB the config [warehouse]database_user is granted SELECT and 
@@ -516,42 +933,40 @@ def create_tables(user, password, dbname, enable_delete=False):
     :param password: the database password
     :param dbname: the database name to populate
     :param enable_delete: testing hook, override for testing needs
+    :param text_index: optional 'trigram' or 'fulltext', to build
+      the keyword search indexes (see `create_text_indexes`)
+    :param normalized: create the dictionary encoded schema, see
+      `pheme.warehouse.normalized`
 
     """
-    engine = create_engine("postgresql://%s:%s@localhost/%s" %\
-                               (user, password, dbname))
+    # Deferred import, the normalized module builds on this one
+    from pheme.warehouse import normalized as normalized_schema
+
+    engine = create_engine(engine_url(user, password, dbname))
+    normalized_schema.drop_normalized(engine)
     metadata.drop_all(bind=engine)
-    metadata.create_all(bind=engine)
-
-    def bless_user(user):
-        engine.execute("""BEGIN; GRANT SELECT, INSERT, UPDATE %(delete)s ON
-                       hl7_raw_message,
-                       hl7_msh,
-                       hl7_visit,
-                       hl7_dx,
-                       hl7_obr,
-                       hl7_obx,
-                       hl7_nte,
-                       hl7_spm TO %(user)s;
-                       COMMIT;""" % {'delete': ", DELETE" 
-                                     if enable_delete else '',
-                                     'user': user});
-        # Sequences also require UPDATE
-        engine.execute("""BEGIN; GRANT SELECT, UPDATE ON
-                       hl7_dx_hl7_dx_id_seq,
-                       hl7_msh_hl7_msh_id_seq,
-                       hl7_obr_hl7_obr_id_seq,
-                       hl7_obx_hl7_obx_id_seq,
-                       hl7_nte_hl7_nte_id_seq,
-                       hl7_spm_hl7_spm_id_seq,
-                       hl7_raw_message_hl7_raw_message_id_seq,
-                       hl7_visit_hl7_visit_id_seq TO %(user)s; COMMIT;""" %
-                       {'user': user});
 
     # Bless the mirth user with the minimal set of privileges
     # Mirth only SELECTs and INSERTs at this time
-
-    bless_user(Config().get('warehouse', 'database_user'))
+    database_user = Config().get('warehouse', 'database_user')
+
+    text_columns = TEXT_SEARCH_COLUMNS
+    if normalized:
+        normalized_schema.create_normalized(engine, database_user,
+                                            enable_delete=enable_delete)
+        # Encoded text is indexed once, in the dictionary
+        text_columns = [(t, c) for t, c in TEXT_SEARCH_COLUMNS if c not in
+                        normalized_schema.NORMALIZED_COLUMNS.get(t.name, ())]
+        text_columns.append((normalized_schema.normalized_metadata().
+                             tables[normalized_schema.TEXT_TABLE], 'value'))
+    else:
+        metadata.create_all(bind=engine)
+        grant_privileges(engine, database_user,
+                         enable_delete=enable_delete)
+    create_key_triggers(engine)
+    create_fingerprint_triggers(engine, normalized)
+    if text_index:
+        create_text_indexes(engine, text_index, text_columns)
 
 
 def main():  # pragma: no cover
@@ -568,7 +983,10 @@ def main():  # pragma: no cover
     user = config.get('warehouse', 'create_table_user')
     print "password for PostgreSQL user:", user
     password = getpass.getpass()
-    create_tables(user, password, dbname)
+    from pheme.warehouse.normalized import normalized_mode
+    create_tables(user, password, dbname,
+                  text_index=config.get('warehouse', 'text_index'),
+                  normalized=normalized_mode(config))
 
 
 if __name__ == '__main__':  # pragma: no cover
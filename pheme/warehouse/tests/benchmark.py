@@ -0,0 +1,258 @@
+"""Differential throughput benchmark, Mirth channels vs native ingester
+
+Feeds the same test batch files (see `MirthInteraction`) through the
+Mirth Connect channels and through the in-process
+`pheme.warehouse.ingest.ingest_batchfile`, each into a freshly created
+warehouse, and records for each path:
+
+- elapsed seconds and messages per second
+- rows and rows per second, per warehouse table
+- peak resident memory, of the Mirth Connect java process (peak since
+  Mirth started) or of the process running the native ingester
+- database round trips.  Counted per statement for the native
+  ingester; for Mirth, whose channels autocommit every statement, the
+  growth of the database transaction count (pg_stat_database) is
+  reported instead
+
+The two resulting warehouses are then compared row for row, using the
+per-message content hashes of `pheme.warehouse.diff`, plus the row
+counts of every table.
+
+Results are appended as a single line of JSON to the output file, for
+trend tracking across runs.
+
+Project setup.py defines the `benchmark_ingest` entry point.
+
+"""
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import select
+
+from pheme.util.config import Config
+from pheme.warehouse.diff import warehouse_hashes
+from pheme.warehouse.ingest import ingest_batchfile
+from pheme.warehouse.normalized import normalized_mode
+from pheme.warehouse.normalized import TextDictionary
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import metadata
+from pheme.warehouse.tests.process_testfiles import MirthInteraction
+from pheme.warehouse.tests.test_warehousedb import setup_module
+
+
+# Differing message_control_ids listed in the results, at most
+MAX_LISTED = 100
+
+
+def warehouse_engine():
+    """Engine for the configured warehouse, as the Mirth database user"""
+    config = Config()
+    return create_engine(engine_url(
+        config.get('warehouse', 'database_user'),
+        config.get('warehouse', 'database_password'),
+        config.get('warehouse', 'database')))
+
+
+def count_round_trips(engine):
+    """Count the statements engine sends to the database
+
+    Returns a single item list, holding the running count.
+
+    """
+    count = [0]
+
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany):
+        count[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    return count
+
+
+def table_rows(connection):
+    """Returns dictionary of row count by warehouse table name"""
+    return dict((table.name, connection.execute(
+        select([func.count()]).select_from(table)).scalar())
+        for table in metadata.sorted_tables)
+
+
+def database_transactions(connection):
+    """Returns the server's count of transactions on this database
+
+    The statistics collector reports with some delay, allow for it.
+
+    """
+    time.sleep(1)
+    connection.execute("SELECT pg_stat_clear_snapshot()")
+    return connection.execute(
+        "SELECT xact_commit + xact_rollback FROM pg_stat_database "
+        "WHERE datname = current_database()").scalar()
+
+
+def mirth_peak_rss():
+    """Returns peak RSS in kB of the Mirth Connect process, if found"""
+    try:
+        pid = subprocess.check_output(
+            ['pgrep', '-f', r'com\.mirth\.connect']).split()[0]
+        with open('/proc/%s/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (subprocess.CalledProcessError, IndexError, IOError):
+        pass
+    return None
+
+
+def _native_worker(filenames):
+    """Run the native ingester over the files, in a child process"""
+    engine = warehouse_engine()
+    round_trips = count_round_trips(engine)
+    dictionary = TextDictionary(engine) if normalized_mode() else None
+    connection = engine.connect()
+    start = time.time()
+    try:
+        for filename in filenames:
+            ingest_batchfile(connection, filename, dictionary)
+    finally:
+        connection.close()
+    return time.time() - start, round_trips[0]
+
+
+def run_native(filenames):
+    """Ingest the files in process, returns partial run results
+
+    The ingester runs in a child process, so the peak RSS measured
+    covers the ingest alone.
+
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        elapsed, round_trips = pool.apply(_native_worker, (filenames,))
+    finally:
+        pool.close()
+        pool.join()
+    # Linux reports ru_maxrss in kB
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'elapsed_seconds': elapsed, 'round_trips': round_trips,
+            'peak_rss_kb': peak_rss}
+
+
+def run_mirth(mirth_interaction, connection):
+    """Feed the files through Mirth, returns partial run results"""
+    transactions = database_transactions(connection)
+    completed = mirth_interaction.feed_batchfiles()
+    return {'elapsed_seconds': sum(result['seconds']
+                                   for result in completed),
+            'round_trips':
+            database_transactions(connection) - transactions,
+            'peak_rss_kb': mirth_peak_rss()}
+
+
+def complete_run(results, connection):
+    """Add message and row rates to a run's results
+
+    Returns the content hashes of the resulting warehouse.
+
+    """
+    rows = table_rows(connection)
+    elapsed = results['elapsed_seconds'] or 1e-9
+    results['messages'] = rows['hl7_msh']
+    results['messages_per_second'] = rows['hl7_msh'] / elapsed
+    results['rows'] = rows
+    results['rows_per_second'] = dict(
+        (table, count / elapsed) for table, count in rows.items())
+    return warehouse_hashes(connection)
+
+
+def compare_runs(runs, hashes):
+    """Row for row comparison of the mirth and native warehouses"""
+    mirth, native = hashes['mirth'], hashes['native']
+    differing = sorted(control_id for control_id in
+                       set(mirth) | set(native)
+                       if mirth.get(control_id) != native.get(control_id))
+    row_mismatches = dict(
+        (table, [count, runs['native']['rows'].get(table)])
+        for table, count in runs['mirth']['rows'].items()
+        if count != runs['native']['rows'].get(table))
+    return {'match': not (differing or row_mismatches),
+            'differing_messages': len(differing),
+            'differing_control_ids': differing[:MAX_LISTED],
+            'row_count_mismatches': row_mismatches}
+
+
+def benchmark(skip_mirth=False):
+    """Run the benchmark, returns the results dictionary"""
+    mirth_interaction = MirthInteraction()
+    filenames = mirth_interaction.filenames
+    runs, hashes = {}, {}
+    paths = ('native',) if skip_mirth else ('mirth', 'native')
+    for path in paths:
+        if path == 'mirth':
+            mirth_interaction.prepare_filesystem()
+        else:
+            setup_module()
+        engine = warehouse_engine()
+        connection = engine.connect()
+        try:
+            if path == 'mirth':
+                runs[path] = run_mirth(mirth_interaction, connection)
+            else:
+                runs[path] = run_native(filenames)
+            hashes[path] = complete_run(runs[path], connection)
+        finally:
+            connection.close()
+            engine.dispose()
+
+    results = {'timestamp': datetime.now().isoformat(),
+               'batch_files': len(filenames),
+               'normalized': normalized_mode(),
+               'runs': runs}
+    if not skip_mirth:
+        results['verification'] = compare_runs(runs, hashes)
+    return results
+
+
+def benchmark_ingest():
+    """Entry point to benchmark Mirth against the native ingester"""
+    ap = argparse.ArgumentParser(description="feed the test batch files "
+                                 "through Mirth and the native ingester, "
+                                 "comparing throughput and results.  "
+                                 "DESTROYS the configured warehouse "
+                                 "database contents")
+    ap.add_argument("-o", "--output", default="ingest_benchmark.json",
+                    help="file to append the JSON results to")
+    ap.add_argument("--skip_mirth", action='store_true',
+                    help="benchmark the native ingester only")
+    args = ap.parse_args()
+
+    if Config().get('general', 'in_production'):  # pragma: no cover
+        raise RuntimeError("DO NOT run destructive test on production system")
+
+    results = benchmark(args.skip_mirth)
+    with open(args.output, 'a') as output:
+        output.write(json.dumps(results, sort_keys=True) + os.linesep)
+
+    for path, run in sorted(results['runs'].items()):
+        print "%s: %d messages in %.1f seconds (%.1f msgs/sec), "\
+            "%s round trips, peak RSS %s kB" % (
+                path, run['messages'], run['elapsed_seconds'],
+                run['messages_per_second'], run['round_trips'],
+                run['peak_rss_kb'])
+    if 'verification' in results:
+        verification = results['verification']
+        if verification['match']:
+            print "warehouses match row for row"
+        else:
+            print "warehouses DIFFER: %d messages, row counts %s" % (
+                verification['differing_messages'],
+                verification['row_count_mismatches'])
+    print "results appended to", args.output
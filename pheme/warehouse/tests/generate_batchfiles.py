@@ -0,0 +1,363 @@
+"""Generate synthetic HL7 batch files for scale and load testing
+
+The scrubbed test set (see `MirthInteraction`) holds a few thousand
+messages.  `BatchGenerator` produces any number of realistic (though
+entirely fictional) messages of the types the channels handle:
+
+- ADT^A03, ADT^A04 and ADT^A08, with PID, PV1, PV2, OBX (patient age)
+  and a configurable number of DG1 segments
+- ORU^R01, with a configurable number of OBR groups, each holding
+  OBX, NTE and SPM segments
+
+Visit ids are placed either as MBDS messages send them (PID-18 with
+the assigning authority) or as Meaningful Use messages do (PV1-19 with
+the authority, PID-18 holding the bare account number).  Configurable
+fractions of messages repeat a recent message_control_id, or carry a
+malformed MSH-7 timestamp, to exercise the duplicate filter and the
+datetime error handling.
+
+Messages are generated and written one at a time from a seeded random
+source, so memory use is flat, runs are repeatable and tens of
+millions of messages are only limited by disk space.
+
+Project setup.py defines the `generate_hl7_batchfiles` entry point.
+
+"""
+import argparse
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+import os
+import random
+
+
+MESSAGE_TYPES = ('ADT^A03', 'ADT^A04', 'ADT^A08', 'ORU^R01')
+
+# MSH-9.3 message structure by type
+STRUCTURES = {'ADT^A03': 'ADT_A03', 'ADT^A04': 'ADT_A01',
+              'ADT^A08': 'ADT_A01', 'ORU^R01': 'ORU_R01'}
+
+FACILITIES = ('1134567890', '1245678901', '1356789012', '1467890123',
+              '1578901234')
+
+AUTHORITIES = ('2.16.840.1.113883.3.1001', '2.16.840.1.113883.3.1002',
+               '2.16.840.1.113883.3.1003')
+
+PATIENT_CLASSES = ('E', 'I', 'O')
+
+CHIEF_COMPLAINTS = ('COUGH', 'FEVER', 'HEADACHE', 'ABD PAIN', 'VOMITING',
+                    'SHORTNESS OF BREATH', 'RASH', 'CHEST PAIN',
+                    'SORE THROAT', 'DIARRHEA', 'FALL', 'BACK PAIN')
+
+DIAGNOSES = (('786.2', 'COUGH'), ('780.60', 'FEVER, UNSPECIFIED'),
+             ('784.0', 'HEADACHE'), ('789.00', 'ABDOMINAL PAIN'),
+             ('787.01', 'NAUSEA WITH VOMITING'), ('786.05', 'SHORTNESS '
+                                                  'OF BREATH'),
+             ('782.1', 'RASH'), ('786.50', 'CHEST PAIN, UNSPECIFIED'),
+             ('462', 'ACUTE PHARYNGITIS'), ('787.91', 'DIARRHEA'),
+             ('487.1', 'INFLUENZA WITH OTHER RESPIRATORY MANIFESTATIONS'))
+
+DX_TYPES = ('A^Admitting^HL70052', 'W^Working^HL70052',
+            'F^Final^HL70052')
+
+ORDERS = (('625-4', 'Bacteria identified in Stool by Culture'),
+          ('600-7', 'Bacteria identified in Blood by Culture'),
+          ('34487-9', 'Influenza virus A Ag in Nasopharynx'),
+          ('5876-2', 'Influenza virus A RNA in Specimen'))
+
+OBSERVATIONS = (('11475-1', 'Microorganism identified', 'CE',
+                 ('Escherichia coli', 'Salmonella sp', 'No growth')),
+                ('5182-1', 'Influenza virus A Ag', 'CE',
+                 ('Positive', 'Negative')),
+                ('6463-4', 'Bacteria identified', 'CE',
+                 ('Staphylococcus aureus', 'Streptococcus pneumoniae')))
+
+SPECIMENS = (('119297000', 'Blood specimen'), ('119339001', 'Stool '
+                                                'specimen'),
+             ('258500001', 'Nasopharyngeal swab'))
+
+NOTES = ('Specimen received in lab', 'Result confirmed by reference lab',
+         'Reported to public health')
+
+# Formats that datetime_for_sql (and the channels) must reject
+MALFORMED_TIMESTAMPS = ('%Y-%m-%d %H:%M', '%Y%m%d', '%Y%m%d%H%M%S.%f',
+                        '%m/%d/%Y %H%M')
+
+
+def timestamp(value):
+    """HL7 DTM, to the second"""
+    return value.strftime('%Y%m%d%H%M%S')
+
+
+def segment(name, fields):
+    """Build segment text from a dictionary of field values
+
+    Keys are the HL7 field numbers (for MSH, numbered from MSH-3 as
+    MSH-1 and MSH-2 hold the separators).
+
+    """
+    values = [''] * max(fields)
+    for index, value in fields.items():
+        values[index - 1] = value
+    if name == 'MSH':
+        return 'MSH|^~\\&|' + '|'.join(values[2:])
+    return '|'.join([name] + values)
+
+
+def count_range(value):
+    """argparse type for a segment count, 'N' or 'MIN-MAX'"""
+    low, _, high = value.partition('-')
+    low, high = int(low), int(high or low)
+    if low < 0 or high < low:
+        raise argparse.ArgumentTypeError("invalid count range '%s'" % value)
+    return low, high
+
+
+class BatchGenerator(object):
+    """Generates synthetic HL7 messages
+
+    :param seed: random seed, the same seed and parameters generate
+      the same messages
+    :param message_types: sequence of types to pick from, with equal
+      weight (repeat a type to weight it), see `MESSAGE_TYPES`
+    :param dg1: (min, max) DG1 segments per ADT message
+    :param obr: (min, max) OBR groups per ORU message
+    :param obx: (min, max) OBX segments per OBR group
+    :param nte: (min, max) NTE segments following each OBR and OBX
+    :param spm: (min, max) SPM segments per OBR group
+    :param mu_fraction: fraction of messages placing the visit id as
+      MU messages do, the remainder follow MBDS
+    :param duplicate_rate: fraction of messages reusing a recently
+      generated message_control_id
+    :param malformed_rate: fraction of messages with a malformed MSH-7
+    :param start: datetime of the first message; message times
+      advance a few seconds per message
+
+    """
+    def __init__(self, seed=0, message_types=MESSAGE_TYPES, dg1=(0, 3),
+                 obr=(1, 2), obx=(1, 3), nte=(0, 1), spm=(0, 1),
+                 mu_fraction=0.5, duplicate_rate=0.0, malformed_rate=0.0,
+                 start=datetime(2012, 1, 1)):
+        for message_type in message_types:
+            if message_type not in STRUCTURES:
+                raise ValueError("unsupported message type '%s'" %
+                                 message_type)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.message_types = tuple(message_types)
+        self.dg1, self.obr, self.obx = dg1, obr, obx
+        self.nte, self.spm = nte, spm
+        self.mu_fraction = mu_fraction
+        self.duplicate_rate = duplicate_rate
+        self.malformed_rate = malformed_rate
+        self.now = start
+        self.generated = 0
+        self._recent = deque(maxlen=1000)
+
+    def _count(self, bounds):
+        return self.random.randint(*bounds)
+
+    def _control_id(self):
+        if self._recent and self.random.random() < self.duplicate_rate:
+            return self.random.choice(self._recent)
+        control_id = 'SYN.%d.%d' % (self.seed, self.generated)
+        self._recent.append(control_id)
+        return control_id
+
+    def _message_datetime(self):
+        if self.random.random() < self.malformed_rate:
+            return self.now.strftime(
+                self.random.choice(MALFORMED_TIMESTAMPS))
+        return timestamp(self.now)
+
+    def _visit_segments(self, event):
+        """Returns the PID, PV1 and PV2 segments for a visit"""
+        pick = self.random.choice
+        authority = pick(AUTHORITIES)
+        patient = str(self.random.randint(100000, 999999))
+        visit = str(self.random.randint(100000, 999999))
+        admit = self.now - timedelta(minutes=self.random.randint(5, 600))
+        dob = admit - timedelta(days=self.random.randint(0, 36500))
+        pid = {1: '1', 3: '%s^^^&%s&ISO^MR' % (patient, authority),
+               7: dob.strftime('%Y%m%d'), 8: pick('MFU'),
+               10: '2106-3^White^HL70005',
+               11: '^^^WA^%05d^USA^^^%03d' % (
+                   self.random.randint(98001, 99403),
+                   self.random.randint(1, 77))}
+        pv1 = {1: '1', 2: pick(PATIENT_CLASSES),
+               3: pick(('ED', 'ICU', 'MED', '')),
+               10: pick(('EME', 'MED', 'SUR', '')),
+               14: pick(('1', '2', '7', '')),
+               44: timestamp(admit)}
+        if self.random.random() < self.mu_fraction:
+            pid[18] = visit
+            pv1[19] = '%s^^^&%s&ISO^VN' % (visit, authority)
+        else:
+            pid[18] = '%s^^^&%s&ISO^' % (visit, authority)
+        if event == 'A03':
+            pv1[36] = pick(('01', '02', '07', '20'))
+            pv1[45] = timestamp(self.now)
+        pv2 = {3: '^' + pick(CHIEF_COMPLAINTS)}
+        return [segment('PID', pid), segment('PV1', pv1),
+                segment('PV2', pv2)]
+
+    def _msh(self, message_type):
+        facility = self.random.choice(FACILITIES)
+        return segment('MSH', {
+            3: 'SYNTHETIC^%s^ISO' % AUTHORITIES[0],
+            4: 'Facility %s^%s^NPI' % (facility[-3:], facility),
+            7: self._message_datetime(),
+            9: '%s^%s' % (message_type, STRUCTURES[message_type]),
+            10: self._control_id(), 11: 'P', 12: '2.5.1'})
+
+    def _notes(self):
+        return [segment('NTE', {1: str(i + 1), 3: self.random.choice(NOTES)})
+                for i in range(self._count(self.nte))]
+
+    def _adt(self, message_type):
+        event = message_type.split('^')[1]
+        segments = [self._msh(message_type),
+                    segment('EVN', {1: event, 2: timestamp(self.now)})]
+        segments.extend(self._visit_segments(event))
+        segments.append(segment('OBX', {
+            1: '1', 2: 'NM', 3: '21612-7^Age Time Patient Reported^LN',
+            5: str(self.random.randint(0, 99)), 6: 'a^Years^UCUM', 11: 'F'}))
+        for rank in range(self._count(self.dg1)):
+            code, description = self.random.choice(DIAGNOSES)
+            segments.append(segment('DG1', {
+                1: str(rank + 1), 3: '%s^%s^I9' % (code, description),
+                5: timestamp(self.now), 6: self.random.choice(DX_TYPES)}))
+        return segments
+
+    def _oru(self, message_type):
+        pick = self.random.choice
+        segments = [self._msh(message_type)]
+        segments.extend(self._visit_segments('R01')[:2])
+        observed = timestamp(self.now - timedelta(hours=6))
+        for index in range(self._count(self.obr)):
+            code, text = pick(ORDERS)
+            specimen = pick(SPECIMENS)
+            segments.append(segment('OBR', {
+                1: str(index + 1),
+                3: 'F%d.%d' % (self.generated, index),
+                4: '%s^%s^LN' % (code, text), 7: observed,
+                15: '&&&%s&%s&L' % (specimen[0], specimen[1]),
+                22: timestamp(self.now), 25: pick(('F', 'P', 'C'))}))
+            segments.extend(self._notes())
+            for sequence in range(self._count(self.obx)):
+                code, text, value_type, results = pick(OBSERVATIONS)
+                segments.append(segment('OBX', {
+                    1: str(sequence + 1), 2: value_type,
+                    3: '%s^%s^LN' % (code, text), 4: str(sequence + 1),
+                    5: pick(results), 8: pick(('A^Abnormal^HL70078', '')),
+                    11: 'F', 14: observed,
+                    15: '^^^%s' % pick(FACILITIES)}))
+                segments.extend(self._notes())
+            for sequence in range(self._count(self.spm)):
+                segments.append(segment('SPM', {
+                    1: str(sequence + 1),
+                    4: '%s^%s^SCT' % pick(SPECIMENS)}))
+        return segments
+
+    def message(self):
+        """Returns the next message, segments joined by carriage returns"""
+        message_type = self.random.choice(self.message_types)
+        if message_type.startswith('ADT'):
+            segments = self._adt(message_type)
+        else:
+            segments = self._oru(message_type)
+        self.generated += 1
+        self.now += timedelta(seconds=self.random.randint(1, 10))
+        return '\r'.join(segments)
+
+    def messages(self, count):
+        """Generate count messages"""
+        for _ in xrange(count):
+            yield self.message()
+
+
+def write_batchfile(path, messages):
+    """Write messages as an HL7 batch file, one segment per line
+
+    Returns the number of messages written.
+
+    """
+    count = 0
+    now = timestamp(datetime.now())
+    with open(path, 'w') as batchfile:
+        batchfile.write('FHS|^~\\&|SYNTHETIC||||%s\n' % now)
+        batchfile.write('BHS|^~\\&|SYNTHETIC||||%s\n' % now)
+        for message in messages:
+            batchfile.write(message.replace('\r', '\n'))
+            batchfile.write('\n')
+            count += 1
+        batchfile.write('BTS|%d\n' % count)
+        batchfile.write('FTS|1\n')
+    return count
+
+
+def generate_batchfiles(directory, total, per_file, generator,
+                        prefix='synthetic'):
+    """Write total messages from generator, per_file to a file
+
+    Generates the path of each batch file as it is completed.
+
+    """
+    written = index = 0
+    while written < total:
+        count = min(per_file, total - written)
+        path = os.path.join(directory, '%s-%06d.hl7' % (prefix, index))
+        written += write_batchfile(path, generator.messages(count))
+        index += 1
+        yield path
+
+
+def generate_hl7_batchfiles():
+    """Entry point to write synthetic HL7 batch files"""
+    ap = argparse.ArgumentParser(description="generate synthetic HL7 "
+                                 "batch files for scale testing")
+    ap.add_argument("directory", help="directory to write batch files to")
+    ap.add_argument("-n", "--messages", type=int, default=10000,
+                    help="total number of messages")
+    ap.add_argument("--per_file", type=int, default=1000,
+                    help="number of messages per batch file")
+    ap.add_argument("--seed", type=int, default=0,
+                    help="random seed, for repeatable output")
+    ap.add_argument("--types", default=','.join(MESSAGE_TYPES),
+                    help="comma separated message types to generate, "
+                    "repeat a type to weight it")
+    for name, default in (('dg1', '0-3'), ('obr', '1-2'), ('obx', '1-3'),
+                          ('nte', '0-1'), ('spm', '0-1')):
+        ap.add_argument("--" + name, type=count_range,
+                        default=count_range(default),
+                        help="%s segments per %s, as N or MIN-MAX "
+                        "(default %s)" % (
+                            name.upper(), 'ADT message' if name == 'dg1'
+                            else 'ORU message' if name == 'obr' else
+                            'OBR group', default))
+    ap.add_argument("--mu_fraction", type=float, default=0.5,
+                    help="fraction of messages with the visit id placed "
+                    "per MU (PV1-19), the rest per MBDS (PID-18)")
+    ap.add_argument("--duplicate_rate", type=float, default=0.0,
+                    help="fraction of messages reusing a recent "
+                    "message_control_id")
+    ap.add_argument("--malformed_rate", type=float, default=0.0,
+                    help="fraction of messages with a malformed "
+                    "message timestamp")
+    args = ap.parse_args()
+
+    try:
+        generator = BatchGenerator(
+            seed=args.seed, message_types=args.types.split(','),
+            dg1=args.dg1, obr=args.obr, obx=args.obx, nte=args.nte,
+            spm=args.spm, mu_fraction=args.mu_fraction,
+            duplicate_rate=args.duplicate_rate,
+            malformed_rate=args.malformed_rate)
+    except ValueError as e:
+        ap.error(str(e))
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    for path in generate_batchfiles(args.directory, args.messages,
+                                    args.per_file, generator):
+        print "wrote", path
+    print "generated %d messages" % generator.generated
@@ -7,9 +7,25 @@ import shutil
 import subprocess
 import time
 
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import select
+
 from pheme.util.config import Config
 from pheme.util.pg_access import FilesystemPersistence
+from pheme.warehouse.ingest import ingest_batchfile
+from pheme.warehouse.normalized import normalized_mode
+from pheme.warehouse.normalized import TextDictionary
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tests import snapshot
 from pheme.warehouse.tests.test_warehousedb import setup_module
+from pheme.warehouse.tests.workers import provision_worker_database
+from pheme.warehouse.tests.workers import worker_database
 
 def require_mirth():
     """Check process space for running instance of Mirth Connect"""
@@ -43,11 +59,15 @@ def copy_file_to_dir(file, dir, as_user):
 
 class MirthInteraction(object):
     """Abstraction to interact with Mirth Connect for testing"""
-    WAIT_INTERVAL = 15
+    WAIT_INTERVAL = 0.25
     TIMEOUT = 300
+    SETTLE = 5
+    WRITER_TABLES = (hl7Msh_table, hl7Visit_table, hl7Dx_table,
+                     hl7Obr_table, hl7Obx_table)
 
     def __init__(self):
         self.config = Config()
+        self.replayed = False
 
         # obtain list of files to process
         path = os.path.abspath(
@@ -68,44 +88,212 @@ class MirthInteraction(object):
                               mirth_user)
 
 
+    def warehouse_engine(self):
+        """Engine for the warehouse, as the config database_user
+
+        Connects to this test worker's copy when running in parallel,
+        see `pheme.warehouse.tests.workers`.
+
+        """
+        return create_engine(engine_url(
+            self.config.get('warehouse', 'database_user'),
+            self.config.get('warehouse', 'database_password'),
+            worker_database(self.config)))
+
+    def replay_batchfiles(self):
+        """Load the testfiles in process - no Mirth required
+
+        Creates a clean database, and runs the Python port of the
+        channel logic (`pheme.warehouse.ingest.ingest_batchfile`) over
+        the testfiles, in name order.
+
+        The result never went through the channels, so is not to be
+        persisted as if it had, see `persist_database`.
+
+        """
+        setup_module()
+        self.replayed = True
+        engine = self.warehouse_engine()
+        dictionary = TextDictionary(engine) if normalized_mode() else None
+        connection = engine.connect()
+        try:
+            for batchfile in sorted(self.filenames):
+                ingest_batchfile(connection, batchfile, dictionary)
+        finally:
+            connection.close()
+            engine.dispose()
+
     def process_batchfiles(self):
         """Feed the testfiles to mirth - block till done"""
         self.prepare_filesystem()
+        self.feed_batchfiles()
+
+    def feed_batchfiles(self):
+        """Copy the testfiles to the Mirth input_dir - block till done
+
+        Requires a prepared filesystem, see `prepare_filesystem`.
+
+        Each batch file is done when Mirth moves it to the output or
+        error dir; the directories are checked every WAIT_INTERVAL
+        seconds.  The channel writer destinations queue their inserts
+        though, so after the last file lands this also waits for the
+        writers to drain, see `wait_for_writers`, and the last file's
+        seconds run till its final rows were written.  Reports
+        progress as each file completes, and a per file throughput
+        summary (messages from the hl7_msh rows by batch_filename) at
+        the end.
+
+        Returns list of dictionaries, one per completed batch file, in
+        completion order, see `throughput`.
+
+        """
         require_mirth()
+        output_dir = self.config.get('warehouse', 'output_dir')
+        error_dir = self.config.get('warehouse', 'error_dir')
+        seen = set(os.listdir(output_dir)) | set(os.listdir(error_dir))
+        start = last_time = time.time()
         for batchfile in self.filenames:
-            copy_file_to_dir(batchfile, 
+            copy_file_to_dir(batchfile,
                              self.config.get('warehouse', 'input_dir'),
                              self.config.get('mirth', 'mirth_system_user'))
 
-        # wait for all files to appear in error our output dirs
-        # providing occasional output and raising if we appear hung
-        last_count = 0
-        last_time = time.time()
-        output_dir = self.config.get('warehouse', 'output_dir')
-        error_dir = self.config.get('warehouse', 'error_dir')
-        while last_count < len(self.filenames):
-            time.sleep(self.WAIT_INTERVAL)
-            count = len(os.listdir(output_dir)) + len(os.listdir(error_dir))
-            if count > last_count:
-                last_count = count
-                last_time = time.time()
+        # wait for all files to appear in error or output dirs,
+        # reporting each as it lands and raising if we appear hung
+        completed = []
+        while len(completed) < len(self.filenames):
+            for directory in (output_dir, error_dir):
+                for name in sorted(set(os.listdir(directory)) - seen):
+                    seen.add(name)
+                    now = time.time()
+                    completed.append({'batch_file': name,
+                                      'error': directory == error_dir,
+                                      'seconds': now - last_time})
+                    last_time = now
+                    print "Mirth processed %s%s (%d of %d)" % (
+                        name, ' INTO ERROR DIR' if
+                        directory == error_dir else '', len(completed),
+                        len(self.filenames))
+            if len(completed) >= len(self.filenames):
+                break
             if time.time() - self.TIMEOUT > last_time:
                 raise RuntimeError("TIMEOUT exceeded waiting on Mirth")
-            print "Waiting on mirth to process files...(%d of %d)" %\
-                (last_count, len(self.filenames))
+            time.sleep(self.WAIT_INTERVAL)
+
+        if completed:
+            completed[-1]['seconds'] += self.wait_for_writers() - last_time
+        self.throughput(completed)
+        print "Mirth processed %d files in %.1f seconds" % (
+            len(completed), time.time() - start)
+        return completed
+
+    def row_counts(self, engine):
+        """Returns the row count of each of the WRITER_TABLES"""
+        return [engine.execute(select([func.count()]).select_from(
+            table)).scalar() for table in self.WRITER_TABLES]
+
+    def wait_for_writers(self):
+        """Block till the channel writers stop adding rows
+
+        Polls the row counts of the WRITER_TABLES every WAIT_INTERVAL
+        seconds, returning once they held steady for SETTLE seconds.
+        Raises if they are still changing after TIMEOUT seconds.
+
+        Returns the time the counts last changed.
+
+        """
+        engine = self.warehouse_engine()
+        try:
+            start = changed = time.time()
+            counts = self.row_counts(engine)
+            while time.time() - changed < self.SETTLE:
+                if time.time() - self.TIMEOUT > start:
+                    raise RuntimeError("TIMEOUT exceeded waiting on the "
+                                       "Mirth channel writers")
+                time.sleep(self.WAIT_INTERVAL)
+                latest = self.row_counts(engine)
+                if latest != counts:
+                    counts, changed = latest, time.time()
+        finally:
+            engine.dispose()
+        print "Mirth channel writers done, %d messages" % counts[0]
+        return changed
+
+    def throughput(self, completed):
+        """Add per file message counts and rates, printing a summary
+
+        Sets 'messages' (hl7_msh rows with the file's batch_filename)
+        and 'messages_per_second' (over the time since the previous
+        file completed) on each completed file dictionary.
+
+        """
+        engine = self.warehouse_engine()
+        msh = hl7Msh_table.c
+        try:
+            counts = dict(engine.execute(select(
+                [msh.batch_filename, func.count()]).group_by(
+                msh.batch_filename)).fetchall())
+        finally:
+            engine.dispose()
+        for result in completed:
+            result['messages'] = counts.get(result['batch_file'], 0)
+            result['messages_per_second'] = result['messages'] / \
+                max(result['seconds'], 1e-3)
+            print "  %-30s %7d messages %8.1f msgs/sec" % (
+                result['batch_file'], result['messages'],
+                result['messages_per_second'])
 
     def persist_database(self):
-        """Write the database contents to disk"""
+        """Write the database contents to disk, and snapshot it
+
+        The snapshot is a template database, see
+        `pheme.warehouse.tests.snapshot`.
+
+        Refuses to persist data loaded by `replay_batchfiles`, lest
+        later runs test the channels against data they never
+        produced.
+
+        """
+        if self.replayed:
+            raise RuntimeError("Won't persist replayed test data as "
+                               "the product of the Mirth channels")
         fsp = FilesystemPersistence(\
             database=self.config.get('warehouse', 'database'),
             user=self.config.get('warehouse', 'database_user'),
             password=self.config.get('warehouse', 'database_password'))
         fsp.persist()
+        snapshot.create_snapshot(
+            self.config.get('warehouse', 'create_table_user'),
+            self.config.get('warehouse', 'create_table_password'),
+            self.config.get('warehouse', 'database'),
+            snapshot.content_hash(self.filenames))
 
     def restore_database(self):
-        """Pull previously persisted data into database"""
+        """Pull previously persisted data into database
+
+        Clones the template database snapshot when present, falling
+        back to the (slow) restore of the persistence file otherwise.
+        Raises if the snapshot was built from other batch files,
+        channels or table definitions than the current ones.  Restores
+        into this test worker's copy when running in parallel.
+
+        """
+        user = self.config.get('warehouse', 'create_table_user')
+        password = self.config.get('warehouse', 'create_table_password')
+        database = self.config.get('warehouse', 'database')
+        target = provision_worker_database(self.config)
+        digest = snapshot.content_hash(self.filenames)
+        stored = snapshot.snapshot_hash(user, password, database)
+        if stored is not None:
+            if stored != digest:
+                raise snapshot.StaleSnapshotError(
+                    "Persisted test database is stale, rerun "
+                    "'process_testfiles_via_mirth'")
+            snapshot.clone_snapshot(user, password, database, digest,
+                                    target=target)
+            return
+
         fsp = FilesystemPersistence(\
-            database=self.config.get('warehouse', 'database'),
+            database=target,
             user=self.config.get('warehouse', 'database_user'),
             password=self.config.get('warehouse', 'database_password'))
         fsp.restore()
@@ -130,10 +318,18 @@ def process_testfiles_via_mirth():
                     help="simply write persistence file "
                     "as the database stands, i.e. do NOT (re-)process "
                     "the testfiles")
+    ap.add_argument("--replay", action='store_true',
+                    help="load the testfiles in process rather than "
+                    "via Mirth, for ad hoc use; NOT persisted")
     args = ap.parse_args()
+    if args.replay and (args.persist or args.restore):
+        ap.error("--replay can't be combined with --persist or --restore")
 
     # still here implies a run - let MirthInteraction do the work
     mi = MirthInteraction()
+    if args.replay:
+        mi.replay_batchfiles()
+        return
     if not (args.persist or args.restore):
         mi.process_batchfiles()
     if args.restore:
@@ -0,0 +1,138 @@
+"""Snapshots of the processed test warehouse as a template database
+
+Restoring the persisted warehouse dump takes far longer than the
+tests using it.  Instead, after processing the test batch files, the
+warehouse is copied to a PostgreSQL template database
+(`<database>_template`), and each test run clones it with `CREATE
+DATABASE ... TEMPLATE`, a file level copy taking seconds.
+
+A snapshot is only valid for the inputs that produced it.  The
+content hash of the test batch files, the channel definitions and the
+table DDL is stored as the template database's comment; a clone is
+refused when it no longer matches, rather than silently testing stale
+data.
+
+Database level statements require a user with CREATEDB, the config
+[warehouse]create_table_user, and no other sessions on the source
+database.
+
+"""
+import glob
+import hashlib
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from pheme.warehouse.tables import engine_url
+from pheme.warehouse.tables import metadata
+
+
+COMMENT_PREFIX = 'pheme warehouse snapshot '
+
+CHANNEL_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           '../../../channels'))
+
+
+class StaleSnapshotError(RuntimeError):
+    """The template database doesn't match the current inputs"""
+
+
+def template_name(database):
+    return database + '_template'
+
+
+def content_hash(batchfiles, channel_dir=CHANNEL_DIR):
+    """Returns hex digest over the inputs determining warehouse content
+
+    Covers the named batch files, the channel (and code template)
+    XML files and the DDL of the warehouse tables.
+
+    """
+    digest = hashlib.sha1()
+    paths = sorted(batchfiles) + sorted(glob.glob(os.path.join(
+        channel_dir, '*.xml')))
+    for path in paths:
+        digest.update(os.path.basename(path) + '\0')
+        with open(path, 'rb') as content:
+            for block in iter(lambda: content.read(1 << 16), ''):
+                digest.update(block)
+    dialect = postgresql.dialect()
+    for table in metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)))
+    return digest.hexdigest()
+
+
+def execute_autocommit(user, password, statements):
+    """Run statements outside a transaction, via the postgres database"""
+    engine = create_engine(engine_url(user, password, 'postgres'))
+    connection = engine.raw_connection()
+    try:
+        connection.set_isolation_level(0)  # autocommit
+        cursor = connection.cursor()
+        results = []
+        for statement, parameters in statements:
+            cursor.execute(statement, parameters)
+            results.append(cursor.fetchall() if cursor.description
+                           else None)
+        cursor.close()
+        return results
+    finally:
+        connection.close()
+        engine.dispose()
+
+
+def terminate_sessions(database):
+    """Statement ending other sessions on the database"""
+    return ("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            "WHERE datname = %(database)s AND pid <> pg_backend_pid()",
+            {'database': database})
+
+
+def snapshot_hash(user, password, database):
+    """Returns the content hash stored with the template, or None"""
+    rows = execute_autocommit(user, password, [(
+        "SELECT shobj_description(oid, 'pg_database') FROM pg_database "
+        "WHERE datname = %(template)s",
+        {'template': template_name(database)})])[0]
+    if not rows or not rows[0][0] or \
+            not rows[0][0].startswith(COMMENT_PREFIX):
+        return None
+    return rows[0][0][len(COMMENT_PREFIX):]
+
+
+def create_snapshot(user, password, database, digest):
+    """Replace the template database with a copy of database"""
+    template = template_name(database)
+    execute_autocommit(user, password, [
+        terminate_sessions(database),
+        ('DROP DATABASE IF EXISTS "%s"' % template, None),
+        ('CREATE DATABASE "%s" TEMPLATE "%s"' % (template, database),
+         None),
+        ('COMMENT ON DATABASE "%s" IS %%(comment)s' % template,
+         {'comment': COMMENT_PREFIX + digest})])
+
+
+def clone_snapshot(user, password, database, digest, target=None):
+    """Recreate database as a clone of its template
+
+    :param target: name of the database to (re)create, defaults to
+      database itself; such as a per test worker copy
+
+    Raises `StaleSnapshotError` if the template is missing or was
+    built from other inputs than those hashing to digest.
+
+    """
+    stored = snapshot_hash(user, password, database)
+    if stored != digest:
+        raise StaleSnapshotError(
+            "template database %s %s" % (
+                template_name(database), 'missing' if stored is None else
+                'is stale (inputs changed since it was built)'))
+    target = target or database
+    execute_autocommit(user, password, [
+        terminate_sessions(target),
+        ('DROP DATABASE IF EXISTS "%s"' % target, None),
+        ('CREATE DATABASE "%s" TEMPLATE "%s"' % (
+            target, template_name(database)), None)])
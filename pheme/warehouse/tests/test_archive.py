@@ -0,0 +1,78 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy import select
+
+from pheme.warehouse.archive import archive
+from pheme.warehouse.archive import epoch_millis
+from pheme.warehouse.archive import RawArchive
+from pheme.warehouse.archive import restore
+from pheme.warehouse.tables import hl7RawMessage_table
+
+
+class TestRawArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        archive = RawArchive(self.directory)
+        first = archive.append([('id1', 'MSH|^~\&|one\rPID|1'),
+                                ('id2', 'MSH|^~\&|two')])
+        second = archive.append([('id3', u'MSH|^~\&|three \xe9')])
+        self.assertEquals(first[0], second[0])
+        self.assertTrue(second[1] > first[1])
+
+        # fresh instance, to bypass the block cache
+        archive = RawArchive(self.directory)
+        self.assertEquals(archive.lookup('id1', *first),
+                          'MSH|^~\&|one\rPID|1')
+        self.assertEquals(archive.lookup('id2', *first), 'MSH|^~\&|two')
+        self.assertEquals(archive.lookup('id3', *second),
+                          u'MSH|^~\&|three \xe9')
+        self.assertEquals(archive.lookup('id3', *first), None)
+
+    def testSegmentRollover(self):
+        archive = RawArchive(self.directory, max_segment_bytes=1)
+        first = archive.append([('id1', 'one')])
+        second = archive.append([('id2', 'two')])
+        self.assertNotEquals(first[0], second[0])
+        self.assertEquals(sorted(os.listdir(self.directory)),
+                          ['raw-000001.seg', 'raw-000002.seg'])
+        self.assertEquals(archive.lookup('id2', *second), 'two')
+
+    def testRestoreMissingBlock(self):
+        engine = create_engine('sqlite://')
+        hl7RawMessage_table.create(engine)
+        connection = engine.connect()
+        imported = str(int(epoch_millis(datetime(2012, 1, 1))))
+        for raw_id in 1, 2, 3:
+            connection.execute(hl7RawMessage_table.insert(), {
+                'hl7_raw_message_id': raw_id,
+                'message_control_id': 'id%d' % raw_id,
+                'raw_data': 'MSH|%d' % raw_id, 'import_time': imported})
+        raw_archive = RawArchive(self.directory, max_segment_bytes=1)
+        self.assertEquals(list(archive(connection, raw_archive,
+                                       datetime(2013, 1, 1), block_size=1)),
+                          [1, 2, 3])
+        os.remove(os.path.join(self.directory, 'raw-000002.seg'))
+
+        missing = []
+        self.assertEquals(list(restore(connection, RawArchive(self.directory),
+                                       block_size=2, missing=missing)),
+                          [1, 2])
+        self.assertEquals(missing, ['id2'])
+        raw = hl7RawMessage_table.c
+        rows = connection.execute(select(
+            [raw.message_control_id, raw.raw_data, raw.archive_segment]).
+            order_by(raw.hl7_raw_message_id)).fetchall()
+        self.assertEquals([tuple(row) for row in rows], [
+            ('id1', 'MSH|1', None), ('id2', None, 'raw-000002.seg'),
+            ('id3', 'MSH|3', None)])
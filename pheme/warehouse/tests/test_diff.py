@@ -0,0 +1,24 @@
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from pheme.warehouse.diff import content_sql
+from pheme.warehouse.diff import message_hash_sql
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Visit_table
+
+
+def test_content_excludes_keys():
+    sql = content_sql(hl7Obx_table, 'x')
+    assert 'x.observation_text' in sql
+    for excluded in ('hl7_obx_id', 'hl7_obr_id', 'hl7_msh_id',
+                     'fingerprint'):
+        assert 'x.%s' % excluded not in sql
+    sql = content_sql(hl7Visit_table, 'v')
+    assert 'v.visit_id' in sql and 'v.visit_key' not in sql
+
+
+def test_single_parameter():
+    compiled = text(message_hash_sql()).compile(
+        dialect=postgresql.dialect())
+    assert compiled.params.keys() == ['control_ids']
+    assert '%(control_ids)s' in str(compiled)
@@ -0,0 +1,109 @@
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from pheme.warehouse.dq import DuplicateControlIdRule
+from pheme.warehouse.dq import rules
+from pheme.warehouse.dq import run_checks
+from pheme.warehouse.dq import visit_id_rule
+from pheme.warehouse.tables import dqResult_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import metadata
+
+
+def sql(query):
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+def populate(connection, first_id, control_ids, patient_classes):
+    for offset, (control_id, patient_class) in enumerate(
+            zip(control_ids, patient_classes)):
+        hl7_msh_id = first_id + offset
+        populate_msh(connection, hl7_msh_id, control_id)
+        populate_visit(connection, hl7_msh_id, patient_class)
+
+
+def populate_msh(connection, hl7_msh_id, control_id):
+    connection.execute(hl7Msh_table.insert(), {
+        'hl7_msh_id': hl7_msh_id, 'message_control_id': control_id,
+        'message_type': 'ADT^A04^ADT_A01', 'facility': '1234',
+        'message_datetime': datetime(2012, 1, 1),
+        'batch_filename': 'Rtest'})
+
+
+def populate_visit(connection, hl7_msh_id, patient_class):
+    connection.execute(hl7Visit_table.insert(), {
+        'hl7_msh_id': hl7_msh_id, 'patient_class': patient_class,
+        'visit_id': '1^^^&1.2&ISO', 'patient_id': '2^^^&1.2&ISO'})
+
+
+def test_incremental_checks():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine, tables=[hl7Msh_table, hl7Visit_table,
+                                        dqResult_table])
+    connection = engine.connect()
+    rule_list = [rule for rule in rules() if rule.name in
+                 ('patient_class_domain', 'duplicate_control_id')]
+
+    populate(connection, 1, ['a', 'b', 'c'], ['E', 'X', None])
+    results = dict((r['rule'], r) for r in run_checks(connection,
+                                                      rule_list))
+    assert results['patient_class_domain']['checked'] == 3
+    assert results['patient_class_domain']['failures'] == 1
+    assert results['patient_class_domain']['examples'] == ['X']
+    assert results['duplicate_control_id']['failures'] == 0
+
+    # nothing new, nothing checked
+    assert list(run_checks(connection, rule_list)) == []
+
+    populate(connection, 4, ['d', 'a'], ['I', 'O'])
+    results = dict((r['rule'], r) for r in run_checks(connection,
+                                                      rule_list))
+    assert results['patient_class_domain']['first_msh_id'] == 3
+    assert results['patient_class_domain']['checked'] == 2
+    assert results['patient_class_domain']['failures'] == 0
+    assert results['duplicate_control_id']['failures'] == 1
+    assert results['duplicate_control_id']['examples'] == ['a']
+
+    full = list(run_checks(connection, rule_list, full=True))
+    assert [r['checked'] for r in full] == [5, 5]
+    assert connection.execute(dqResult_table.count()).scalar() == 6
+
+
+def test_late_visit_rows():
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine, tables=[hl7Msh_table, hl7Visit_table,
+                                        dqResult_table])
+    connection = engine.connect()
+    rule_list = [rule for rule in rules() if rule.name in
+                 ('patient_class_domain', 'duplicate_control_id')]
+
+    populate(connection, 1, ['a', 'b'], ['E', 'I'])
+    # the visit row of message 3 is written after the checks run
+    populate_msh(connection, 3, 'c')
+    results = dict((r['rule'], r) for r in run_checks(connection,
+                                                      rule_list))
+    assert results['patient_class_domain']['last_msh_id'] == 2
+    assert results['duplicate_control_id']['last_msh_id'] == 3
+
+    populate_visit(connection, 3, 'X')
+    results = list(run_checks(connection, rule_list))
+    assert [r['rule'] for r in results] == ['patient_class_domain']
+    assert results[0]['first_msh_id'] == 2
+    assert results[0]['failures'] == 1
+
+
+def test_visit_id_rule():
+    rule = visit_id_rule(['&3768573961&NPI'])
+    query = sql(rule.failures_query(0, 10))
+    assert 'hl7_visit.visit_id ~' in query
+    assert 'strpos' in query
+    assert 'strpos' not in sql(visit_id_rule().failures_query(0, 10))
+
+
+def test_duplicates_span_warehouse():
+    query = sql(DuplicateControlIdRule().failures_query(5, 10))
+    assert 'HAVING count(*) >' in query
+    assert query.count('hl7_msh.hl7_msh_id >') == 1
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+from pheme.warehouse.ingest import accept_message
+from pheme.warehouse.ingest import dx_values
+from pheme.warehouse.ingest import iter_messages
+from pheme.warehouse.ingest import lab_groups
+from pheme.warehouse.ingest import Message
+from pheme.warehouse.ingest import msh_values
+from pheme.warehouse.ingest import visit_values
+from pheme.warehouse.tests.generate_batchfiles import BatchGenerator
+from pheme.warehouse.tests.generate_batchfiles import count_range
+from pheme.warehouse.tests.generate_batchfiles import generate_batchfiles
+
+
+def test_repeatable():
+    first = list(BatchGenerator(seed=3).messages(20))
+    assert first == list(BatchGenerator(seed=3).messages(20))
+    assert first != list(BatchGenerator(seed=4).messages(20))
+
+
+def test_adt_segments():
+    generator = BatchGenerator(message_types=['ADT^A03'], dg1=(2, 2))
+    for raw in generator.messages(10):
+        message = Message(raw)
+        assert accept_message(message)
+        assert message.message_type == 'ADTADT_A03'
+        assert len(dx_values(message)) == 2
+        visit = visit_values(message)
+        assert visit['disposition'] and visit['discharge_datetime']
+        assert msh_values(message, 'x')['message_datetime']
+
+
+def test_visit_id_placement():
+    for mu_fraction, field in ((1.0, ('PV1', 19)), (0.0, ('PID', 18))):
+        generator = BatchGenerator(mu_fraction=mu_fraction)
+        for raw in generator.messages(10):
+            message = Message(raw)
+            assert message.value(*field, component=4)
+            assert visit_values(message)['visit_id'].endswith('&ISO')
+
+
+def test_oru_segments():
+    generator = BatchGenerator(message_types=['ORU^R01'], obr=(2, 2),
+                               obx=(3, 3), nte=(1, 1), spm=(1, 1))
+    message = Message(generator.message())
+    groups = lab_groups(message)
+    assert len(groups) == 2
+    for group in groups:
+        assert len(group['obxes']) == 3 and len(group['notes']) == 1
+        assert len(group['spms']) == 1
+        assert all(len(notes) == 1 for _, notes in group['obxes'])
+
+
+def test_duplicates_and_malformed():
+    generator = BatchGenerator(duplicate_rate=0.5, malformed_rate=1.0)
+    messages = [Message(raw) for raw in generator.messages(200)]
+    control_ids = [m.message_control_id for m in messages]
+    assert 50 < len(control_ids) - len(set(control_ids)) < 150
+    assert not any(msh_values(m, 'x')['message_datetime']
+                   for m in messages)
+
+
+def test_batchfiles():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = list(generate_batchfiles(tmpdir, 25, 10,
+                                         BatchGenerator(seed=1)))
+        assert [os.path.basename(p) for p in paths] == [
+            'synthetic-000000.hl7', 'synthetic-000001.hl7',
+            'synthetic-000002.hl7']
+        with open(paths[0], 'rU') as batchfile:
+            messages = list(iter_messages(batchfile))
+    finally:
+        shutil.rmtree(tmpdir)
+    assert messages == list(BatchGenerator(seed=1).messages(10))
+
+
+def test_count_range():
+    assert count_range('2') == (2, 2)
+    assert count_range('0-3') == (0, 3)
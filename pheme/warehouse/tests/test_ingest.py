@@ -0,0 +1,249 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from sqlalchemy.exc import IntegrityError
+
+from pheme.warehouse.ingest import accept_message
+from pheme.warehouse.ingest import adt_obx_values
+from pheme.warehouse.ingest import datetime_for_sql
+from pheme.warehouse.ingest import dx_values
+from pheme.warehouse.ingest import ingest_batchfile
+from pheme.warehouse.ingest import iter_messages
+from pheme.warehouse.ingest import lab_groups
+from pheme.warehouse.ingest import Message
+from pheme.warehouse.ingest import msh_values
+from pheme.warehouse.ingest import visit_values
+from pheme.warehouse.metrics import IngestMetrics
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7RawMessage_table
+
+
+ADT = '\r'.join((
+    "MSH|^~\&||^8806879582^NPI|^04757.7.4174.2244.942977.0603.^ISO|"
+    "^1.380752.496.84.3.75.910260.20^ISO|32440919023142||"
+    "ADT^A08^ADT_A01|43867.91489.826194.764.6875.35|P|2.5",
+    "EVN|A08|32440919023233",
+    "PID|1||081994^^^&650903.98473.0179.6039.1.333.1&ISO||||319604|F"
+    "||||||||||093601^^^&650903.98473.0179.6039.1.333.1&ISO^",
+    "PV1|1|E^Emergency^HL70004^E^^L|||||||||||||||||||||||||||||||||"
+    "|01^Discharged to home^UB04FL17^DHR^^L||||||||32440911233335|"
+    "32440912043133",
+    "OBX|1|NM|29553-5^Calculated Patient Age^LN||97|a^Years^UCUM|||||F",
+    "DG1|1||784.0^HEADACHE^I9||32440911233335|W^Working^HL70052",
+    "DG1|2||793.99^OTH NOSP (ABN) FINDINGS RADIOLOGICAL \T\ ^I9||"
+    "32440911233335|W^Working^HL70052",
+    ))
+
+MU = '\r'.join((
+    "MSH|^~\&|1129556781^121771.21.204.4084.1851.4.288.^ISO|"
+    "Site emexhju^3768573961^NPI|||32460615083038||ADT^A03^ADT_A03|"
+    "2.6.21919.99289.858698.379.23.|T|2.5.1",
+    "PID|1||761339^^^Site emexhju&3768573961&NPI^MR||^^^^^^S|||M||"
+    "2106-3^White^HL70005|^^^^99304^^^^071|||||||358798||||U^^HL70189",
+    "PV1|1|I||||||||||||9||||I|358798^^^Site emexhju&3768573961&NPI^VN"
+    "|||||||||||||||||06||||||||32460528115833|32460530120533",
+    "PV2|||^Seizure",
+    ))
+
+ORU = '\r'.join((
+    "MSH|^~\&|lab^1.2.3^ISO|Site^1234567890^NPI|||32430418093438||"
+    "ORU^R01^ORU_R01|ctrl.oru.1|P|2.5.1",
+    "PID|1||123^^^&1.2.3&ISO||||20010101|F||||||||||456^^^&1.2.3&ISO",
+    "OBR|1||F123|610-6^Micro^LN^MIC^Culture^L|||32430418093438|||||||"
+    "|&&&BLUD&Blood&L|||||||32430418103438|||IP",
+    "NTE|1||obr note",
+    "OBX|1|CE|600-7^Bacteria identified^LN||E. coli||||||F",
+    "NTE|1||obx note",
+    "SPM|1|||119297000^Blood^SCT^^Blood specimen",
+    ))
+
+
+def test_msh_fields():
+    message = Message(ADT)
+    assert message.message_control_id == '43867.91489.826194.764.6875.35'
+    values = msh_values(message, 'Amxcfy')
+    assert values['message_type'] == 'ADT^A08^ADT_A01'
+    assert values['facility'] == '8806879582'
+    assert values['message_datetime'] == datetime(3244, 9, 19, 2, 31, 42)
+    assert values['batch_filename'] == 'Amxcfy'
+
+
+def test_accept_message():
+    assert accept_message(Message(ADT))
+    assert not accept_message(Message(ADT.replace(
+        '093601^^^&650903.98473.0179.6039.1.333.1&ISO^', '')))
+
+
+def test_datetime_for_sql():
+    assert datetime_for_sql('324409190231') == datetime(3244, 9, 19, 2, 31)
+    assert datetime_for_sql('') is None
+    assert datetime_for_sql('3244091902') is None
+
+
+def test_mbds_visit():
+    values = visit_values(Message(ADT))
+    assert values['visit_id'] == \
+        '093601^^^&650903.98473.0179.6039.1.333.1&ISO'
+    assert values['patient_id'] == \
+        '081994^^^&650903.98473.0179.6039.1.333.1&ISO'
+    assert values['patient_class'] == 'E'
+    assert values['disposition'] == '01'
+    assert values['gender'] == 'F'
+    assert values['admit_datetime'] == datetime(3244, 9, 11, 23, 33, 35)
+
+
+def test_mu_visit():
+    "MU sends assigning authority in PV1 19"
+    values = visit_values(Message(MU))
+    assert values['visit_id'] == '358798^^^&3768573961&NPI'
+    assert values['patient_id'] == '761339^^^&3768573961&NPI'
+    assert values['zip'] == '99304'
+    assert values['county'] == '071'
+    assert values['race'] == 'White'
+    assert values['chief_complaint'] == 'Seizure'
+    assert values['disposition'] == '06'
+    assert values['admission_source'] == '9'
+
+
+def test_dx():
+    rows = dx_values(Message(ADT))
+    assert len(rows) == 2
+    assert rows[0] == {'rank': 1, 'dx_code': '784.0',
+                       'dx_description': 'HEADACHE', 'dx_type': 'W'}
+    assert rows[1]['dx_description'] == \
+        "OTH NOSP (ABN) FINDINGS RADIOLOGICAL \T\\ "
+
+
+def test_adt_obx():
+    rows = adt_obx_values(Message(ADT))
+    assert len(rows) == 1
+    assert rows[0]['observation_id'] == '29553-5'
+    assert rows[0]['units'] == 'Years'
+    assert adt_obx_values(Message(ORU)) == []
+
+
+def test_lab_groups():
+    groups = lab_groups(Message(ORU))
+    assert len(groups) == 1
+    group = groups[0]
+    assert group['obr']['loinc_code'] == '610-6'
+    assert group['obr']['alt_text'] == 'Culture'
+    assert group['obr']['status'] == 'I'
+    assert group['obr']['specimen_source'] == 'BLUD'
+    assert group['notes'] == [{'sequence_number': '1', 'note': 'obr note'}]
+    assert len(group['obxes']) == 1
+    obx, notes = group['obxes'][0]
+    assert obx['observation_text'] == 'Bacteria identified'
+    assert notes == [{'sequence_number': '1', 'note': 'obx note'}]
+    assert group['spms'] == [{'id': '119297000', 'description': 'Blood',
+                              'code': None}]
+    assert lab_groups(Message(ADT)) == []
+
+
+def test_iter_messages():
+    batch = ["FHS|^~\&|x\n", "BHS|^~\&|x\n"] + \
+        [s + '\n' for s in ADT.split('\r')] + \
+        [s + '\n' for s in MU.split('\r')] + ["BTS|2\n", "FTS|1\n"]
+    messages = list(iter_messages(batch))
+    assert messages == [ADT, MU]
+
+
+class FakeConnection(object):
+    "Records inserts; control id 'stored' is already in the warehouse"
+    def __init__(self):
+        self.inserts = []
+        self.ids = 0
+
+    def execute(self, statement, *multiparams):
+        if multiparams:
+            self.inserts.append((statement.table.name, multiparams[0]))
+            return None
+        if isinstance(statement, basestring):  # nextval()
+            self.ids += 1
+            return self
+        return [('stored',)]
+
+    def scalar(self):
+        return self.ids
+
+    def begin(self):
+        return self
+
+    def begin_nested(self):
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FailingConnection(FakeConnection):
+    "As FakeConnection, failing hl7_spm inserts lacking a code"
+    def execute(self, statement, *multiparams):
+        if multiparams and statement.table.name == 'hl7_spm' and \
+                [row for row in multiparams[0] if row['code'] is None]:
+            raise IntegrityError(statement, multiparams[0],
+                                 Exception("null value in column code"))
+        return super(FailingConnection, self).execute(statement,
+                                                      *multiparams)
+
+
+def test_ingest_batchfile():
+    stored = ADT.replace('43867.91489.826194.764.6875.35', 'stored')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'Rbatch')
+        with open(path, 'w') as batchfile:
+            batchfile.write('\n'.join((ADT, stored, ADT, MU)) + '\n')
+        connection = FakeConnection()
+        assert ingest_batchfile(connection, path) == (4, 2)
+    finally:
+        shutil.rmtree(tmpdir)
+    tables = [name for name, _ in connection.inserts]
+    assert tables[:3] == [hl7RawMessage_table.name, hl7Msh_table.name,
+                          'hl7_visit']
+    assert tables.count(hl7Msh_table.name) == 2
+    msh = connection.inserts[1][1][0]
+    assert msh['batch_filename'] == 'Rbatch' and msh['hl7_msh_id'] == 1
+
+
+def test_ingest_metrics():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'Rbatch')
+        with open(path, 'w') as batchfile:
+            batchfile.write('\n'.join((ADT, ADT, ORU)) + '\n')
+        metrics = IngestMetrics()
+        ingest_batchfile(FakeConnection(), path, metrics=metrics)
+    finally:
+        shutil.rmtree(tmpdir)
+    text = metrics.render()
+    assert 'pheme_ingest_messages_total{outcome="stored"} 2.0' in text
+    assert 'pheme_ingest_messages_total{outcome="duplicate"} 1.0' in text
+    assert 'pheme_ingest_rows_total{table="hl7_dx"} 2.0' in text
+    assert 'pheme_ingest_stage_seconds_count{stage="parse"} 3.0' in text
+    assert 'pheme_ingest_insert_seconds_count{table="hl7_obr"} 1.0' in text
+
+
+def test_failed_message():
+    "A message failing to store doesn't stop the rest"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'Rbatch')
+        # the ORU specimen lacks the (NOT NULL) SPM-4.4 code
+        with_code = ORU.replace('SCT^^Blood', 'SCT^BLDS^Blood').replace(
+            'ctrl.oru.1', 'ctrl.oru.2')
+        with open(path, 'w') as batchfile:
+            batchfile.write('\n'.join((ORU, ADT, with_code)) + '\n')
+        metrics = IngestMetrics()
+        assert ingest_batchfile(FailingConnection(), path,
+                                metrics=metrics) == (3, 2)
+    finally:
+        shutil.rmtree(tmpdir)
+    text = metrics.render()
+    assert 'pheme_ingest_messages_total{outcome="failed"} 1.0' in text
+    assert 'pheme_ingest_messages_total{outcome="stored"} 2.0' in text
@@ -0,0 +1,59 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import alias
+
+from pheme.warehouse.tables import FINGERPRINT_SEPARATOR
+from pheme.warehouse.tables import fingerprint
+from pheme.warehouse.tables import fingerprint_sql
+from pheme.warehouse.tables import hash_key
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import HL7_Dx
+from pheme.warehouse.tables import HL7_Obx
+from pheme.warehouse.tables import HL7_Visit
+from pheme.warehouse.tables import same_visit
+from pheme.warehouse.tables import visit_criteria
+
+
+def test_hash_key():
+    # md5('abc') begins 900150983cd24fb0, as a signed 64 bit value
+    assert hash_key('abc') == 0x900150983cd24fb0 - (1 << 64)
+    assert hash_key(u'abc') == hash_key('abc')
+    assert hash_key(None) is None
+    key = hash_key('358798^^^&3768573961&NPI')
+    assert -(1 << 63) <= key < (1 << 63)
+
+
+def test_visit_keys():
+    visit = HL7_Visit(1, '358798^^^&3768573961&NPI',
+                      '761339^^^&3768573961&NPI')
+    assert visit.visit_key == hash_key('358798^^^&3768573961&NPI')
+    assert visit.patient_key == hash_key('761339^^^&3768573961&NPI')
+
+
+def test_criteria_verifies_string():
+    sql = str(visit_criteria('v1').compile(dialect=postgresql.dialect()))
+    assert 'hl7_visit.visit_key = ' in sql
+    assert 'hl7_visit.visit_id = ' in sql
+    a, b = alias(hl7Visit_table, 'a'), alias(hl7Visit_table, 'b')
+    sql = str(same_visit(a, b))
+    assert sql == 'a.visit_key = b.visit_key AND a.visit_id = b.visit_id'
+
+
+def test_fingerprint():
+    dx = HL7_Dx(1, '784.0', dx_description='HEADACHE', dx_type='W')
+    assert dx.compare_str() == '784.0|W'
+    assert fingerprint(dx.compare_fields()) == \
+        hash_key('784.0' + FINGERPRINT_SEPARATOR + 'W')
+    # None and empty are equivalent, as in compare_str
+    assert fingerprint(('784.0', None)) == fingerprint(('784.0', ''))
+    obx = HL7_Obx(hl7_obr_id=12, value_type='NM', units='mg')
+    assert obx.compare_fields()[0] == 't'
+
+
+def test_fingerprint_sql():
+    sql = fingerprint_sql('hl7_dx')
+    assert sql == "hl7_hash_key(coalesce(NEW.dx_code::TEXT, '') || " \
+        "E'\\x1f' || coalesce(NEW.dx_type::TEXT, ''))"
+    sql = fingerprint_sql('hl7_obx', encoded=('units',))
+    assert "(SELECT value FROM hl7_text WHERE text_id = NEW.units_id)" \
+        in sql
+    assert "coalesce(NEW.hl7_obr_id, 0)" in sql
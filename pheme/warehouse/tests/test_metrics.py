@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import urllib2
+
+from pheme.warehouse.metrics import Counter
+from pheme.warehouse.metrics import Gauge
+from pheme.warehouse.metrics import Histogram
+from pheme.warehouse.metrics import IngestMetrics
+
+
+def test_counter():
+    counter = Counter('rows_total', 'Rows', ('table',))
+    counter.inc(2, ('hl7_dx',))
+    counter.inc(1, ('hl7_dx',))
+    counter.inc(1, ('say "hi"',))
+    assert counter.render().split('\n') == [
+        '# HELP rows_total Rows', '# TYPE rows_total counter',
+        'rows_total{table="hl7_dx"} 3.0',
+        'rows_total{table="say \\"hi\\""} 1.0']
+
+
+def test_gauge():
+    gauge = Gauge('depth', 'Queue depth')
+    gauge.set(5)
+    gauge.dec()
+    assert gauge.render().endswith('\ndepth 4.0')
+
+
+def test_histogram():
+    histogram = Histogram('seconds', 'Time', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value, ('parse',))
+    lines = histogram.render().split('\n')[2:]
+    assert lines == ['seconds_bucket{stage="parse",le="0.1"} 1.0',
+                     'seconds_bucket{stage="parse",le="1"} 3.0',
+                     'seconds_bucket{stage="parse",le="+Inf"} 4.0',
+                     'seconds_sum{stage="parse"} 4.05',
+                     'seconds_count{stage="parse"} 4.0']
+
+
+def test_exports():
+    metrics = IngestMetrics()
+    metrics.files.inc()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'ingest.prom')
+        metrics.write_textfile(path)
+        assert os.listdir(tmpdir) == ['ingest.prom']
+        with open(path) as textfile:
+            assert 'pheme_ingest_files_total 1.0' in textfile.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    server = metrics.serve(0)
+    try:
+        url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+        assert urllib2.urlopen(url).read() == metrics.render()
+    finally:
+        server.shutdown()
@@ -0,0 +1,95 @@
+from sqlalchemy.dialects import postgresql
+
+from pheme.warehouse.migrate import AddColumnStep
+from pheme.warehouse.migrate import CreateIndexStep
+from pheme.warehouse.migrate import CreateTableStep
+from pheme.warehouse.migrate import ReplaceViewStep
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7RawMessage_table
+from pheme.warehouse.tables import hl7Visit_table
+
+dialect = postgresql.dialect()
+
+
+def test_add_column():
+    step = AddColumnStep(hl7RawMessage_table.c.archive_offset)
+    assert step.statements(dialect) == \
+        ["ALTER TABLE hl7_raw_message ADD COLUMN archive_offset BIGINT"]
+
+
+def test_add_foreign_key_column():
+    step = AddColumnStep(hl7Visit_table.c.hl7_msh_id)
+    assert step.statements(dialect) == \
+        ["ALTER TABLE hl7_visit ADD COLUMN hl7_msh_id INTEGER "
+         "REFERENCES hl7_msh (hl7_msh_id) ON DELETE CASCADE"]
+
+
+def test_create_index_concurrently():
+    index = [i for i in hl7Msh_table.indexes
+             if i.name == 'ix_hl7_msh_batch_filename'][0]
+    assert CreateIndexStep(index).statements(dialect) == \
+        ["CREATE INDEX CONCURRENTLY ix_hl7_msh_batch_filename "
+         "ON hl7_msh (batch_filename)"]
+    statements = CreateIndexStep(index, invalid=True).statements(dialect)
+    assert statements[0] == "DROP INDEX CONCURRENTLY IF EXISTS "\
+        "ix_hl7_msh_batch_filename"
+
+
+class FakeRawConnection(object):
+    "Records statements and isolation level changes, as psycopg2 would"
+    def __init__(self):
+        self.isolation_level = 1  # read committed
+        self.levels = []
+        self.executed = []
+        self.closed = False
+
+    def set_isolation_level(self, level):
+        self.levels.append(level)
+        self.isolation_level = level
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        assert self.isolation_level == 0, "not in autocommit"
+        self.executed.append(statement)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeEngine(object):
+    dialect = dialect
+
+    def __init__(self):
+        self.connection = FakeRawConnection()
+
+    def raw_connection(self):
+        return self.connection
+
+
+def test_create_index_restores_isolation_level():
+    index = [i for i in hl7Msh_table.indexes
+             if i.name == 'ix_hl7_msh_batch_filename'][0]
+    engine = FakeEngine()
+    CreateIndexStep(index).apply(engine, 'user')
+    connection = engine.connection
+    assert len(connection.executed) == 1
+    assert connection.levels == [0, 1]
+    assert connection.isolation_level == 1 and connection.closed
+
+
+def test_create_table():
+    statements = CreateTableStep(hl7Msh_table).statements(dialect)
+    assert statements[0].startswith("CREATE TABLE hl7_msh")
+    assert len(statements) == 1 + len(hl7Msh_table.indexes)
+
+
+def test_replace_view():
+    view, function = ReplaceViewStep(hl7Dx_table).statements(dialect)
+    assert view.startswith("CREATE OR REPLACE VIEW hl7_dx AS SELECT ")
+    assert 's.fingerprint FROM hl7_dx_store s' in view
+    assert function.strip().startswith(
+        "CREATE OR REPLACE FUNCTION hl7_dx_write()")
+    assert 'NEW.fingerprint' in function
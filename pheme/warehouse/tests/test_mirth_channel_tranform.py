@@ -1,8 +1,26 @@
+import argparse
+import json
 from lxml import etree
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import SkipTest
 
+from pheme.warehouse.mirth_channel_transform import BATCH_PRELUDE
+from pheme.warehouse.mirth_channel_transform import BatchedInsertTransferAgent
+from pheme.warehouse.mirth_channel_transform import consolidate
+from pheme.warehouse.mirth_channel_transform import placeholder
 from pheme.warehouse.mirth_channel_transform import transformer_factory
 from pheme.warehouse.mirth_channel_transform import CommonTransferAgent
 from pheme.warehouse.mirth_channel_transform import PHEME_http_receiverTransferAgent
+from pheme.warehouse.mirth_channel_transform import TransformManager
+from pheme.warehouse.mirth_channel_transform import TransformManifest
+from pheme.warehouse.mirth_shell_commands import INSERT_CHANNELS
+from pheme.warehouse.mirth_shell_commands import MirthShell
+from pheme.warehouse.tables import hl7Nte_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tests.snapshot import CHANNEL_DIR
 
 
 def test_transformer_factory_common():
@@ -20,3 +38,257 @@ def test_transformer_factory_http_receiver():
         </channel>""")
     tf = transformer_factory(fake_channel, None)
     assert(isinstance(tf, PHEME_http_receiverTransferAgent))
+
+
+FAKE_CHANNEL = """<channel>
+  <name>fake</name>
+  <sourceConnector><properties>
+    <property name="DataType">File Reader</property>
+    <property name="host">/src</property>
+  </properties></sourceConnector>
+</channel>"""
+
+
+def fake_options(**kwargs):
+    options = dict(db='db', user='user', password='pw', input_dir='/in',
+                   output_dir='/out', error_dir='/err')
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def test_incremental_transform():
+    source_dir, target_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        src = os.path.join(source_dir, 'fake.xml')
+        with open(src, 'w') as channel:
+            channel.write(FAKE_CHANNEL)
+
+        def transform(options, force=False):
+            manifest = TransformManifest(target_dir)
+            written = TransformManager(src, target_dir, options, manifest,
+                                       force)()
+            manifest.save()
+            return written
+
+        assert transform(fake_options())
+        assert '<property name="host">/in</property>' in \
+            open(os.path.join(target_dir, 'fake.xml')).read()
+        assert not transform(fake_options())
+        assert transform(fake_options(), force=True)
+        assert transform(fake_options(input_dir='/elsewhere'))
+        with open(src, 'a') as channel:
+            channel.write(' ')
+        assert transform(fake_options(input_dir='/elsewhere'))
+        assert not transform(fake_options(input_dir='/elsewhere'))
+    finally:
+        shutil.rmtree(source_dir)
+        shutil.rmtree(target_dir)
+
+
+def test_manifest_deploy():
+    target_dir = tempfile.mkdtemp()
+    try:
+        target = os.path.join(target_dir, 'fake.xml')
+        with open(target, 'w') as channel:
+            channel.write(FAKE_CHANNEL)
+        manifest = TransformManifest(target_dir)
+        assert manifest.needs_deploy(target)
+        manifest.record_deploy(target)
+        manifest.save()
+        assert not TransformManifest(target_dir).needs_deploy(target)
+        with open(target, 'a') as channel:
+            channel.write(' ')
+        assert TransformManifest(target_dir).needs_deploy(target)
+    finally:
+        shutil.rmtree(target_dir)
+
+
+def test_script_deploys_changed_channels():
+    target_dir = tempfile.mkdtemp()
+    try:
+        target = os.path.join(target_dir, 'fake.xml')
+        with open(target, 'w') as channel:
+            channel.write(FAKE_CHANNEL)
+        commands = MirthShell().script_commands(
+            imports=[target], codetemplates=False)
+        assert 'import %s force' % target in commands
+        assert not [c for c in commands if c.startswith('importcode')]
+        # no per channel deploy in the Mirth 2.2 shell
+        assert [c for c in commands if 'deploy' in c] == ['deploy']
+    finally:
+        shutil.rmtree(target_dir)
+
+
+POOLED_CHANNEL = """<channel>
+  <name>pooled</name>
+  <sourceConnector><properties>
+    <property name="DataType">Channel Reader</property>
+  </properties></sourceConnector>
+  <destinationConnectors><connector><properties>
+    <property name="script">var dbConn = DatabaseConnectionFactory.createDatabaseConnection('org.postgresql.Driver',
+    'jdbc:postgresql://localhost:5432/warehouse','user','password');
+try {
+  dbConn.executeUpdate(stmt)
+} finally {
+  dbConn.close();
+}</property>
+  </properties></connector></destinationConnectors>
+  <deployScript>return;</deployScript>
+  <shutdownScript>return;</shutdownScript>
+</channel>"""
+
+
+def test_pooled_connections():
+    tree = etree.ElementTree(etree.fromstring(POOLED_CHANNEL))
+    tree = transformer_factory(tree, fake_options(
+        pooled_connections=True)).transform()
+    script = tree.xpath("//property[@name='script']")[0].text
+    call = "DatabaseConnectionFactory.createDatabaseConnection(" \
+        "'org.postgresql.Driver',\n    " \
+        "'jdbc:postgresql://localhost:5432/db','user','pw')"
+    assert "globalChannelMap.get('pheme_dbConn')" in script
+    assert call in script
+    assert "dbConn.close()" not in script
+    assert "globalChannelMap.put('pheme_dbConn', %s);" % call in \
+        tree.xpath("/channel/deployScript")[0].text
+    assert "conn.close();" in tree.xpath("/channel/shutdownScript")[0].text
+
+
+def test_unpooled_connections():
+    tree = etree.ElementTree(etree.fromstring(POOLED_CHANNEL))
+    tree = transformer_factory(tree, fake_options()).transform()
+    script = tree.xpath("//property[@name='script']")[0].text
+    assert "globalChannelMap" not in script
+    assert "dbConn.close();" in script
+    assert tree.xpath("/channel/deployScript")[0].text == "return;"
+
+
+def test_placeholder():
+    assert placeholder(hl7Obx_table.c.observation_text) == '?'
+    assert placeholder(hl7Obx_table.c.observation_datetime) == \
+        '?::TIMESTAMP WITHOUT TIME ZONE'
+    assert placeholder(hl7Nte_table.c.sequence_number) == '?::SMALLINT'
+    # foreign keys take the referenced column's type
+    assert placeholder(hl7Nte_table.c.hl7_obx_id) == '?::INTEGER'
+
+
+def test_batched_inserts():
+    for channel, tables in (
+            ('PHEME_hl7_visit_insert', ('hl7_visit',)),
+            ('PHEME_hl7_dx_insert', ('hl7_dx',)),
+            ('PHEME_hl7_obx_insert', ('hl7_obx',)),
+            ('PHEME_hl7_obr_insert', ('hl7_obr', 'hl7_obx', 'hl7_nte',
+                                      'hl7_spm'))):
+        tree = etree.parse(os.path.join(CHANNEL_DIR, channel + '.xml'))
+        agent = transformer_factory(tree, fake_options(batched_inserts=True))
+        assert isinstance(agent, BatchedInsertTransferAgent)
+        script = agent.transform().xpath(
+            "//property[@name='script']")[0].text
+        assert 'StringBuilder' not in script
+        assert "localhost:5432/db','user','pw')" in script
+        for table in tables:
+            assert "new InsertBatch('%s'" % table in script
+        if channel == 'PHEME_hl7_obr_insert':
+            assert "nextIds(dbConn, 'hl7_obx_hl7_obx_id_seq'" in script
+
+    tree = etree.parse(os.path.join(CHANNEL_DIR, 'PHEME_hl7_dx_insert.xml'))
+    assert not isinstance(transformer_factory(tree, fake_options()),
+                          BatchedInsertTransferAgent)
+
+
+def test_batched_sql_values():
+    # The literals as built by quoteOrNull, and the values PostgreSQL
+    # reads from them (standard_conforming_strings off)
+    literals = [r"'a\\T\\ b'", "'O''Brien'", r"'x\\''y'", '12', None]
+    expected = [r'a\T\ b', "O'Brien", r"x\'y", '12', None]
+    start = BATCH_PRELUDE.index('function sqlValue')
+    end = BATCH_PRELUDE.index('function InsertBatch')
+    script = BATCH_PRELUDE[start:end] + \
+        "console.log(JSON.stringify(%s.map(sqlValue)))" % \
+        json.dumps(literals)
+    try:
+        node = subprocess.Popen(['node'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+    except OSError:
+        raise SkipTest("node is required to run the channel JavaScript")
+    output = node.communicate(script)[0]
+    assert json.loads(output) == expected
+
+
+def consolidated_consumer():
+    parse = lambda channel: etree.parse(os.path.join(CHANNEL_DIR,
+                                                     channel + '.xml'))
+    return consolidate(parse('PHEME_batchfile_consumer'),
+                       [parse(channel) for channel in INSERT_CHANNELS])
+
+
+def test_consolidate():
+    tree = consolidated_consumer()
+    destinations = dict((connector.find('name').text, connector) for
+                        connector in tree.xpath(
+                            '/channel/destinationConnectors/connector'))
+    assert sorted(destinations) == [
+        'debug - write outbound xml to disk', 'hl7_dx insert',
+        'hl7_obr insert', 'hl7_obx insert', 'hl7_visit insert']
+    # only the disabled debug destination still writes to a channel
+    assert [connector.find('enabled').text for connector in
+            destinations.values() if connector.find('transportName').text
+            == 'Channel Writer'] == ['false']
+
+    dx = destinations['hl7_dx insert']
+    assert dx.find('transportName').text == 'JavaScript Writer'
+    assert [step.text for step in dx.xpath('transformer/steps/step/name')] \
+        == ['Pull ids from inbound xml', 'dg1Array']
+    assert [rule.text for rule in dx.xpath('filter/rules/rule/name')] == \
+        ['Contains DG1 segments']
+    obx = destinations['hl7_obx insert']
+    assert obx.find('transportName').text == 'Database Writer'
+    assert [step.text for step in obx.xpath('transformer/steps/step/name')] \
+        == ['Pull ids from inbound xml', 'obxArray']
+    assert [sequence.text for sequence in obx.xpath(
+        'transformer/steps/step/sequenceNumber')] == ['0', '1']
+
+
+def test_consolidate_transform():
+    options = fake_options(batched_inserts=True, pooled_connections=True)
+    agent = transformer_factory(consolidated_consumer(), options)
+    assert isinstance(agent, BatchedInsertTransferAgent)
+    tree = agent.transform()
+    scripts = [connector.xpath("properties/property[@name='script']")[0].text
+               for connector in tree.xpath(
+                   '/channel/destinationConnectors/connector') if
+               connector.find('transportName').text != 'Channel Writer']
+    assert len(scripts) == 4
+    for script in scripts:
+        assert 'new InsertBatch(' in script
+        assert "globalChannelMap.get('pheme_dbConn')" in script
+    assert tree.xpath('/channel/deployScript')[0].text.count(
+        'createDatabaseConnection') == 1
+
+
+def test_incremental_consolidated():
+    source_dir, target_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        src, inlined = [os.path.join(source_dir, name + '.xml') for name in
+                        ('PHEME_batchfile_consumer', 'PHEME_hl7_dx_insert')]
+        for path in src, inlined:
+            shutil.copy(os.path.join(CHANNEL_DIR, os.path.basename(path)),
+                        path)
+
+        def transform(inline=()):
+            manifest = TransformManifest(target_dir)
+            written = TransformManager(src, target_dir, fake_options(),
+                                       manifest, inline=inline)()
+            manifest.save()
+            return written
+
+        assert transform()
+        assert transform(inline=[inlined])
+        assert not transform(inline=[inlined])
+        with open(inlined, 'a') as channel:
+            channel.write(' ')
+        assert transform(inline=[inlined])
+        assert transform()
+    finally:
+        shutil.rmtree(source_dir)
+        shutil.rmtree(target_dir)
@@ -8,6 +8,12 @@ available.  To create said file - run::
 
 (and go get some coffee while you wait...)
 
+Alternatively, set [warehouse]test_replay in the config to load the
+test set in process instead (see `MirthInteraction.replay_batchfiles`),
+which takes seconds and doesn't require Mirth.  This exercises the
+Python port of the channel logic rather than the channels themselves,
+so use it for quick iterations, not to validate channel changes.
+
 The test files should not contain ANY sensitive data.  All test files
 should either be hand generated from test data, or scrubbed by a process
 such as pheme.anonymize
@@ -20,9 +26,19 @@ import unittest
 from sqlalchemy import select, and_
 
 from pheme.util.config import Config
-from pheme.util.pg_access import db_connection
+from pheme.util.pg_access import AlchemyAccess
 from pheme.warehouse.tables import *
 from pheme.warehouse.tests.process_testfiles import MirthInteraction
+from pheme.warehouse.tests.workers import worker_database
+from pheme.warehouse.visit_cache import VisitCache
+
+
+def db_connection():
+    """Connection to the warehouse, this test worker's copy if parallel"""
+    c = Config()
+    return AlchemyAccess(database=worker_database(c), host='localhost',
+                         user=c.get('warehouse', 'database_user'),
+                         password=c.get('warehouse', 'database_password'))
 
 
 def setup_module():
@@ -32,12 +48,16 @@ def setup_module():
     if c.get('general', 'in_production'):  # pragma: no cover
         raise RuntimeError("DO NOT run destructive test on production system")
 
-    "Pull in the filesystem dump from a previous mirth run"
     mi = MirthInteraction()
-    mi.restore_database()
+    if c.get('warehouse', 'test_replay'):
+        "Load the test set in process"
+        mi.replay_batchfiles()
+    else:
+        "Pull in the filesystem dump from a previous mirth run"
+        mi.restore_database()
 
     "Run a quick sanity check, whole module requires a populated db"
-    connection = db_connection('warehouse')
+    connection = db_connection()
     count = connection.session.query(HL7_Msh).count()
     connection.disconnect()
 
@@ -52,7 +72,7 @@ class SQATest(unittest.TestCase):
 
     def setUp(self):
         super(SQATest, self).setUp()
-        self.connection = db_connection('warehouse')
+        self.connection = db_connection()
         self.session = self.connection.session
 
     def tearDown(self):
@@ -963,6 +983,18 @@ class TestObservationData(SQATest):
             found += 1
         self.assertEquals(found, 2)
 
+    def testCachedVisitLookup(self):
+        "Cached lookup returns the same observations, then hits"
+        v_id = '950039^^^&650903.98473.0179.6039.1.333.1&ISO'
+        cache = VisitCache(self.session.bind)
+        found = cache.observation_data(v_id)
+        self.assertEquals(len(found), 2)
+        for r in found:
+            self.assertTrue(len(r.obxes) > 0)
+        self.assertEquals(len(cache.observation_data(v_id)), 2)
+        stats = cache.stats()['observation_data']
+        self.assertEquals((stats['hits'], stats['misses']), (1, 1))
+
     def dontestMegaJoin(self):
         v_id = '950039^^^&650903.98473.0179.6039.1.333.1&ISO'
         query = self.session.query(ObservationData,HL7_Visit).\
@@ -983,6 +1015,20 @@ class TestObservationData(SQATest):
                 order_by(FullMessage.message_datetime)
         self.assertEquals(query.count(), 8)
 
+    def testCachedFullMessageByVisit(self):
+        "Cached full messages, evicted on invalidation"
+        v_id = '405774^^^&650903.98473.0179.6039.1.333.1&ISO'
+        cache = VisitCache(self.session.bind)
+        messages = cache.full_messages(v_id)
+        self.assertEquals(len(messages), 8)
+        self.assertEquals([m.message_datetime for m in messages],
+                          sorted(m.message_datetime for m in messages))
+        cache.invalidate(v_id)
+        self.assertEquals(len(cache.full_messages(v_id)), 8)
+        stats = cache.stats()
+        self.assertEquals(stats['full_messages']['misses'], 2)
+        self.assertEquals(stats['invalidations'], 1)
+
     def testMessageW9(self):
         nine = '467984^^^&650903.98473.0179.6039.1.333.1&ISO'
         query = self.session.query(FullMessage).\
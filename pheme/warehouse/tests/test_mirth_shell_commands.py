@@ -0,0 +1,104 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from pheme.warehouse.mirth_shell_commands import MirthSession
+from pheme.warehouse.mirth_shell_commands import MirthShellError
+from pheme.warehouse.mirth_shell_commands import parse_status
+
+
+# Stands in for an interactive mccommand
+FAKE_SHELL = r"""
+import sys
+sys.stdout.write("Connected to Mirth Connect server @ https://localhost\n$ ")
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+    command = line.strip()
+    if command == 'quit':
+        break
+    elif command == 'status':
+        sys.stdout.write(
+            "ID                                   Status      Name\n"
+            "96fea321-defb-42a1-b6b2-74298bcc6e03 STARTED     dx_insert\n"
+            "9c6d9546-bfba-4445-a6bb-f6e2869aaa42 STOPPED     obr_insert\n")
+    elif command.startswith('import'):
+        sys.stdout.write("Could not read file %s\n" % command.split()[1])
+    elif command.startswith('export'):
+        sys.stdout.write("Exported channel to %s\n" % command.split()[2])
+    elif command != 'deploy':
+        sys.stdout.write("Unknown command: %s\n" % command)
+    sys.stdout.write("$ ")
+    sys.stdout.flush()
+"""
+
+
+class TestMirthSession(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'fake_shell.py'), 'w') as shell:
+            shell.write(FAKE_SHELL)
+        self.session = MirthSession(
+            self.dir, command=(sys.executable, 'fake_shell.py'), timeout=10)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def test_run(self):
+        self.session.start()
+        results = self.session.run(['deploy', 'status'])
+        assert [command for command, output in results] == \
+            ['deploy', 'status']
+        assert results[0][1] == []
+        assert len(results[1][1]) == 3
+
+    def test_status(self):
+        with self.session as session:
+            assert session.status() == {'dx_insert': 'STARTED',
+                                        'obr_insert': 'STOPPED'}
+            # the session persists across calls
+            assert session.status()['dx_insert'] == 'STARTED'
+
+    def test_errors(self):
+        with self.session as session:
+            with self.assertRaises(MirthShellError) as context:
+                session.run(['import /missing.xml force', 'deploy'])
+            assert 'Could not read file /missing.xml' in \
+                str(context.exception)
+            assert 'deploy:' not in str(context.exception)
+
+    def test_output_mentioning_errors(self):
+        with self.session as session:
+            results = session.run(['export dump /srv/error_dir/dump.xml'])
+            assert results[0][1] == [
+                'Exported channel to /srv/error_dir/dump.xml']
+
+    def test_exited(self):
+        self.session.start()
+        self.session.process.stdin.write("quit\n")
+        self.session.process.stdin.flush()
+        self.session.process.wait()
+        self.assertRaises(MirthShellError, self.session.run, ['status'])
+
+
+def test_parse_status():
+    lines = ["ID                                   Status      Name",
+             "96fea321-defb-42a1-b6b2-74298bcc6e03 PAUSED      dump_to_disk"]
+    assert parse_status(lines) == {'dump_to_disk': 'PAUSED'}
+
+
+def test_error_pattern():
+    failed = MirthSession.ERROR_PATTERN.search
+    for line in ("Error: channel not found",
+                 "Could not read file /tmp/x.xml",
+                 "Unknown command: depoly",
+                 "com.mirth.connect.client.core.ClientException: refused",
+                 "java.io.IOException: Broken pipe"):
+        assert failed(line), line
+    for line in ("Exported channel to /srv/error_dir/dump.xml",
+                 "Channel error_feed deployed",
+                 "0 channels with errors"):
+        assert not failed(line), line
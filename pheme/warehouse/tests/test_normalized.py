@@ -0,0 +1,62 @@
+from pheme.warehouse.normalized import normalized_metadata
+from pheme.warehouse.normalized import TextDictionary
+from pheme.warehouse.normalized import trigger_ddl
+from pheme.warehouse.normalized import view_ddl
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import sequence_names
+
+
+class FakeEngine(object):
+    "Stands in for hl7_text_id(), assigning keys in call order"
+    def __init__(self):
+        self.calls = 0
+
+    def execute(self, statement):
+        self.calls += 1
+        return self
+
+    def scalar(self):
+        return self.calls
+
+
+def test_store_tables():
+    normalized = normalized_metadata()
+    obx = normalized.tables['hl7_obx_store']
+    assert 'observation_text' not in obx.c
+    assert 'observation_text_id' in obx.c
+    assert 'ix_hl7_obx_store_observation_text_id' in \
+        [index.name for index in obx.indexes]
+    assert [fk.target_fullname for fk in obx.c.hl7_obr_id.foreign_keys] \
+        == ['hl7_obr_store.hl7_obr_id']
+    visit = normalized.tables['hl7_visit']
+    assert [fk.target_fullname for fk in visit.c.hl7_msh_id.foreign_keys] \
+        == ['hl7_msh_store.hl7_msh_id']
+    # sequences keep the names used by the channels
+    assert 'hl7_obx_hl7_obx_id_seq' in sequence_names([obx])
+
+
+def test_view_shape():
+    ddl = view_ddl(hl7Obx_table)
+    assert ddl.startswith('CREATE VIEW hl7_obx AS SELECT s.hl7_obx_id, ')
+    assert 't_units.value AS units' in ddl
+    function, trigger = trigger_ddl(hl7Obx_table)
+    assert 'hl7_text_id(NEW.observation_text)' in function
+    assert 'INSTEAD OF INSERT OR UPDATE OR DELETE ON hl7_obx' in trigger
+
+
+def test_encode():
+    engine = FakeEngine()
+    dictionary = TextDictionary(engine, preload=False)
+    table, rows = dictionary.encode(hl7Obx_table, [
+        {'hl7_obx_id': 1, 'observation_text': 'Temp', 'units': 'C',
+         'result_status': None},
+        {'hl7_obx_id': 2, 'observation_text': 'Temp', 'units': 'F'}])
+    assert table.name == 'hl7_obx_store'
+    assert rows == [
+        {'hl7_obx_id': 1, 'observation_text_id': 1, 'units_id': 2,
+         'result_status_id': None},
+        {'hl7_obx_id': 2, 'observation_text_id': 1, 'units_id': 3,
+         'result_status_id': None}]
+    assert dictionary.misses == 3
+    assert dictionary.encode(hl7Visit_table, []) == (hl7Visit_table, [])
@@ -0,0 +1,42 @@
+import os
+import pstats
+import shutil
+import signal
+import tempfile
+
+from pheme.warehouse.profiling import BatchProfiler
+
+
+def busy():
+    return sum(range(1000))
+
+
+def test_profile_next_batches():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        profiler = BatchProfiler(batches=1, output_dir=tmpdir)
+        with profiler.profile('/input/Rfirst') as path:
+            busy()
+        assert path == os.path.join(tmpdir, 'Rfirst.prof')
+        assert 'busy' in str(pstats.Stats(path).stats.keys())
+        with open(path + '.txt') as summary:
+            assert 'cumulative' in summary.read()
+        with profiler.profile('/input/Rsecond') as path:
+            busy()
+        assert path is None
+        assert sorted(os.listdir(tmpdir)) == ['Rfirst.prof',
+                                              'Rfirst.prof.txt']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_signal_arms():
+    profiler = BatchProfiler(signal_batches=2)
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        profiler.install_signal_handler()
+        os.kill(os.getpid(), signal.SIGUSR1)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert profiler.remaining == 2
+    assert profiler.output_path('/input/Rbatch') == '/input/Rbatch.prof'
@@ -0,0 +1,106 @@
+from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import select
+
+from pheme.warehouse.purge import count_rows
+from pheme.warehouse.purge import purge
+from pheme.warehouse.purge import retention_cutoff
+from pheme.warehouse.selection import MessageSelection
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Nte_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7RawMessage_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import metadata
+
+
+TABLES = [hl7RawMessage_table, hl7Msh_table, hl7Visit_table, hl7Dx_table,
+          hl7Obr_table, hl7Obx_table, hl7Nte_table, hl7Spm_table]
+
+
+def seed(connection, hl7_msh_id, message_datetime):
+    """Store a message having a row in each table"""
+    control_id = 'control.%d' % hl7_msh_id
+    connection.execute(hl7RawMessage_table.insert(), {
+        'hl7_raw_message_id': hl7_msh_id,
+        'message_control_id': control_id, 'raw_data': 'MSH|^~\&|'})
+    connection.execute(hl7Msh_table.insert(), {
+        'hl7_msh_id': hl7_msh_id, 'message_control_id': control_id,
+        'message_type': 'ORU^R01^ORU_R01', 'facility': '1234',
+        'message_datetime': message_datetime, 'batch_filename': 'Rtest'})
+    connection.execute(hl7Visit_table.insert(), {
+        'hl7_msh_id': hl7_msh_id, 'visit_id': '1^^^&1.2&ISO',
+        'patient_id': '2^^^&1.2&ISO'})
+    connection.execute(hl7Dx_table.insert(), {
+        'hl7_dx_id': hl7_msh_id, 'hl7_msh_id': hl7_msh_id, 'rank': 1})
+    connection.execute(hl7Obr_table.insert(), {
+        'hl7_obr_id': hl7_msh_id, 'hl7_msh_id': hl7_msh_id})
+    connection.execute(hl7Obx_table.insert(), {
+        'hl7_obx_id': hl7_msh_id, 'hl7_obr_id': hl7_msh_id,
+        'hl7_msh_id': hl7_msh_id})
+    connection.execute(hl7Nte_table.insert(), [
+        {'hl7_nte_id': 2 * hl7_msh_id, 'sequence_number': 1,
+         'hl7_obr_id': hl7_msh_id, 'hl7_obx_id': None},
+        {'hl7_nte_id': 2 * hl7_msh_id + 1, 'sequence_number': 1,
+         'hl7_obr_id': None, 'hl7_obx_id': hl7_msh_id}])
+    connection.execute(hl7Spm_table.insert(), {
+        'hl7_spm_id': hl7_msh_id, 'code': 'BLD', 'hl7_obr_id': hl7_msh_id})
+
+
+def seeded_warehouse():
+    """Returns connection to a warehouse of 3 old and 2 new messages"""
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine, tables=TABLES)
+    connection = engine.connect()
+    now = datetime.now()
+    for hl7_msh_id in range(1, 6):
+        seed(connection, hl7_msh_id, now - timedelta(
+            days=100 if hl7_msh_id <= 3 else 1))
+    return connection
+
+
+def remaining(connection, table):
+    return connection.execute(
+        select([func.count()]).select_from(table)).scalar()
+
+
+def test_retention_cutoff():
+    assert retention_cutoff(30, datetime(2013, 5, 31)) == \
+        datetime(2013, 5, 1)
+
+
+def test_purge():
+    connection = seeded_warehouse()
+    selection = MessageSelection(until=retention_cutoff(30))
+    assert dict(count_rows(connection, selection)) == dict(
+        (table.name, 6 if table is hl7Nte_table else 3) for table in TABLES)
+
+    progress = list(purge(connection, selection, chunk_size=2))
+    assert [(done, total) for done, total, _ in progress] == [(2, 3), (3, 3)]
+    assert progress[-1][2][hl7Msh_table.name] == 3
+    assert progress[-1][2][hl7Nte_table.name] == 6
+    for table in TABLES:
+        assert remaining(connection, table) == \
+            (4 if table is hl7Nte_table else 2)
+    assert [row[0] for row in connection.execute(
+        select([hl7Msh_table.c.hl7_msh_id]).order_by(
+            hl7Msh_table.c.hl7_msh_id))] == [4, 5]
+
+
+def test_purge_keep_raw():
+    connection = seeded_warehouse()
+    selection = MessageSelection(until=retention_cutoff(30))
+    assert hl7RawMessage_table.name not in dict(
+        count_rows(connection, selection, keep_raw=True))
+
+    totals = list(purge(connection, selection, keep_raw=True))[-1][2]
+    assert hl7RawMessage_table.name not in totals
+    assert remaining(connection, hl7RawMessage_table) == 5
+    assert remaining(connection, hl7Msh_table) == 2
+    assert remaining(connection, hl7Obx_table) == 2
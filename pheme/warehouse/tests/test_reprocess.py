@@ -0,0 +1,22 @@
+import shutil
+import tempfile
+
+from pheme.warehouse import reprocess
+from pheme.warehouse.archive import RawArchive
+
+
+def test_archived_raw_data():
+    directory = tempfile.mkdtemp()
+    saved = reprocess._archive
+    try:
+        reprocess._archive = RawArchive(directory)
+        segment, offset = reprocess._archive.append([('id1', 'MSH|1')])
+        assert reprocess.archived_raw_data('id1', segment, offset) == \
+            'MSH|1'
+        # message absent from the block, segment missing
+        assert reprocess.archived_raw_data('id2', segment, offset) is None
+        assert reprocess.archived_raw_data('id1', 'raw-000009.seg',
+                                           0) is None
+    finally:
+        reprocess._archive = saved
+        shutil.rmtree(directory)
@@ -0,0 +1,73 @@
+from datetime import datetime
+from datetime import timedelta
+import random
+import time
+
+from sqlalchemy.dialects import postgresql
+
+from pheme.warehouse.scan import parallel_windows
+from pheme.warehouse.scan import visit_query
+from pheme.warehouse.scan import windows
+
+
+def test_windows():
+    start, end = datetime(2012, 1, 1), datetime(2012, 1, 3, 12)
+    found = list(windows(start, end))
+    assert found == [(datetime(2012, 1, 1), datetime(2012, 1, 2)),
+                     (datetime(2012, 1, 2), datetime(2012, 1, 3)),
+                     (datetime(2012, 1, 3), datetime(2012, 1, 3, 12))]
+    assert list(windows(end, start)) == []
+
+
+def slow_fetch(window):
+    time.sleep(random.random() / 100)
+    return [(window, n) for n in range(3)]
+
+
+def test_ordered():
+    rows = list(parallel_windows(slow_fetch, range(20), workers=4,
+                                 ordered=True))
+    assert rows == [(w, n) for w in range(20) for n in range(3)]
+
+
+def test_unordered():
+    rows = list(parallel_windows(slow_fetch, range(20), workers=4))
+    assert sorted(rows) == [(w, n) for w in range(20) for n in range(3)]
+
+
+def test_dispatch_bound():
+    started = []
+
+    def fetch(window):
+        started.append(window)
+        if window == 0:
+            time.sleep(0.2)
+        return [window]
+    rows = parallel_windows(fetch, range(20), workers=2, ordered=True)
+    assert rows.next() == 0
+    # the windows after the slow first were held back, not all fetched
+    assert len(started) <= 2 * 2
+    assert list(rows) == range(1, 20)
+    assert sorted(started) == range(20)
+
+
+def test_fetch_error():
+    def fetch(window):
+        if window == 5:
+            raise ValueError("bad window")
+        return [window]
+    try:
+        list(parallel_windows(fetch, range(10), workers=2, ordered=True))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+
+def test_visit_query():
+    query = visit_query('message_datetime', datetime(2012, 1, 1),
+                        datetime(2012, 1, 2))
+    sql = str(query.compile(dialect=postgresql.dialect()))
+    assert 'hl7_msh.message_datetime >= %(message_datetime_1)s' in sql
+    assert sql.endswith('ORDER BY hl7_msh.message_datetime, '
+                        'hl7_visit.hl7_visit_id')
@@ -0,0 +1,43 @@
+from sqlalchemy.dialects import postgresql
+
+from pheme.warehouse.search import like_pattern
+from pheme.warehouse.search import search_query
+
+dialect = postgresql.dialect()
+
+
+def compiled(query):
+    compiled = query.compile(dialect=dialect)
+    return str(compiled), compiled.params
+
+
+def test_like_pattern():
+    assert like_pattern('cough') == '%cough%'
+    assert like_pattern('100%_x') == '%100\\%\\_x%'
+
+
+def test_trigram_query():
+    sql, params = compiled(search_query(['cough', 'fever']))
+    assert sql.count('ILIKE') == 4
+    assert 'UNION' in sql
+    assert sorted(params.values()) == ['%cough%', '%cough%',
+                                       '%fever%', '%fever%']
+
+
+def test_fulltext_query():
+    sql, params = compiled(search_query(['cough'], method='fulltext',
+                                        match_all=True))
+    # must repeat the indexed expression verbatim
+    assert "to_tsvector('english', coalesce(chief_complaint, '')) @@ "\
+        "plainto_tsquery('english', %(plainto_tsquery_1)s)" in sql
+    assert "to_tsvector('english', coalesce(dx_description, ''))" in sql
+    assert params['plainto_tsquery_1'] == 'cough'
+
+
+def test_unknown_method():
+    try:
+        search_query(['cough'], method='soundex')
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from nose.tools import raises
+
+from pheme.warehouse.selection import chunked
+from pheme.warehouse.selection import MessageSelection
+from pheme.warehouse.selection import parse_datetime
+
+
+@raises(ValueError)
+def test_selection_requires_criteria():
+    MessageSelection()
+
+
+def test_selection_criteria():
+    selection = MessageSelection(batch_filenames=['Rrliqv'],
+                                 since=datetime(2013, 1, 1),
+                                 last_msh_id=100)
+    assert len(selection.criteria()) == 3
+    assert str(selection) == "batch_filename in (Rrliqv) and "\
+        "message_datetime >= 2013-01-01 00:00:00 and hl7_msh_id <= 100"
+
+
+def test_parse_datetime():
+    assert parse_datetime('2013-05-01') == datetime(2013, 5, 1)
+    assert parse_datetime('2013-05-01 12:30:00') == \
+        datetime(2013, 5, 1, 12, 30)
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
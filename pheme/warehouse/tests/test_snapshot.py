@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+
+from pheme.warehouse.tests.snapshot import content_hash
+from pheme.warehouse.tests.snapshot import template_name
+
+
+def test_content_hash():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(tmpdir, name) for name in ('Ra', 'Rb')]
+        for path in paths:
+            with open(path, 'w') as batchfile:
+                batchfile.write('MSH|' + path)
+        digest = content_hash(paths)
+        assert digest == content_hash(reversed(paths))
+        assert digest != content_hash(paths[:1])
+        with open(paths[1], 'a') as batchfile:
+            batchfile.write('\nPID|')
+        assert digest != content_hash(paths)
+        assert content_hash(paths, tmpdir) != content_hash(paths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_template_name():
+    assert template_name('warehouse') == 'warehouse_template'
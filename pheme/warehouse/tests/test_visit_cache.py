@@ -0,0 +1,86 @@
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+from pheme.warehouse.tables import HL7_Obx
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Msh_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import metadata
+from pheme.warehouse.visit_cache import estimate_size
+from pheme.warehouse.visit_cache import LRUCache
+from pheme.warehouse.visit_cache import OBJECT_OVERHEAD
+from pheme.warehouse.visit_cache import VisitCache
+
+
+def test_lru_order():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts b, the least recently used
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['evictions'] == 1
+
+
+def test_size_bound():
+    cache = LRUCache(max_bytes=100)
+    cache.put('a', 'x', size=60)
+    cache.put('b', 'y', size=60)
+    assert len(cache) == 1 and 'b' in cache
+    assert cache.bytes == 60
+    cache.put('huge', 'z', size=101)
+    assert 'huge' not in cache
+    assert cache.pop('b')
+    assert cache.bytes == 0
+
+
+def test_miss_rate():
+    cache = LRUCache()
+    assert cache.get('missing') is None
+    cache.put('a', [])
+    assert cache.get('a') == []
+    assert cache.stats()['hit_rate'] == 0.5
+
+
+def test_estimate_size():
+    obx = HL7_Obx(observation_text='abcd', units='mg')
+    assert estimate_size([obx]) >= OBJECT_OVERHEAD + 6
+
+
+def test_late_derived_rows():
+    "dx and obr rows committed after the visit's invalidate it"
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine, tables=[
+        hl7Msh_table, hl7Visit_table, hl7Dx_table, hl7Obr_table,
+        hl7Obx_table, hl7Spm_table])
+    engine.execute(hl7Msh_table.insert(), {
+        'hl7_msh_id': 1, 'message_control_id': 'a',
+        'message_type': 'ADT^A04^ADT_A01', 'facility': '1234',
+        'message_datetime': datetime(2012, 1, 1), 'batch_filename': 'R'})
+    engine.execute(hl7Visit_table.insert(), {
+        'hl7_msh_id': 1, 'visit_id': '1^^^&1.2&ISO',
+        'patient_id': '2^^^&1.2&ISO'})
+    cache = VisitCache(engine)
+    assert cache.full_messages('1^^^&1.2&ISO')[0].dxes == []
+    assert cache.observation_data('1^^^&1.2&ISO') == []
+
+    engine.execute(hl7Dx_table.insert(), {
+        'hl7_dx_id': 1, 'hl7_msh_id': 1, 'rank': 1, 'dx_code': '784.0'})
+    engine.execute(hl7Obr_table.insert(), {
+        'hl7_obr_id': 1, 'hl7_msh_id': 1, 'loinc_code': '610-6'})
+    messages = cache.full_messages('1^^^&1.2&ISO')
+    assert [dx.dx_code for dx in messages[0].dxes] == ['784.0']
+    assert len(cache.observation_data('1^^^&1.2&ISO')) == 1
+    assert cache.invalidations == 1
+
+    # handled rows don't invalidate again
+    cache.full_messages('1^^^&1.2&ISO')
+    assert cache.stats()['full_messages']['hits'] == 1
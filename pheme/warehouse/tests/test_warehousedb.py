@@ -12,6 +12,8 @@ from pheme.warehouse.tables import HL7_Obx
 from pheme.warehouse.tables import HL7_RawMessage
 from pheme.warehouse.tables import HL7_Spm
 from pheme.warehouse.tables import HL7_Visit
+from pheme.warehouse.tests.workers import provision_worker_database
+from pheme.warehouse.tests.workers import worker_database
 
 
 def setup_module():
@@ -23,7 +25,7 @@ def setup_module():
     cfg_value = lambda v: c.get('warehouse', v)
     create_tables(cfg_value('create_table_user'),
                   cfg_value('create_table_password'),
-                  cfg_value('database'),
+                  provision_worker_database(c),
                   enable_delete=True)
 
 
@@ -34,7 +36,7 @@ class testSqlAObjects(unittest.TestCase):
     def setUp(self):
         c = Config()
         cfg_value = lambda v: c.get('warehouse', v)
-        self.alchemy = AlchemyAccess(database=cfg_value('database'),
+        self.alchemy = AlchemyAccess(database=worker_database(c),
                                      host='localhost',
                                      user=cfg_value('database_user'),
                                      password=cfg_value('database_password'))
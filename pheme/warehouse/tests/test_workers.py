@@ -0,0 +1,62 @@
+import multiprocessing
+import os
+from unittest import SkipTest
+
+from pheme.util.config import Config
+from pheme.warehouse.tests import workers
+
+
+def test_serial_uses_configured_database():
+    if multiprocessing.current_process().name != 'MainProcess':
+        raise SkipTest("running in a worker process")
+    os.environ.pop('PHEME_TEST_WORKER', None)
+    os.environ.pop('PYTEST_XDIST_WORKER', None)
+    assert workers.worker_id() is None
+    assert workers.worker_database(Config()) == \
+        Config().get('warehouse', 'database')
+    # nothing provisioned, nothing dropped
+    workers.drop_worker_database()
+
+
+def test_worker_process():
+    if multiprocessing.current_process().name == 'MainProcess':
+        raise SkipTest("not running in a worker process")
+    assert workers.worker_id().startswith('w')
+
+
+def test_worker_database():
+    os.environ['PHEME_TEST_WORKER'] = 'gw-2'
+    try:
+        assert workers.worker_id() == 'gw_2'
+        assert workers.worker_database(Config()) == '%s_gw_2' % \
+            Config().get('warehouse', 'database')
+    finally:
+        del os.environ['PHEME_TEST_WORKER']
+
+
+def test_provisioned_database_dropped():
+    statements, exit_functions = [], []
+
+    def execute_autocommit(user, password, batch):
+        statements.extend(statement for statement, parameters in batch)
+        return [[]]
+
+    def finalize(obj, callback, exitpriority):
+        exit_functions.append(callback)
+
+    saved = workers.execute_autocommit, workers.Finalize
+    workers.execute_autocommit = execute_autocommit
+    workers.Finalize = finalize
+    os.environ['PHEME_TEST_WORKER'] = 'gw9'
+    try:
+        database = workers.provision_worker_database(Config())
+        assert database.endswith('_gw9')
+        assert 'CREATE DATABASE "%s"' % database in statements
+        assert exit_functions == [workers.drop_worker_database]
+        exit_functions[0]()
+        assert 'DROP DATABASE IF EXISTS "%s"' % database in statements
+        assert not workers._provisioned
+    finally:
+        workers.execute_autocommit, workers.Finalize = saved
+        del os.environ['PHEME_TEST_WORKER']
+        workers._provisioned.clear()
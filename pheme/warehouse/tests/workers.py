@@ -0,0 +1,93 @@
+"""Per worker test databases, for running the suites in parallel
+
+The database test modules destructively recreate the warehouse in
+their `setup_module`, so concurrent test processes sharing the
+configured [warehouse]database would trample each other.  When run in
+a worker process (such as `nosetests --processes=4`, pytest-xdist, or
+any runner setting PHEME_TEST_WORKER), each worker instead uses its
+own database, `<database>_<worker id>`, created on first use and
+dropped when the worker process exits.  Run serially, the configured
+database is used as before.
+
+"""
+import multiprocessing
+from multiprocessing.util import Finalize
+import os
+import re
+
+from pheme.util.config import Config
+from pheme.warehouse.tests.snapshot import execute_autocommit
+from pheme.warehouse.tests.snapshot import terminate_sessions
+
+
+# Databases created by this process, dropped by drop_worker_database
+_provisioned = set()
+
+
+def worker_id():
+    """Returns the id of this test worker process, None if not a worker"""
+    worker = os.environ.get('PHEME_TEST_WORKER') or \
+        os.environ.get('PYTEST_XDIST_WORKER')
+    if not worker:
+        name = multiprocessing.current_process().name
+        if name == 'MainProcess':
+            return None
+        worker = 'w' + name.rsplit('-', 1)[-1]
+    return re.sub(r'\W', '_', worker).lower()
+
+
+def worker_database(config=None):
+    """Returns the name of the warehouse database for this process"""
+    database = (config or Config()).get('warehouse', 'database')
+    worker = worker_id()
+    return '%s_%s' % (database, worker) if worker else database
+
+
+def _owner_credentials(config):
+    return (config.get('warehouse', 'create_table_user'),
+            config.get('warehouse', 'create_table_password'))
+
+
+def provision_worker_database(config=None):
+    """Ensure this worker's database exists, if a worker
+
+    Called by the database test fixtures before (re)creating tables,
+    so suites without database tests never create one.  The database
+    is dropped as the worker exits; registered here, as the worker is
+    the only process knowing it.  Returns the database name, see
+    `worker_database`.
+
+    """
+    config = config or Config()
+    database = worker_database(config)
+    if worker_id() and database not in _provisioned:
+        user, password = _owner_credentials(config)
+        exists = execute_autocommit(user, password, [(
+            "SELECT 1 FROM pg_database WHERE datname = %(database)s",
+            {'database': database})])[0]
+        if not exists:
+            execute_autocommit(user, password, [
+                ('CREATE DATABASE "%s"' % database, None)])
+        if not _provisioned:
+            # a multiprocessing exit handler, as worker processes
+            # leave by os._exit(), skipping atexit
+            Finalize(None, drop_worker_database, exitpriority=0)
+        _provisioned.add(database)
+    return database
+
+
+def drop_worker_database(config=None):
+    """Drop the database provisioned by this worker, if any
+
+    Never touches the shared, configured database.
+
+    """
+    if not _provisioned:
+        return
+    config = config or Config()
+    user, password = _owner_credentials(config)
+    while _provisioned:
+        database = _provisioned.pop()
+        execute_autocommit(user, password, [
+            terminate_sessions(database),
+            ('DROP DATABASE IF EXISTS "%s"' % database, None)])
@@ -0,0 +1,274 @@
+"""In-process cache of the per-visit message lookups
+
+Consumers such as alerting repeatedly request every message for the
+same visit_id as further A08 updates arrive.  `VisitCache` holds the
+results of the two per-visit queries (all `FullMessage` rows, and all
+`ObservationData` rows for a visit) in a least recently used cache,
+bounded by both entry count and estimated memory.
+
+New messages invalidate the affected visits: before answering, the
+cache asks hl7_visit, and the hl7_dx, hl7_obr, hl7_obx and hl7_spm
+tables feeding the cached results, for any rows of an hl7_msh_id above
+the highest it has seen (index range scans) and evicts those
+visit_ids.  The channels commit a message's rows to each table
+separately, and sequence values aren't committed in order, so the
+scan reaches back `lookback` ids below the highest seen, ignoring rows
+already handled.
+
+Bulk operations that rewrite existing rows in place
+(`reprocess_warehouse`, `purge_warehouse`) are not detected; call
+`VisitCache.clear` after such operations.
+
+"""
+from collections import OrderedDict
+import threading
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import union_all
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import sessionmaker
+
+from pheme.warehouse.tables import FullMessage
+from pheme.warehouse.tables import HL7_Visit
+from pheme.warehouse.tables import hl7Dx_table
+from pheme.warehouse.tables import hl7Obr_table
+from pheme.warehouse.tables import hl7Obx_table
+from pheme.warehouse.tables import hl7Spm_table
+from pheme.warehouse.tables import hl7Visit_table
+from pheme.warehouse.tables import ObservationData
+
+
+# Rough per object overhead, added to the length of its string values
+OBJECT_OVERHEAD = 256
+
+
+def estimate_size(objects):
+    """Approximate memory held by a list of loaded mapped objects
+
+    Walks the loaded attributes (including loaded relations), summing
+    the length of each value plus a fixed per object overhead.
+
+    """
+    size = 0
+    pending = list(objects)
+    while pending:
+        obj = pending.pop()
+        size += OBJECT_OVERHEAD
+        for key, value in obj.__dict__.items():
+            if key.startswith('_'):
+                continue
+            if isinstance(value, list):
+                pending.extend(value)
+            elif hasattr(value, '_sa_instance_state'):
+                pending.append(value)
+            elif isinstance(value, basestring):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by entries and size
+
+    :param max_entries: maximum number of cached entries
+    :param max_bytes: maximum total of the entry sizes given to `put`
+
+    Tracks hits, misses and evictions; see `stats`.
+
+    """
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Returns cached value, or None on a miss"""
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = (value, size)  # now most recently used
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=0):
+        """Cache value, evicting least recently used entries to fit
+
+        Values larger than max_bytes on their own are not cached.
+
+        """
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or \
+                self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def pop(self, key):
+        """Remove the entry if present, returns True if it was"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[1]
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """Returns dictionary of the cache metrics"""
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class VisitCache(object):
+    """Cached `FullMessage` and `ObservationData` lookups by visit_id
+
+    :param bind: engine (or connection) for the warehouse database.
+      The cache uses its own session; returned objects are shared
+      between callers and must be treated as read only.
+    :param max_visits: maximum number of visits cached, per lookup type
+    :param max_bytes: maximum estimated memory, per lookup type
+    :param lookback: hl7_msh_id range rescanned for late commits
+
+    Safe for use from multiple threads.
+
+    """
+    def __init__(self, bind, max_visits=1000, max_bytes=64 * 1024 * 1024,
+                 lookback=1000):
+        self.session = sessionmaker(bind=bind, expire_on_commit=False)()
+        self._caches = {FullMessage: LRUCache(max_visits, max_bytes),
+                        ObservationData: LRUCache(max_visits, max_bytes)}
+        self._lock = threading.Lock()
+        self.invalidations = 0
+        self.lookback = lookback
+        # hl7_msh_id of the rows handled, keyed by (table, row id)
+        self._seen = {}
+        self.high_water = self.session.execute(select(
+            [func.max(hl7Visit_table.c.hl7_msh_id)])).scalar() or 0
+        self.session.commit()
+
+    def full_messages(self, visit_id):
+        """Returns list of FullMessage for the visit, by message_datetime"""
+        return self._lookup(FullMessage, visit_id)
+
+    def observation_data(self, visit_id):
+        """Returns list of ObservationData (OBRs with OBXes and SPMs)"""
+        return self._lookup(ObservationData, visit_id)
+
+    def _query(self, kind, visit_id):
+        if kind is FullMessage:
+            return self.session.query(FullMessage).\
+                join((HL7_Visit,
+                      HL7_Visit.hl7_msh_id == FullMessage.hl7_msh_id)).\
+                filter(HL7_Visit.visit_id == visit_id).\
+                order_by(FullMessage.message_datetime)
+        return self.session.query(ObservationData).\
+            options(joinedload('spms')).\
+            join((HL7_Visit,
+                  HL7_Visit.hl7_msh_id == ObservationData.hl7_msh_id)).\
+            filter(HL7_Visit.visit_id == visit_id).\
+            order_by(ObservationData.hl7_obr_id)
+
+    def _lookup(self, kind, visit_id):
+        with self._lock:
+            try:
+                self._invalidate_new_messages()
+                cache = self._caches[kind]
+                results = cache.get(visit_id)
+                if results is None:
+                    results = self._query(kind, visit_id).\
+                        populate_existing().all()
+                    cache.put(visit_id, results, estimate_size(results))
+            finally:
+                # Don't hold a transaction open between lookups
+                self.session.commit()
+            return list(results)
+
+    def _new_rows_query(self, floor):
+        """Select (table, row id, hl7_msh_id, visit_id) above floor
+
+        Rows of messages lacking their hl7_visit row are left out; the
+        visit's eventual arrival invalidates the visit.
+
+        """
+        visit, obr = hl7Visit_table.c, hl7Obr_table.c
+        queries = [select([literal(hl7Visit_table.name).label('source'),
+                           visit.hl7_msh_id.label('row_id'),
+                           visit.hl7_msh_id, visit.visit_id],
+                          visit.hl7_msh_id > floor)]
+        for table in hl7Dx_table, hl7Obr_table, hl7Obx_table:
+            queries.append(select(
+                [literal(table.name), list(table.primary_key)[0],
+                 table.c.hl7_msh_id, visit.visit_id],
+                and_(table.c.hl7_msh_id > floor,
+                     table.c.hl7_msh_id == visit.hl7_msh_id)))
+        queries.append(select(
+            [literal(hl7Spm_table.name), hl7Spm_table.c.hl7_spm_id,
+             obr.hl7_msh_id, visit.visit_id],
+            and_(obr.hl7_msh_id > floor,
+                 hl7Spm_table.c.hl7_obr_id == obr.hl7_obr_id,
+                 obr.hl7_msh_id == visit.hl7_msh_id)))
+        return union_all(*queries)
+
+    def _invalidate_new_messages(self):
+        """Evict visits having rows added since the last check"""
+        floor = self.high_water - self.lookback
+        rows = self.session.execute(self._new_rows_query(floor)).fetchall()
+        for source, row_id, hl7_msh_id, visit_id in rows:
+            if (source, row_id) in self._seen:
+                continue
+            self._seen[(source, row_id)] = hl7_msh_id
+            self.high_water = max(self.high_water, hl7_msh_id)
+            self.invalidate(visit_id)
+        floor = self.high_water - self.lookback
+        self._seen = dict((key, msh_id) for key, msh_id in
+                          self._seen.items() if msh_id > floor)
+
+    def invalidate(self, visit_id):
+        """Evict any cached results for the visit"""
+        evicted = [cache.pop(visit_id) for cache in self._caches.values()]
+        if any(evicted):
+            self.invalidations += 1
+
+    def clear(self):
+        """Evict everything, such as after a bulk reprocess or purge"""
+        with self._lock:
+            for cache in self._caches.values():
+                cache.clear()
+
+    def stats(self):
+        """Returns dictionary of metrics, keyed by lookup type
+
+        Each lookup type reports entries, bytes, hits, misses,
+        evictions and hit_rate; 'invalidations' counts visits evicted
+        due to new messages.
+
+        """
+        with self._lock:
+            stats = {'full_messages': self._caches[FullMessage].stats(),
+                     'observation_data':
+                     self._caches[ObservationData].stats(),
+                     'invalidations': self.invalidations}
+        return stats
@@ -30,10 +30,19 @@ setup(name='pheme.warehouse',
                         },
       entry_points=("""
                     [console_scripts]
+                    archive_raw_messages=pheme.warehouse.archive:archive_raw_messages
+                    benchmark_ingest=pheme.warehouse.tests.benchmark:benchmark_ingest
                     create_warehouse_tables=pheme.warehouse.tables:main
                     deploy_channels=pheme.warehouse.mirth_shell_commands:deploy_channels
+                    diff_warehouses=pheme.warehouse.diff:diff_warehouses
                     export_channels=pheme.warehouse.mirth_shell_commands:export_channels
                     transform_channels=pheme.warehouse.mirth_shell_commands:transform_channels
+                    generate_hl7_batchfiles=pheme.warehouse.tests.generate_batchfiles:generate_hl7_batchfiles
+                    ingest_batchfiles=pheme.warehouse.ingest:ingest_batchfiles
+                    migrate_warehouse=pheme.warehouse.migrate:migrate_warehouse
                     process_testfiles_via_mirth=pheme.warehouse.tests.process_testfiles:process_testfiles_via_mirth
+                    purge_warehouse=pheme.warehouse.purge:purge_warehouse
+                    reprocess_warehouse=pheme.warehouse.reprocess:reprocess_warehouse
+                    warehouse_dq=pheme.warehouse.dq:warehouse_dq
                     """),
 )